@@ -0,0 +1,310 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+from lsmTree import LsmTree
+from value import Value
+
+'''
+ $$$$ Workload benchmark:
+  Runs YCSB-style workloads against LsmTree. Every run makes a fresh tree, loads it (the load phase) and then runs a
+  mix of operations on it (the run phase), timing every operation. A sweep runs every combination of the given tree
+  shapes, and the results of all runs are printed and written as JSON, so that runs can be compared.
+
+    python bench.py --workload b --distribution zipfian --items 10000,100000 --fan-out 5,10 --out results.json
+
+  Workloads (read / update / scan share of the run phase, as in YCSB):
+   - a: 50 / 50 / 0       update heavy
+   - b: 95 / 5 / 0        read mostly
+   - c: 100 / 0 / 0       read only
+   - e: 0 / 5 / 95        short ranges
+  or any mix given with --mix read,update,scan.
+
+  Key distributions: uniform, zipfian (YCSB's, skew 0.99, with the popular keys scattered over the key space) and
+  sequential (keys in order, wrapping around).
+
+  Every run also records LsmTree.stats() (see stats.py). Bytes read are the stored bytes of the data blocks the
+  operations read from the node files, memory-mapped ones included (the tree's block_bytes_read). Bytes written, and
+  the syscall_read bytes next to them, are what the process wrote and read through system calls (/proc/self/io, Linux
+  only).
+'''
+
+WORKLOADS = {
+    'a': (0.5, 0.5, 0.0),
+    'b': (0.95, 0.05, 0.0),
+    'c': (1.0, 0.0, 0.0),
+    'e': (0.0, 0.05, 0.95),
+}
+
+ZIPFIAN_THETA = 0.99
+
+
+class ZipfianKeys(object):
+    """
+    YCSB's zipfian generator over the keys 1..items, the most popular rank first, the ranks scattered over the key
+    space by a fixed permutation
+    """
+    def __init__(self, items, rng, theta=ZIPFIAN_THETA):
+        self.items = items
+        self.rng = rng
+        self.theta = theta
+
+        self.zeta_n = sum(1 / pow(i, theta) for i in range(1, items + 1))
+        zeta_2 = 1 + 1 / pow(2, theta)
+        self.alpha = 1 / (1 - theta)
+        self.eta = (1 - pow(2 / items, 1 - theta)) / (1 - zeta_2 / self.zeta_n)
+
+        # multiplying by a number coprime with items permutes the ranks
+        self.scatter = next(m for m in itertools.count(2654435761) if math.gcd(m, items) == 1)
+
+    def next(self):
+        u = self.rng.random()
+        uz = u * self.zeta_n
+        if uz < 1:
+            rank = 0
+        elif uz < 1 + pow(0.5, self.theta):
+            rank = 1
+        else:
+            rank = int(self.items * pow(self.eta * u - self.eta + 1, self.alpha))
+        return (min(rank, self.items - 1) * self.scatter) % self.items + 1
+
+
+class UniformKeys(object):
+    def __init__(self, items, rng):
+        self.items = items
+        self.rng = rng
+
+    def next(self):
+        return self.rng.randint(1, self.items)
+
+
+class SequentialKeys(object):
+    def __init__(self, items, rng):
+        self.items = items
+        self.last = 0
+
+    def next(self):
+        self.last = self.last % self.items + 1
+        return self.last
+
+
+DISTRIBUTIONS = {'uniform': UniformKeys, 'zipfian': ZipfianKeys, 'sequential': SequentialKeys}
+
+
+def make_value(rng, columns, col_bytes):
+    return Value([(col, ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(col_bytes)))
+                  for col in range(1, columns + 1)], columns)
+
+
+def io_counters(lsm):
+    """
+    :return: dict of the data block bytes the tree read so far, and of the bytes the process read and wrote through
+             system calls, None where the platform does not tell
+    """
+    counters = {'read': lsm.stats()['tree']['block_bytes_read'], 'syscall_read': None, 'written': None}
+    try:
+        with open('/proc/self/io') as infile:
+            fields = dict(line.split(': ') for line in infile.read().splitlines())
+        counters.update(syscall_read=int(fields['rchar']), written=int(fields['wchar']))
+    except (OSError, KeyError, ValueError):
+        pass
+    return counters
+
+
+def io_delta(before, after):
+    return {key: None if before[key] is None else after[key] - before[key] for key in before}
+
+
+def disk_bytes(file_root):
+    return sum(os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(file_root) for name in names)
+
+
+def percentiles(latencies):
+    """
+    :param latencies: operation latencies in seconds
+    :return: dict of the count and the p50, p99, p999 and max latencies in microseconds
+    """
+    if not latencies:
+        return {'count': 0}
+    ordered = sorted(latencies)
+
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1e6, 1)
+    return {'count': len(ordered), 'p50': at(0.5), 'p99': at(0.99), 'p999': at(0.999),
+            'max': round(ordered[-1] * 1e6, 1)}
+
+
+def load(lsm, args, rng):
+    """
+    Writes every key once, in random order
+    """
+    keys = list(range(1, args.records + 1))
+    rng.shuffle(keys)
+
+    latencies = []
+    start = time.perf_counter()
+    for key in keys:
+        t = time.perf_counter()
+        lsm.write(key, make_value(rng, args.columns, args.col_bytes))
+        latencies.append(time.perf_counter() - t)
+    lsm.flush()
+    seconds = time.perf_counter() - start
+    return {'ops': len(keys), 'seconds': round(seconds, 3), 'throughput': round(len(keys) / seconds, 1),
+            'latency_us': {'write': percentiles(latencies)}}
+
+
+def run(lsm, args, rng, mix):
+    keys = DISTRIBUTIONS[args.distribution](args.records, rng)
+    latencies = {'read': [], 'update': [], 'scan': []}
+    read_cols = list(range(1, min(args.read_columns, args.columns) + 1)) if args.read_columns else 0
+
+    start = time.perf_counter()
+    for _ in range(args.operations):
+        pick = rng.random()
+        key = keys.next()
+        if pick < mix[0]:
+            op = 'read'
+            t = time.perf_counter()
+            lsm.read(key, key, read_cols)
+        elif pick < mix[0] + mix[1]:
+            op = 'update'
+            val = make_value(rng, args.columns, args.col_bytes)
+            t = time.perf_counter()
+            lsm.write(key, val)
+        else:
+            op = 'scan'
+            high = key + rng.randint(1, args.scan_length) - 1
+            t = time.perf_counter()
+            for _ in lsm.scan(key, high, read_cols):
+                pass
+        latencies[op].append(time.perf_counter() - t)
+    seconds = time.perf_counter() - start
+    return {'ops': args.operations, 'seconds': round(seconds, 3), 'throughput': round(args.operations / seconds, 1),
+            'latency_us': {op: percentiles(latencies[op]) for op in latencies if latencies[op]}}
+
+
+def bench(shape, args, mix):
+    """
+    One run: a fresh tree of the given shape, loaded and then run
+    :param shape: dict of items, levels, fan_out and fp_prob
+    """
+    rng = random.Random(args.seed)
+    file_root = tempfile.mkdtemp(prefix='lsm-bench-', dir=args.dir)
+    try:
+        lsm = LsmTree(shape['items'], shape['levels'], shape['fan_out'], file_root, shape['fp_prob'],
+                      cols_per_group=args.cols_per_group, wal_sync=args.wal_sync,
+                      compression=args.compression if len(args.compression) > 1 else args.compression[0],
+                      compaction_workers=args.compaction_workers, compaction_pool=args.compaction_pool,
+                      buffer_bytes=args.buffer_bytes,
+                      compaction=args.compaction if len(args.compaction) > 1 else args.compaction[0],
+                      tier_runs=args.tier_runs)
+
+        io_start = io_counters(lsm)
+        load_result = load(lsm, args, rng)
+        io_loaded = io_counters(lsm)
+        run_result = run(lsm, args, rng, mix)
+        lsm.flush()
+        io_end = io_counters(lsm)
+
+        load_result['bytes'] = io_delta(io_start, io_loaded)
+        run_result['bytes'] = io_delta(io_loaded, io_end)
+        result = {'shape': shape, 'load': load_result, 'run': run_result, 'disk_bytes': disk_bytes(file_root),
+                  'stats': lsm.stats()}
+        lsm.close()
+        return result
+    finally:
+        if not args.keep:
+            shutil.rmtree(file_root, ignore_errors=True)
+
+
+def print_result(result):
+    shape = result['shape']
+    print('items=%d levels=%d fan_out=%d fp_prob=%g' % (shape['items'], shape['levels'], shape['fan_out'],
+                                                         shape['fp_prob']))
+    for phase in ('load', 'run'):
+        res = result[phase]
+        print('  %-4s %8d ops %9.1f ops/s  read %s B  written %s B' % (phase, res['ops'], res['throughput'],
+                                                                       res['bytes']['read'], res['bytes']['written']))
+        for op, lat in res['latency_us'].items():
+            print('       %-6s p50 %8.1f us  p99 %8.1f us  p999 %8.1f us  max %9.1f us' %
+                  (op, lat['p50'], lat['p99'], lat['p999'], lat['max']))
+    print('  on disk %d B' % result['disk_bytes'])
+
+
+def number_list(kind):
+    return lambda text: [kind(part) for part in text.split(',')]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='YCSB-style workload benchmark of LsmTree')
+    parser.add_argument('--items', type=number_list(int), default=[10000], help='key space sizes to sweep')
+    parser.add_argument('--levels', type=number_list(int), default=[3], help='numbers of levels to sweep')
+    parser.add_argument('--fan-out', type=number_list(int), default=[10], help='fan out rates to sweep')
+    parser.add_argument('--fp-prob', type=number_list(float), default=[0.05],
+                        help='bloom filter false positive probabilities to sweep')
+    parser.add_argument('--workload', choices=sorted(WORKLOADS), default='b')
+    parser.add_argument('--mix', type=number_list(float), help='read,update,scan shares, overrides --workload')
+    parser.add_argument('--distribution', choices=sorted(DISTRIBUTIONS), default='zipfian')
+    parser.add_argument('--records', type=int, help='keys written by the load phase (default: items)')
+    parser.add_argument('--operations', type=int, default=10000, help='operations of the run phase')
+    parser.add_argument('--columns', type=int, default=10, help='columns per value')
+    parser.add_argument('--col-bytes', type=int, default=20, help='bytes per column')
+    parser.add_argument('--read-columns', type=int, default=0, help='columns a read asks for, 0 for all')
+    parser.add_argument('--scan-length', type=int, default=100, help='longest key range a scan covers')
+    parser.add_argument('--cols-per-group', type=int, default=1)
+    parser.add_argument('--compression', type=number_list(str), default=['none'],
+                        help='block compression codec, or one per level (e.g. none,zlib,lzma)')
+    parser.add_argument('--wal-sync', choices=('always', 'group', 'none'), default='group',
+                        help='when a write is fsynced: on its own, sharing an fsync with concurrent writes, or never')
+    parser.add_argument('--compaction-workers', type=int, default=1, help='level 0 subtrees compacted at a time')
+    parser.add_argument('--compaction-pool', choices=('thread', 'process'), default='thread',
+                        help='whether last level files are encoded by the compacting threads or worker processes')
+    parser.add_argument('--buffer-bytes', type=int, default=1024 * 1024,
+                        help='bytes of writes the memory buffer holds before it is flushed')
+    parser.add_argument('--compaction', type=number_list(str), default=['leveled'],
+                        help='compaction policy of the levels above the last, or one per level (e.g. tiered,leveled)')
+    parser.add_argument('--tier-runs', type=int, default=4, help='sorted runs a tiered node has before they are merged')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dir', help='where the trees are made (default: the temp directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the trees after the runs')
+    parser.add_argument('--out', help='file to write the JSON results to')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    mix = args.mix if args.mix else WORKLOADS[args.workload]
+    if len(mix) != 3 or abs(sum(mix) - 1) > 1e-9:
+        raise SystemExit('--mix takes three shares (read,update,scan) adding up to 1')
+
+    results = []
+    for items, levels, fan_out, fp_prob in itertools.product(args.items, args.levels, args.fan_out, args.fp_prob):
+        shape = {'items': items, 'levels': levels, 'fan_out': fan_out, 'fp_prob': fp_prob}
+        run_args = argparse.Namespace(**vars(args))
+        run_args.records = min(args.records or items, items)
+        result = bench(shape, run_args, mix)
+        print_result(result)
+        results.append(result)
+
+    report = {'workload': {'mix': dict(zip(('read', 'update', 'scan'), mix)), 'distribution': args.distribution,
+                           'records': args.records, 'operations': args.operations, 'columns': args.columns,
+                           'col_bytes': args.col_bytes, 'read_columns': args.read_columns,
+                           'scan_length': args.scan_length, 'cols_per_group': args.cols_per_group,
+                           'wal_sync': args.wal_sync, 'compression': args.compression,
+                           'compaction_workers': args.compaction_workers, 'compaction_pool': args.compaction_pool,
+                           'buffer_bytes': args.buffer_bytes, 'compaction': args.compaction,
+                           'tier_runs': args.tier_runs, 'seed': args.seed},
+              'runs': results}
+    if args.out:
+        with open(args.out, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+import json
+import bench
+
+
+def test_a_small_sweep_reports_every_run(tmp_path):
+    out = tmp_path / 'results.json'
+    report = bench.main(['--items', '300', '--levels', '1,2', '--fan-out', '4', '--operations', '300',
+                         '--mix', '0.6,0.2,0.2', '--scan-length', '20', '--columns', '3', '--buffer-bytes', '4000',
+                         '--dir', str(tmp_path), '--out', str(out)])
+    assert json.loads(out.read_text()) == json.loads(json.dumps(report))
+
+    runs = report['runs']
+    assert [result['shape']['levels'] for result in runs] == [1, 2]
+    for result in runs:
+        assert result['disk_bytes'] > 0
+        for phase in ('load', 'run'):
+            res = result[phase]
+            assert res['ops'] == 300 and res['throughput'] > 0
+            assert res['bytes']['written'] is None or res['bytes']['written'] > 0
+            for lat in res['latency_us'].values():
+                assert lat['p50'] <= lat['p99'] <= lat['p999'] <= lat['max']
+        assert set(result['run']['latency_us']) == {'read', 'update', 'scan'}
+        # scans read their blocks through memory maps, and still count
+        assert result['run']['bytes']['read'] > 0
+        assert result['stats']['tree']['block_bytes_read'] >= result['run']['bytes']['read']
+
+    # the trees are removed after their runs
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['results.json']
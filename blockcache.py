@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+
+# bytes of the key and the dict slot of every key/value pair of a cached block, on top of the value (see Value.nbytes)
+ENTRY_OVERHEAD = 100
+
+
+class BlockCache(object):
+    """
+    Tree-wide LRU cache of decoded data blocks, shared by all nodes. A block is keyed by its node file name, the
+    generation of the file (see MetaCache) and its position in the file, so a block of a replaced file is never
+    served for the new one. Blocks are charged their decoded size in memory against the byte budget (see block_bytes
+    and ColumnBlock.nbytes), which is several times their size in the file.
+    """
+    def __init__(self, capacity_bytes):
+        # the byte budget, 0 turns the cache off
+        self.capacity_bytes = capacity_bytes
+        self.used_bytes = 0
+
+        # (file name, generation, block position) -> (block, bytes), least recently used first
+        self.blocks = OrderedDict()
+
+        # file name -> keys of its cached blocks, to drop them when the file is replaced
+        self.by_file = dict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: the block, or None if it is not cached
+        """
+        with self.lock:
+            entry = self.blocks.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, block, nbytes):
+        if nbytes > self.capacity_bytes:
+            return
+        with self.lock:
+            if key in self.blocks:
+                return
+            self.blocks[key] = (block, nbytes)
+            self.by_file.setdefault(key[0], set()).add(key)
+            self.used_bytes += nbytes
+
+            while self.used_bytes > self.capacity_bytes:
+                old_key, (_, old_bytes) = self.blocks.popitem(last=False)
+                self.forget(old_key, old_bytes)
+                self.evictions += 1
+
+    def invalidate(self, filename):
+        """
+        Drops every cached block of a node file that was replaced or removed
+        """
+        with self.lock:
+            for key in self.by_file.get(filename, set()).copy():
+                _, nbytes = self.blocks.pop(key)
+                self.forget(key, nbytes)
+
+    def forget(self, key, nbytes):
+        self.used_bytes -= nbytes
+        file_keys = self.by_file[key[0]]
+        file_keys.discard(key)
+        if not file_keys:
+            del self.by_file[key[0]]
+
+    def counters(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'used_bytes': self.used_bytes, 'capacity_bytes': self.capacity_bytes}
+
+
+def block_bytes(block):
+    """
+    :param block: dict of the key/value pairs of a decoded block
+    :return: approximate memory size of the block
+    """
+    return sum(val.nbytes for val in block.values()) + ENTRY_OVERHEAD * len(block)
@@ -0,0 +1,70 @@
+from blockcache import ENTRY_OVERHEAD, BlockCache, block_bytes
+from lsmTree import LsmTree
+from value import Value
+
+
+def test_least_recently_used_blocks_are_evicted():
+    cache = BlockCache(300)
+    for pos in range(3):
+        cache.put(('a', 0, pos), {pos: 'block'}, 100)
+    assert cache.get(('a', 0, 0)) == {0: 'block'}
+
+    # block 1 is the least recently used one now
+    cache.put(('b', 0, 0), {0: 'other'}, 100)
+    assert cache.get(('a', 0, 1)) is None
+    assert [cache.get(('a', 0, pos)) is not None for pos in (0, 2)] == [True, True]
+    assert cache.counters() == {'hits': 3, 'misses': 1, 'evictions': 1, 'used_bytes': 300, 'capacity_bytes': 300}
+
+    # a block larger than the whole budget is not cached, nor does it evict anything
+    cache.put(('c', 0, 0), {0: 'huge'}, 301)
+    assert cache.get(('c', 0, 0)) is None
+    assert cache.counters()['evictions'] == 1
+
+
+def test_invalidate_drops_only_the_blocks_of_the_file():
+    cache = BlockCache(1000)
+    for name in ('a', 'b'):
+        for pos in range(2):
+            cache.put((name, 1, pos), {pos: name}, 50)
+    cache.invalidate('a')
+    assert [cache.get(('a', 1, pos)) for pos in range(2)] == [None, None]
+    assert [cache.get(('b', 1, pos)) for pos in range(2)] == [{0: 'b'}, {1: 'b'}]
+    assert cache.counters()['used_bytes'] == 100
+    assert cache.by_file == {'b': {('b', 1, 0), ('b', 1, 1)}}
+
+    # the same block of a newer generation of the file is another block
+    cache.put(('b', 2, 0), {0: 'new'}, 50)
+    assert cache.get(('b', 1, 0)) == {0: 'b'} and cache.get(('b', 2, 0)) == {0: 'new'}
+    cache.invalidate('missing')
+    assert cache.counters()['used_bytes'] == 150
+
+
+def test_block_bytes_charges_the_decoded_values():
+    block = {1: Value([(1, 'x' * 50)], 1), 2: Value([(1, 'y')], 1)}
+    assert block_bytes(block) == block[1].nbytes + block[2].nbytes + 2 * ENTRY_OVERHEAD
+    assert block[1].nbytes > block[2].nbytes
+
+
+def test_reads_hit_the_cache_until_the_file_is_replaced(tmp_path):
+    lsm = LsmTree(400, 2, 4, str(tmp_path), 0.01, buffer_bytes=4000)
+    for key in range(1, 200):
+        lsm.write(key, Value([(1, 'a%d' % key)], 1))
+    lsm.flush()
+
+    assert lsm.read(50, 50, 0).cols == [(1, 'a50')]
+    hits = lsm.cache_stats()['hits']
+    assert lsm.read(50, 50, 0).cols == [(1, 'a50')]
+    assert lsm.cache_stats()['hits'] == hits + 1
+
+    # the compaction rewriting the node drops its cached blocks, the new value is read from the new file
+    for key in range(1, 200):
+        lsm.write(key, Value([(1, 'b%d' % key)], 1))
+    lsm.flush()
+    assert lsm.read(50, 50, 0).cols == [(1, 'b50')]
+    counters = lsm.cache_stats()
+    assert 0 < counters['used_bytes'] <= counters['capacity_bytes']
+    lsm.close()
+
+    lsm = LsmTree(400, 2, 4, str(tmp_path / 'uncached'), 0.01, block_cache_bytes=0)
+    assert lsm.cache_stats() is None
+    lsm.close()
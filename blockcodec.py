@@ -0,0 +1,227 @@
+import bisect
+import bz2
+import lzma
+import struct
+import zlib
+from value import Value
+
+'''
+ $$$$ Data block encoding:
+  Every data block of a node file starts with one byte telling how the rest of it is stored: the low 4 bits are the
+  compression codec (an index into CODECS), bit 4 is set for a columnar block. A block is only stored compressed
+  when that makes it smaller.
+
+  Row blocks hold records (see nodefile.py). Columnar blocks, used by the last level, hold the keys of the block and
+  then one segment per column:
+   - dictionary: the distinct values of the column in the block
+   - codes: for every row the position of its value in the dictionary plus one, 0 for a row without the column,
+     stored either plain or run-length encoded (as (code, run length) pairs), whichever is smaller
+  so a read only decodes the segments of the columns it wants. A last segment, stored the same way, holds the num_cols
+  of every row (see value.py), as 4 byte values.
+'''
+
+CODECS = ('none', 'zlib', 'lzma', 'bz2')
+COMPRESS = (None, zlib.compress, lzma.compress, bz2.compress)
+DECOMPRESS = (None, zlib.decompress, lzma.decompress, bz2.decompress)
+COLUMNAR = 0x10
+
+# columnar block: number of rows, number of columns
+COLUMNS_HEADER = struct.Struct('>IH')
+ROW_WIDTH = struct.Struct('>I')
+PLAIN_CODES = 0
+RLE_CODES = 1
+
+# bytes a decoded column segment takes per row at most, on top of the block it is decoded from: a slot in its codes and
+# one dictionary value object
+SEGMENT_ROW_BYTES = 48
+
+
+def pack_block(raw, codec, columnar):
+    """
+    :param raw: the encoded block
+    :param codec: one of CODECS
+    :return: the block as stored in the file
+    """
+    head = COLUMNAR if columnar else 0
+    kind = CODECS.index(codec)
+    if kind:
+        packed = COMPRESS[kind](raw)
+        if len(packed) < len(raw):
+            return bytes([head | kind]) + packed
+    return bytes([head]) + raw
+
+
+def unpack_block(stored):
+    """
+    :return: whether the block is columnar, the encoded block
+    """
+    head = stored[0]
+    kind = head & 0x0f
+    raw = DECOMPRESS[kind](stored[1:]) if kind else bytes(stored[1:])
+    return bool(head & COLUMNAR), raw
+
+
+def code_format(dict_size):
+    if dict_size < 0xff:
+        return 'B'
+    if dict_size < 0xffff:
+        return 'H'
+    return 'I'
+
+
+def encode_columns(rows):
+    """
+    :param rows: list of (key, Value) pairs in key order
+    :return: the encoded columnar block
+    """
+    col_ids = sorted(set(col for _, val in rows for col in val.ids))
+    out = bytearray(COLUMNS_HEADER.pack(len(rows), len(col_ids)))
+    out += struct.pack('>%dq' % len(rows), *[key for key, _ in rows])
+    out += struct.pack('>%di' % len(col_ids), *col_ids)
+
+    segments = bytearray()
+    ends = []
+    for col in col_ids:
+        dictionary = dict()
+        codes = []
+        for _, val in rows:
+            col_bytes = val.get_bytes(col)
+            if col_bytes is None:
+                codes.append(0)
+            else:
+                codes.append(dictionary.setdefault(col_bytes, len(dictionary) + 1))
+        segments += encode_segment(list(dictionary), codes)
+        ends.append(len(segments))
+
+    widths = dict()
+    codes = [widths.setdefault(ROW_WIDTH.pack(val.num_cols), len(widths) + 1) for _, val in rows]
+    segments += encode_segment(list(widths), codes)
+
+    out += struct.pack('>%dI' % len(ends), *ends)
+    out += segments
+    return bytes(out)
+
+
+def encode_segment(values, codes):
+    fmt = code_format(len(values))
+    out = bytearray(struct.pack('>I', len(values)))
+    out += struct.pack('>%dI' % len(values), *[len(col_bytes) for col_bytes in values])
+    out += b''.join(values)
+
+    run_codes, run_lengths = [], []
+    for code in codes:
+        if run_codes and run_codes[-1] == code:
+            run_lengths[-1] += 1
+        else:
+            run_codes.append(code)
+            run_lengths.append(1)
+
+    plain_size = struct.calcsize('>' + fmt) * len(codes)
+    if 4 + struct.calcsize('>%d%s%dI' % (len(run_codes), fmt, len(run_codes))) < plain_size:
+        out.append(RLE_CODES)
+        out += struct.pack('>I', len(run_codes))
+        out += struct.pack('>%d%s' % (len(run_codes), fmt), *run_codes)
+        out += struct.pack('>%dI' % len(run_lengths), *run_lengths)
+    else:
+        out.append(PLAIN_CODES)
+        out += struct.pack('>%d%s' % (len(codes), fmt), *codes)
+    return out
+
+
+class ColumnBlock(object):
+    """
+    A decoded columnar block. The column segments are decoded when a read first wants their column, also once the block
+    is in the block cache (where threads may decode one at the same time, to the same result).
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        num_rows, num_cols = COLUMNS_HEADER.unpack_from(raw, 0)
+        pos = COLUMNS_HEADER.size
+        self.keys = struct.unpack_from('>%dq' % num_rows, raw, pos)
+        pos += 8 * num_rows
+        self.col_ids = struct.unpack_from('>%di' % num_cols, raw, pos)
+        pos += 4 * num_cols
+        self.ends = struct.unpack_from('>%dI' % num_cols, raw, pos)
+        self.segments_start = pos + 4 * num_cols
+
+        # column position -> (dictionary, codes)
+        self.columns = dict()
+        # num_cols of every row, decoded on the first row built
+        self.widths = None
+
+    @property
+    def nbytes(self):
+        """
+        approximate memory size of the block once every segment is decoded, the dictionary values being slices of it
+        """
+        return 2 * len(self.raw) + len(self.keys) * (len(self.col_ids) + 1) * SEGMENT_ROW_BYTES
+
+    def column(self, pos):
+        if pos not in self.columns:
+            self.columns[pos] = self.decode_segment(self.segments_start + (self.ends[pos - 1] if pos else 0))
+        return self.columns[pos]
+
+    def decode_segment(self, pos):
+        raw = self.raw
+        (dict_size,) = struct.unpack_from('>I', raw, pos)
+        pos += 4
+        lengths = struct.unpack_from('>%dI' % dict_size, raw, pos)
+        pos += 4 * dict_size
+        values = [None]
+        for length in lengths:
+            values.append(raw[pos:(pos + length)])
+            pos += length
+
+        fmt = code_format(dict_size)
+        kind = raw[pos]
+        pos += 1
+        if kind == RLE_CODES:
+            (num_runs,) = struct.unpack_from('>I', raw, pos)
+            pos += 4
+            run_codes = struct.unpack_from('>%d%s' % (num_runs, fmt), raw, pos)
+            pos += struct.calcsize('>%d%s' % (num_runs, fmt))
+            run_lengths = struct.unpack_from('>%dI' % num_runs, raw, pos)
+            codes = [code for code, length in zip(run_codes, run_lengths) for _ in range(length)]
+        else:
+            codes = struct.unpack_from('>%d%s' % (len(self.keys), fmt), raw, pos)
+        return values, codes
+
+    def wanted(self, cols):
+        return [pos for pos, col in enumerate(self.col_ids) if cols is None or col in cols]
+
+    def row_widths(self):
+        if self.widths is None:
+            values, codes = self.decode_segment(self.segments_start + (self.ends[-1] if self.ends else 0))
+            widths = [None] + [ROW_WIDTH.unpack(width)[0] for width in values[1:]]
+            self.widths = [widths[code] for code in codes]
+        return self.widths
+
+    def row(self, row, positions):
+        pairs = []
+        for pos in positions:
+            values, codes = self.column(pos)
+            if codes[row]:
+                pairs.append((self.col_ids[pos], values[codes[row]]))
+        return Value.from_raw(pairs, self.row_widths()[row])
+
+    def get(self, key, cols=None):
+        row = bisect.bisect_left(self.keys, key)
+        if row == len(self.keys) or self.keys[row] != key:
+            return None
+        return self.row(row, self.wanted(cols))
+
+    def get_many(self, keys, cols=None):
+        found = dict()
+        positions = self.wanted(cols)
+        for key in keys:
+            row = bisect.bisect_left(self.keys, key)
+            if row < len(self.keys) and self.keys[row] == key:
+                found[key] = self.row(row, positions)
+        return found
+
+    def items(self, low=None, high=None, cols=None):
+        positions = self.wanted(cols)
+        row = 0 if low is None else bisect.bisect_left(self.keys, low)
+        while row < len(self.keys) and (high is None or self.keys[row] <= high):
+            yield self.keys[row], self.row(row, positions)
+            row += 1
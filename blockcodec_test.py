@@ -0,0 +1,134 @@
+import random
+import struct
+import pytest
+from blockcache import BlockCache
+from bloomfilter import BloomFilter
+from blockcodec import CODECS, PLAIN_CODES, RLE_CODES, ColumnBlock, encode_columns, encode_segment, pack_block, \
+    unpack_block
+from columngroup import ColumnGroup
+from lsmTree import LsmTree
+from nodefile import HEADER, MAGIC, VERSION, read_node_file, read_node_meta, read_node_value, read_node_values, \
+    write_node_file
+from value import Value
+
+ROWS = [(key, Value([(1, 'city-%d' % (key % 3)), (2, 'same'), (5, 'k%d' % key)] if key % 4 else [(2, 'same')], 9))
+        for key in range(0, 2000, 2)]
+
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('columnar', [False, True])
+def test_blocks_unpack_to_what_was_packed(codec, columnar):
+    raw = encode_columns(ROWS) if columnar else b'row block ' * 100
+    stored = pack_block(raw, codec, columnar)
+    assert unpack_block(stored) == (columnar, raw)
+    if codec != 'none':
+        assert len(stored) < len(raw)
+
+    # a block compression does not make smaller is stored as it is
+    assert pack_block(b'x', codec, columnar) == bytes([0x10 if columnar else 0]) + b'x'
+
+
+def test_codes_are_run_length_encoded_only_when_smaller():
+    values = [b'a', b'b']
+    runs = encode_segment(values, [1] * 500 + [2] * 500)
+    plain = encode_segment(values, [1, 2] * 500)
+    # the kind of codes follows the dictionary: its size, the value lengths and the values
+    kind_at = 4 + 4 * 2 + 2
+    assert (runs[kind_at], plain[kind_at]) == (RLE_CODES, PLAIN_CODES)
+    assert struct.unpack_from('>I', runs, kind_at + 1) == (2,)
+    assert len(runs) < len(plain)
+
+
+def test_column_block_decodes_only_the_wanted_columns():
+    block = ColumnBlock(encode_columns(ROWS))
+    assert list(block.keys) == [key for key, _ in ROWS] and block.col_ids == (1, 2, 5)
+
+    assert block.get(6, {5}).cols == [(5, 'k6')]
+    assert set(block.columns) == {2}
+    # a row without the column, and a key not in the block
+    assert block.get(8, {5}).cols == [] and block.get(8, {5}).num_cols == 9
+    assert block.get(3) is None
+
+    model = dict(ROWS)
+    assert all(val.cols == model[key].cols for key, val in block.items())
+    assert [key for key, _ in block.items(100, 110)] == [100, 102, 104, 106, 108, 110]
+    assert {key: val.cols for key, val in block.get_many([6, 7, 10, 12], {1}).items()} == \
+        {6: [(1, 'city-0')], 10: [(1, 'city-1')], 12: []}
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_cached_blocks_still_honour_the_wanted_columns(tmp_path, columnar):
+    filename = str(tmp_path / 'data.log')
+    write_node_file(filename, ROWS, BloomFilter.build([key for key, _ in ROWS], 0.01), ColumnGroup(4), 0, 1998,
+                    'zlib', columnar)
+    meta = read_node_meta(filename)
+    meta.generation = 0
+    cache = BlockCache(1024 * 1024)
+    model = dict(ROWS)
+    for _ in range(2):
+        with open(filename, 'rb') as infile:
+            val = read_node_value(infile, meta, 42, cache, {5})
+            assert val.cols == ([(5, 'k42')] if columnar else model[42].cols)
+            found = read_node_values(infile, meta, [42, 43, 1000], cache, {1, 5})
+            assert sorted(found) == [42, 1000]
+            assert found[42].cols == (model[42].project({1, 5}).cols if columnar else model[42].cols)
+
+    assert cache.counters()['hits'] == 4
+    # a cached column block has decoded the segments of the columns read only
+    for block, nbytes in cache.blocks.values():
+        if columnar:
+            assert isinstance(block, ColumnBlock) and set(block.columns) <= {0, 2}
+        assert nbytes == block.nbytes
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_node_files_take_their_pairs_in_key_order(tmp_path, columnar):
+    filename = str(tmp_path / 'data.log')
+    bloom = BloomFilter.build([key for key, _ in ROWS], 0.01)
+    # a generator is written as it comes, and counted
+    meta = write_node_file(filename, iter(ROWS), bloom, ColumnGroup(4), 0, 1998, 'none', columnar)
+    assert meta.num_keys == len(ROWS) and read_node_meta(filename).num_keys == len(ROWS)
+
+    with pytest.raises(ValueError):
+        write_node_file(filename, [ROWS[1], ROWS[0]], bloom, ColumnGroup(4), 0, 1998, 'none', columnar)
+    with pytest.raises(ValueError):
+        write_node_file(filename, [ROWS[0], ROWS[0]], bloom, ColumnGroup(4), 0, 1998, 'none', columnar)
+
+
+def test_node_files_of_another_version_are_not_read(tmp_path):
+    filename = str(tmp_path / 'data.log')
+    write_node_file(filename, ROWS, BloomFilter.build([key for key, _ in ROWS], 0.01), ColumnGroup(4), 0, 1998)
+    with open(filename, 'rb') as infile:
+        data = infile.read()
+    assert HEADER.unpack_from(data, 0)[:2] == (MAGIC, VERSION)
+
+    with open(filename, 'r+b') as outfile:
+        outfile.write(HEADER.pack(MAGIC, VERSION - 1, HEADER.unpack_from(data, 0)[2]))
+    for read in (read_node_meta, read_node_file):
+        with pytest.raises(ValueError, match='version %d node file' % (VERSION - 1)):
+            read(filename)
+
+    with open(filename, 'r+b') as outfile:
+        outfile.write(b'JUNK')
+    with pytest.raises(ValueError, match='not a node file'):
+        read_node_meta(filename)
+
+
+@pytest.mark.parametrize('compression', ['lzma', ['none', 'zlib', 'bz2']])
+def test_compressed_trees_read_back(tmp_path, compression):
+    lsm = LsmTree(600, 3, 4, str(tmp_path), 0.01, buffer_bytes=30000, compression=compression, cols_per_group=2)
+    model = dict()
+    rnd = random.Random(1)
+    for version in range(800):
+        key = rnd.randint(1, 599)
+        model[key] = Value([(1, 'v%d' % version), (2, 'k%d' % key), (3, 'c%d' % (key % 5))], 3)
+        lsm.write(key, model[key])
+    lsm.flush()
+    for key in range(600):
+        val = lsm.read(key, key, [2, 3])
+        assert (None if val is None else val.cols) == (model[key].project({2, 3}).cols if key in model else None)
+    assert [(key, val.cols) for key, val in lsm.scan(0, 600)] == [(key, model[key].cols) for key in sorted(model)]
+    lsm.close()
+
+    with pytest.raises(ValueError):
+        LsmTree(600, 3, 4, str(tmp_path / 'other'), 0.01, compression='snappy')
@@ -1,7 +1,28 @@
 import math
+import struct
 import mmh3
-import pickle
-from bitarray import bitarray
+
+try:
+    import numpy as np
+except ImportError:  # check_many falls back to one check per key
+    np = None
+
+# bits per block: one 64 bytes cache line, so every probe of a key lands in the same cache line
+BLOCK_BITS = 512
+BLOCK_BYTES = BLOCK_BITS // 8
+
+# serialized header: number of blocks, number of hash functions, number of items, false positive probability
+HEADER = struct.Struct('>IHId')
+
+# probe i of a key lands on bit h2 + i * step + i * (i - 1) / 2 * bend + (i^3 - i) / 6 of its block (step and bend
+# being more bits of its hash). With only the first two terms (double hashing) two keys of a block with the same step
+# and nearby starts share most of their probes, and there are only BLOCK_BITS * BLOCK_BITS / 2 such pairs, which lets
+# through several times more false positives than the share of bits set predicts once the filter is below 1%
+TRIANGLE = [i * (i - 1) // 2 for i in range(BLOCK_BITS)]
+TWIST = [(i ** 3 - i) // 6 for i in range(BLOCK_BITS)]
+
+KEY = struct.Struct('>q')
+MASK_64 = (1 << 64) - 1
 
 
 class BloomFilter(object):
@@ -15,46 +36,130 @@ class BloomFilter(object):
         # False posible probability in decimal
         self.fp_prob = fp_prob
 
-        # Size of bit array to use
-        self.size = self.get_size(items_count, fp_prob)
+        # number of items the filter is sized for
+        self.items_count = items_count
+
+        # Size of bit array to use, rounded up to whole blocks
+        bits_needed = self.get_size(items_count, fp_prob)
+        self.num_blocks = max(1, math.ceil(bits_needed / BLOCK_BITS))
+        self.size = self.num_blocks * BLOCK_BITS
+
+        # number of hash functions to use (the rounding up only lowers the FP rate, it does not call for more probes)
+        self.hash_count = self.get_hash_count(bits_needed, items_count)
 
-        # number of hash functions to use
-        self.hash_count = self.get_hash_count(self.size, items_count)
+        # the bits, all 0 to begin with
+        self.bit_array = bytearray(self.num_blocks * BLOCK_BYTES)
 
-        # Bit array of given size
-        self.bit_array = bitarray(self.size)
+    @classmethod
+    def build(cls, keys, fp_prob):
+        """
+        Builds a filter sized for exactly the given keys
+        """
+        bloom = cls(len(keys), fp_prob)
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    @staticmethod
+    def hash_item(item):
+        """
+        One 128 bits murmur hash per item, split in two 64 bits halves for double hashing.
+        Integer keys are hashed on their 8 bytes encoding, anything else on its string form.
+        """
+        if isinstance(item, int):
+            data = KEY.pack(item)
+        else:
+            data = str(item).encode()
+        digest = mmh3.hash128(data, seed=0, x64arch=True, signed=False)
+        return digest & MASK_64, digest >> 64
 
-        # initialize all bits as 0
-        self.bit_array.setall(0)
+    def probes(self, item):
+        """
+        The block and the hash_count bit positions inside that block for an item
+        """
+        h1, h2 = self.hash_item(item)
+        block = h1 % self.num_blocks
+        step = (h2 >> 32) | 1
+        bend = h1 >> 32
+        return block, [(h2 + i * step + TRIANGLE[i] * bend + TWIST[i]) % BLOCK_BITS for i in range(self.hash_count)]
 
     def add(self, item):
         """
         Add an item in the filter
         """
-        for i in range(self.hash_count):
-            # create digest for given item.
-            # i works as seed to mmh3.hash() function
-            # With different seeds, digest created is different
-            digest = mmh3.hash(item, i) % self.size
-
-            # set the bit True in bit_array
-            self.bit_array[digest] = True
+        block, bits = self.probes(item)
+        base = block * BLOCK_BYTES
+        for bit in bits:
+            self.bit_array[base + (bit >> 3)] |= 1 << (bit & 7)
 
     def check(self, item):
         """
         Check for existence of an item in filter
         """
-        for i in range(self.hash_count):
-            digest = mmh3.hash(item, i) % self.size
-            if not self.bit_array[digest]:
+        block, bits = self.probes(item)
+        base = block * BLOCK_BYTES
+        for bit in bits:
+            if not self.bit_array[base + (bit >> 3)] & (1 << (bit & 7)):
                 # if any of bit is False then,its not present
                 # in filter
                 # else there is probability that it exist
                 return False
         return True
 
+    def check_many(self, items):
+        """
+        Checks a batch of items at once
+        :return: list of booleans, one per item
+        """
+        if np is None or not items:
+            return [self.check(item) for item in items]
+
+        hashes = np.array([self.hash_item(item) for item in items], dtype=np.uint64)
+        h1, h2 = hashes[:, 0], hashes[:, 1]
+        blocks = h1 % np.uint64(self.num_blocks)
+        steps = (h2 >> np.uint64(32)) | np.uint64(1)
+        bends = h1 >> np.uint64(32)
+        rounds = np.arange(self.hash_count, dtype=np.uint64)
+        triangle = np.array(TRIANGLE[:self.hash_count], dtype=np.uint64)
+        twist = np.array(TWIST[:self.hash_count], dtype=np.uint64)
+        # the sums wrap around 2^64, a multiple of BLOCK_BITS, so the bit positions come out as in probes
+        bits = (h2[:, None] + rounds[None, :] * steps[:, None] + triangle[None, :] * bends[:, None] +
+                twist[None, :]) % np.uint64(BLOCK_BITS)
+
+        bytes_view = np.frombuffer(self.bit_array, dtype=np.uint8)
+        byte_pos = blocks[:, None] * np.uint64(BLOCK_BYTES) + (bits >> np.uint64(3))
+        masks = (np.uint8(1) << (bits & np.uint64(7)).astype(np.uint8))
+        return ((bytes_view[byte_pos] & masks) != 0).all(axis=1).tolist()
+
+    def estimated_fp_rate(self):
+        """
+        The false positive rate the filter has now, from the share of bits set in every block: an item not in the
+        filter passes if all its probes hit set bits of its block
+        """
+        total = 0.0
+        for block in range(self.num_blocks):
+            base = block * BLOCK_BYTES
+            ones = int.from_bytes(self.bit_array[base:(base + BLOCK_BYTES)], 'big').bit_count()
+            total += (ones / BLOCK_BITS) ** self.hash_count
+        return total / self.num_blocks
+
     def clear(self):
-        self.bit_array.setall(0)
+        self.bit_array = bytearray(len(self.bit_array))
+
+    def to_bytes(self):
+        return HEADER.pack(self.num_blocks, self.hash_count, self.items_count, self.fp_prob) + bytes(self.bit_array)
+
+    @classmethod
+    def from_bytes(cls, data):
+        num_blocks, hash_count, items_count, fp_prob = HEADER.unpack_from(data, 0)
+        bloom = cls.__new__(cls)
+        bloom.fp_prob = fp_prob
+        bloom.items_count = items_count
+        bloom.num_blocks = num_blocks
+        bloom.size = num_blocks * BLOCK_BITS
+        bloom.hash_count = hash_count
+        bloom.bit_array = bytearray(data[HEADER.size:(HEADER.size + num_blocks * BLOCK_BYTES)])
+        return bloom
 
     def prepare_bloom_filter_to_write(self):
         """
@@ -62,7 +167,7 @@ class BloomFilter(object):
         ready to write to a file
         :return: bloom filter (with length) bytes
         """
-        bloom_binary = pickle.dumps(self)
+        bloom_binary = self.to_bytes()
         length = len(bloom_binary)
         len_bytes = length.to_bytes(4, 'big')
         bloom_binary_with_len = len_bytes + bloom_binary
@@ -76,9 +181,8 @@ class BloomFilter(object):
         :return: Bloom Filter object instance, length of bloom filter plus length
         """
         with open(filename, "rb") as infile:
-            indata = infile.read(1024)
-        length = int.from_bytes(indata[:4], 'big')
-        bloom = pickle.loads(indata[4:(4+length)])
+            length = int.from_bytes(infile.read(4), 'big')
+            bloom = BloomFilter.from_bytes(infile.read(length))
         return bloom, 4+length
 
     @classmethod
@@ -107,5 +211,7 @@ class BloomFilter(object):
         n : int
             number of items expected to be stored in filter
         """
+        if n == 0:
+            return 1
         k = (m / n) * math.log(2)
-        return int(k)
+        return max(1, int(k))
@@ -0,0 +1,77 @@
+import random
+import pytest
+import bloomfilter
+import metacache
+from bloomfilter import BloomFilter
+from lsmTree import LsmTree
+from value import Value
+
+KEYS = random.Random(1).sample(range(-10 ** 12, 10 ** 12), 5000)
+OTHERS = [key + 1 for key in KEYS]
+
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_check_many_agrees_with_check(monkeypatch, vectorized):
+    if not vectorized:
+        # without numpy every key is checked on its own
+        monkeypatch.setattr(bloomfilter, 'np', None)
+    bloom = BloomFilter.build(KEYS, 0.05)
+    probes = KEYS[:500] + OTHERS + ['text', 'keys']
+    assert bloom.check_many(probes) == [bloom.check(key) for key in probes]
+    assert all(bloom.check_many(KEYS))
+    assert bloom.check_many([]) == []
+
+
+def test_round_trip_through_bytes():
+    bloom = BloomFilter.build(KEYS, 0.01)
+    copy = BloomFilter.from_bytes(bloom.to_bytes())
+    assert (copy.num_blocks, copy.hash_count, copy.items_count, copy.fp_prob, copy.size) == \
+           (bloom.num_blocks, bloom.hash_count, bloom.items_count, bloom.fp_prob, bloom.size)
+    assert copy.bit_array == bloom.bit_array
+    assert copy.check_many(OTHERS) == bloom.check_many(OTHERS)
+
+    # the length prefixed form node files hold
+    data = bloom.prepare_bloom_filter_to_write()
+    assert int.from_bytes(data[:4], 'big') == len(data) - 4
+    assert BloomFilter.from_bytes(data[4:]).bit_array == bloom.bit_array
+
+
+@pytest.mark.parametrize('fp_prob', [0.1, 0.01, 0.001, 0.0001])
+def test_estimated_fp_rate_matches_the_measured_one(fp_prob):
+    bloom = BloomFilter.build(KEYS, fp_prob)
+    estimate = bloom.estimated_fp_rate()
+    absent = range(10 ** 13, 10 ** 13 + 200000)
+    measured = sum(bloom.check_many(list(absent))) / len(absent)
+    assert estimate == pytest.approx(measured, rel=0.2, abs=1e-4)
+    # sized for fp_prob, the blocks costing some on top of it the lower it is (Node.build_filter makes up for that)
+    assert estimate < 3 * fp_prob
+
+
+def test_empty_filter_lets_nothing_through():
+    bloom = BloomFilter.build([], 0.01)
+    assert bloom.estimated_fp_rate() == 0
+    assert not any(bloom.check_many(KEYS[:100]))
+
+
+def test_missing_keys_cost_no_file_io(tmp_path, monkeypatch):
+    lsm = LsmTree(2000, 3, 4, str(tmp_path), 0.01, buffer_bytes=8000)
+    for key in range(2, 2000, 2):
+        lsm.write(key, Value([(1, 'k%d' % key)], 1))
+    lsm.flush()
+
+    def counted(name):
+        return sum(counters[name] for counters in lsm.stats()['levels'])
+
+    # beyond the key fences of every node nothing is opened at all
+    def no_open(*args):
+        raise AssertionError('a node file was opened for ' + str(args))
+    monkeypatch.setattr(metacache, 'open', no_open, raising=False)
+    assert [lsm.read(key, key, 0) for key in (-5, 0, 1, 2001, 10 ** 9)] == [None] * 5
+    assert lsm.multi_get([-5, 2001, 10 ** 9]) == [None] * 3
+    assert counted('files_opened') == 0
+    monkeypatch.undo()
+
+    # within them, only the keys a bloom filter lets through open a file
+    assert all(lsm.read(key, key, 0) is None for key in range(3, 2000, 2))
+    assert counted('files_opened') == counted('bloom_false_positives') < 50
+    lsm.close()
@@ -1,20 +1,65 @@
-import pickle
+import struct
+
+# column group map: number of keys, number of children listed; per child: key range order, number of groups; per
+# group: number of columns, followed by the column ids
+MAP_HEADER = struct.Struct('>II')
+CHILD = struct.Struct('>IH')
+GROUP = struct.Struct('>H')
 
 
 class ColumnGroup(object):
     def __init__(self, num_keys):
         self.num_keys = num_keys
+
+        # child key range order -> the column ids of every column group of that child, group k at position k-1
         self.cg_map = dict()
 
     @staticmethod
     def get_column_groups_from_file(indata, start_len):
         cgmap_len = int.from_bytes(indata[start_len:(start_len + 4)], 'big')
-        cgmap = pickle.loads(indata[(start_len + 4):(start_len + 4 + cgmap_len)])
+        cgmap = ColumnGroup.decode(indata[(start_len + 4):(start_len + 4 + cgmap_len)])
 
         return cgmap, cgmap_len
 
+    @staticmethod
+    def split_columns(col_ids, width):
+        """
+        Cuts a list of column ids into column groups of (at most) width columns each
+        """
+        return [col_ids[i:(i + width)] for i in range(0, len(col_ids), width)]
+
+    def set_child_groups(self, key_range_order, groups):
+        self.cg_map[key_range_order] = [list(group_cols) for group_cols in groups]
+
+    def encode(self):
+        out = bytearray(MAP_HEADER.pack(self.num_keys, len(self.cg_map)))
+        for key_range_order in sorted(self.cg_map):
+            groups = self.cg_map[key_range_order]
+            out += CHILD.pack(key_range_order, len(groups))
+            for group_cols in groups:
+                out += GROUP.pack(len(group_cols))
+                out += struct.pack('>%di' % len(group_cols), *group_cols)
+        return bytes(out)
+
+    @classmethod
+    def decode(cls, data):
+        num_keys, num_children = MAP_HEADER.unpack_from(data, 0)
+        cgmap = cls(num_keys)
+        pos = MAP_HEADER.size
+        for _ in range(num_children):
+            key_range_order, num_groups = CHILD.unpack_from(data, pos)
+            pos += CHILD.size
+            groups = []
+            for _ in range(num_groups):
+                (count,) = GROUP.unpack_from(data, pos)
+                pos += GROUP.size
+                groups.append(list(struct.unpack_from('>%di' % count, data, pos)))
+                pos += 4 * count
+            cgmap.cg_map[key_range_order] = groups
+        return cgmap
+
     def prepare_column_group_map_to_write(self):
-        cgmap_bytes = pickle.dumps(self)
+        cgmap_bytes = self.encode()
         cgmap_length = len(cgmap_bytes)
         cgmap_len_bytes = cgmap_length.to_bytes(4, 'big')
         cgmap_with_len = cgmap_len_bytes + cgmap_bytes
@@ -0,0 +1,104 @@
+from partition import key_count, wants_split
+
+'''
+ $$$$ Compaction policies:
+  How a node takes the keys its parent (or the memory buffer) pushes into it is chosen per level:
+   - leveled: the keys are merged into the node file, which is read and written again whole, and the node is pushed
+     down into its children once it holds storage_capacity keys. A node is one sorted run, so a read checks one file
+     per level, but the keys a node holds are written again every time keys are pushed into it.
+   - tiered: the keys are written as a new sorted run, a file of its own next to the node file ("run-<n>.log", with
+     its own bloom filter and block index), and nothing on disk is read or written again. Once the node has tier_runs
+     sorted runs (a node file holding keys counting as one) or they hold storage_capacity keys together, they are
+     merged into the node file, which from there goes on like a leveled node: pushed down once full, or split. A read
+     checks the runs newest first and then the node file, so it may check up to tier_runs files of the node, while the
+     keys it holds are written again about tier_runs times less often.
+  The last level is always leveled, it is where column groups are regrouped and tombstones dropped. Any other rewrite
+  of a whole node (a merge of two children, a split, a bloom filter rebuild) merges its runs as well, so a node opened
+  with the leveled policy after the tiered one merges the runs it has on the next keys pushed into it.
+'''
+
+POLICIES = ('leveled', 'tiered')
+
+
+class LeveledPolicy(object):
+    """
+    Merges the keys pushed into a node into its file
+    """
+    name = 'leveled'
+
+    def receive(self, parent, node, pairs, split):
+        """
+        Puts the key/value pairs into the node and writes it, pushing it down (or splitting it) once it is full
+        :param parent: the node (or memory buffer) the pairs come from
+        :param pairs: iterable of (key, value) in key order
+        :param split: function splitting the node if it wants to be (see partition.split_if_wanted), returns the new
+                      node or None
+        :return: the node split off, None if the node was not split
+        """
+        # the pairs come sorted, and so do the node's files: they are merged on the way in, never sorted again
+        for key, value in node.merged_with_files(pairs):
+            node.put(key, value)
+
+            if len(node.workspace) >= node.storage_capacity and not wants_split(parent, node):
+                node.compaction_f2f()
+
+        # a node hotter than its siblings is split instead of pushed down (see partition.py)
+        piece = split()
+        if len(node.workspace) >= node.storage_capacity:
+            node.compaction_f2f()
+
+        node.write_to_file()
+        return piece
+
+
+class TieredPolicy(object):
+    """
+    Writes the keys pushed into a node as a new sorted run, merging the runs once there are tier_runs of them
+    """
+    name = 'tiered'
+
+    def __init__(self, tier_runs):
+        # number of sorted runs a node has before they are merged
+        self.tier_runs = tier_runs
+
+    def receive(self, parent, node, pairs, split):
+        """
+        See LeveledPolicy.receive
+        """
+        node.write_run(pairs)
+        if stored_runs(node) < self.tier_runs and key_count(node) < node.storage_capacity:
+            return None
+
+        # every run goes into the node file, which then is a leveled node's
+        node.read_whole_file()
+        node.stats.count(node.level, run_merges=1)
+        piece = split()
+        if len(node.workspace) >= node.storage_capacity:
+            node.compaction_f2f()
+
+        node.write_to_file()
+        return piece
+
+
+def stored_runs(node):
+    """
+    :return: number of sorted runs of the node holding keys, its node file included, without reading any data block
+    """
+    meta = node.meta_cache.lookup_file(node.get_file_name())
+    return len(node.runs) + int(meta is not None and meta.num_keys > 0)
+
+
+def make_policies(compaction, levels, tier_runs):
+    """
+    :param compaction: one of POLICIES for every level but the last, or a list with one per level
+    :param tier_runs: number of sorted runs a tiered node has before they are merged
+    :return: the policy of every level
+    """
+    names = [compaction] * (levels - 1) + ['leveled'] if isinstance(compaction, str) else list(compaction)
+    if len(names) != levels or any(name not in POLICIES for name in names):
+        raise ValueError('compaction takes one of ' + str(POLICIES) + ' or a list of them, one per level')
+    if names[-1] != 'leveled':
+        raise ValueError('the last level is always leveled')
+    if tier_runs < 2:
+        raise ValueError('tier_runs takes at least 2')
+    return [TieredPolicy(tier_runs) if name == 'tiered' else LeveledPolicy() for name in names]
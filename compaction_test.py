@@ -0,0 +1,100 @@
+import os
+import pytest
+import compactor
+import node
+from compaction import LeveledPolicy, TieredPolicy, make_policies
+from lsmTree import LsmTree
+
+N = 4000
+
+
+def test_make_policies():
+    assert [policy.name for policy in make_policies('tiered', 3, 4)] == ['tiered', 'tiered', 'leveled']
+    assert [type(policy) for policy in make_policies(['leveled', 'tiered', 'leveled'], 3, 2)] == \
+        [LeveledPolicy, TieredPolicy, LeveledPolicy]
+    assert make_policies('tiered', 3, 5)[0].tier_runs == 5
+
+    for compaction, levels, tier_runs in ((['tiered', 'tiered'], 2, 4), ('tiered', 3, 1), ('size', 3, 4),
+                                          (['tiered', 'leveled'], 3, 4)):
+        with pytest.raises(ValueError):
+            make_policies(compaction, levels, tier_runs)
+
+
+def test_tiered_levels_write_runs_and_merge_them(tmp_path, load_model, check_model):
+    written = dict()
+    for compaction in ('leveled', 'tiered'):
+        path = tmp_path / compaction
+        lsm = LsmTree(N, 3, 4, str(path), 0.01, buffer_bytes=6000, compaction=compaction, tier_runs=4)
+        model = load_model(lsm, dict(), N, 1500)
+        lsm.flush()
+        check_model(lsm, model, N, step=3)
+
+        levels = lsm.stats()['levels']
+        assert [counters['policy'] for counters in levels] == [compaction] * 2 + ['leveled']
+        written[compaction] = sum(counters['compaction_bytes_written'] for counters in levels)
+        if compaction == 'leveled':
+            assert all(counters['runs_written'] == counters['run_merges'] == 0 for counters in levels)
+            lsm.close()
+            continue
+
+        assert levels[0]['runs_written'] > 0 and levels[0]['run_merges'] > 0
+        assert levels[2]['runs_written'] == 0 and levels[2]['runs'] == 0
+        runs = sum(counters['runs'] for counters in levels)
+        assert runs > 0
+        lsm.close()
+
+        # the runs are in the manifest
+        lsm = LsmTree.open(str(path), buffer_bytes=6000, compaction=compaction, tier_runs=4)
+        assert sum(counters['runs'] for counters in lsm.stats()['levels']) == runs
+        check_model(lsm, model, N, step=3)
+        lsm.close()
+
+        # opened leveled, a node merges its runs on the next keys pushed into it
+        lsm = LsmTree.open(str(path), buffer_bytes=6000)
+        load_model(lsm, model, N, 1500, seed=2)
+        lsm.flush()
+        check_model(lsm, model, N, step=3)
+        assert sum(counters['runs'] for counters in lsm.stats()['levels']) < runs
+        lsm.close()
+
+    # the keys of a tiered level are written again less often
+    assert written['tiered'] < written['leveled']
+
+
+def test_a_flush_leaves_the_nodes_it_does_not_reach_alone(tmp_path, monkeypatch, make_value):
+    lsm = LsmTree(1000, 3, 4, str(tmp_path), 0.01, buffer_bytes=8000)
+    for key in range(1, 1000):
+        lsm.write(key, make_value(key, 0))
+    lsm.flush()
+
+    def files(tree):
+        return {nd.get_file_name(cg): nd for nd in tree.walk_nodes(tree.root.children)
+                for cg in range(1, len(nd.column_groups) + 2) if os.path.exists(nd.get_file_name(cg))}
+    def stamp(name):
+        info = os.stat(name)
+        return info.st_ino, info.st_mtime_ns
+    before = {name: stamp(name) for name in files(lsm)}
+
+    opened = []
+    read_node_file, read_group_files = node.read_node_file, compactor.read_group_files
+    monkeypatch.setattr(node, 'read_node_file', lambda name: opened.append(name) or read_node_file(name))
+    monkeypatch.setattr(compactor, 'read_group_files', lambda names: opened.extend(names) or read_group_files(names))
+
+    # more keys than a level 0 node holds, all of them in one level 0 range and a few of the ranges below it
+    for key in range(1, 25):
+        lsm.write(key, make_value(key, 1))
+    lsm.flush()
+    assert lsm.stats()['levels'][1]['compactions'] > 0
+
+    # a node file is replaced whole, under a new inode
+    changed = set(name for name in before if stamp(name) != before[name])
+    assert len(changed) > 3 and set(opened) <= set(before)
+    for name, nd in files(lsm).items():
+        if nd.key_high_bound < 1 or nd.key_low_bound > 24:
+            assert name not in changed and name not in opened, name
+    # the level 0 nodes of the other ranges, and everything below them, were not touched at all
+    untouched = os.path.join(str(tmp_path), 'lv-0.kr-2.cg-1')
+    assert not [name for name in changed | set(opened) if name.startswith(untouched)]
+    assert [lsm.read(key, key, 0).cols for key in (1, 24, 25, 999)] == \
+        [make_value(1, 1).cols, make_value(24, 1).cols, make_value(25, 0).cols, make_value(999, 0).cols]
+    lsm.close()
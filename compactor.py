@@ -0,0 +1,167 @@
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from nodefile import pack_records, read_group_files, unpack_records, write_group_files
+
+'''
+ $$$$ Parallel compaction:
+  Level 0 nodes never share keys, so a flush pushes the keys of every level 0 node it reaches down that node's subtree
+  independently of the others. With more than one compaction worker the compactor thread hands every subtree to a
+  thread pool (see run_all) and waits for all of them before the flush is done. A subtree is only ever written by the
+  job it was handed to, and node files are still replaced whole (written under a temporary name, then swapped in), so
+  reads of a subtree being compacted see either the old or the new file. Splits and merges of level 0 nodes change the
+  memory buffer's boundary table, shared by all jobs, and are made one at a time under MemBuf.layout_lock.
+
+  Merging keys and encoding blocks is pure Python and holds the GIL, so threads alone mostly overlap the file I/O (and
+  compression, which releases it). With the 'process' pool, the last level column group files, most of the work, are
+  encoded and decoded in worker processes (see CodecPool), so the jobs use as many cores as there are workers. The
+  row files of the upper levels are encoded by the compacting threads: handing their rows to a process costs about as
+  much as encoding them. Worker processes are started with the 'spawn' method, so a program using them has to guard
+  its entry point with if __name__ == '__main__'.
+'''
+
+
+class Compactor(object):
+    """
+    Background worker that flushes frozen memory buffers into level 0, oldest first, so writes never wait for
+    compaction_m2f to finish. Other rewrites of node files (see submit_task) run on it as well, so only this thread
+    and the subtree jobs of the flush it is waiting for ever write them.
+    """
+    def __init__(self, membuf, workers=1):
+        self.membuf = membuf
+
+        # the subtree compactions of a flush run on this pool, None when they run one after the other on the worker
+        self.subtrees = ThreadPoolExecutor(workers, thread_name_prefix='declstore-subtree') if workers > 1 else None
+
+        # frozen buffers waiting to be flushed and tasks waiting to run, in the order they were submitted
+        self.pending = queue.Queue()
+
+        # the first exception a flush raised, reported back to the writer
+        self.error = None
+
+        self.worker = threading.Thread(target=self.run, name='declstore-compactor', daemon=True)
+        self.worker.start()
+
+    def submit(self, frozen):
+        self.check()
+        self.pending.put(frozen)
+
+    def submit_task(self, task):
+        """
+        :param task: function called with no arguments on the worker thread
+        """
+        self.pending.put(task)
+
+    def run(self):
+        while True:
+            frozen = self.pending.get()
+            if frozen is None:
+                self.pending.task_done()
+                return
+            try:
+                if self.error is None:
+                    if callable(frozen):
+                        frozen()
+                    else:
+                        self.membuf.compaction_m2f(frozen)
+                        self.membuf.retire(frozen)
+            except Exception as e:
+                # the frozen buffer stays visible to reads, nothing was lost
+                self.error = e
+            finally:
+                self.pending.task_done()
+
+    def run_all(self, jobs):
+        """
+        Calls every job, on the subtree pool if there is one, and returns once all of them are done
+        :param jobs: functions called with no arguments
+        """
+        if self.subtrees is None:
+            for job in jobs:
+                job()
+            return
+
+        futures = [self.subtrees.submit(job) for job in jobs]
+        # every job is waited for before the first error is raised, so none is still writing afterwards
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def wait(self):
+        """
+        Blocks until every submitted buffer has been flushed
+        """
+        self.pending.join()
+        self.check()
+
+    def stop(self):
+        self.pending.put(None)
+        self.worker.join()
+        if self.subtrees is not None:
+            self.subtrees.shutdown()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError('background compaction failed') from self.error
+
+
+class CodecPool(object):
+    """
+    Encodes and decodes the column group files of last level nodes, the bulk of the work of a compaction (projecting
+    every row into every group, dictionary encoding the columns, stitching the rows back together), in worker
+    processes when there are any. A worker writes the files under their temporary names and returns their NodeMeta,
+    which the compaction installs as if it had written them itself. Workspaces cross over packed into flat arrays (see
+    nodefile.pack_records).
+    """
+    def __init__(self, workers=0):
+        # None when the calling thread does the work itself
+        self.executor = None
+        if workers:
+            self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def write_groups(self, filenames, workspace, layout, bloom_ftr, cg_metadata, key_min, key_max, codec):
+        """
+        :return: list of the NodeMeta of every file (see nodefile.write_group_files)
+        """
+        if self.executor is None:
+            return write_group_files(filenames, workspace, layout, bloom_ftr, cg_metadata, key_min, key_max, codec)
+        metas = self.executor.submit(write_packed_groups, filenames, pack_records(workspace), layout, bloom_ftr,
+                                     cg_metadata, key_min, key_max, codec).result()
+        # all files share the caller's bloom filter, as when written in process
+        for meta in metas:
+            meta.bloom_ftr = bloom_ftr
+        return metas
+
+    def read_groups(self, filenames):
+        """
+        :return: NodeMeta of the first file, list of the column ids of every group, dict of all key/value pairs (see
+                 nodefile.read_group_files)
+        """
+        if self.executor is None:
+            return read_group_files(filenames)
+        meta, layout, packed = self.executor.submit(read_packed_groups, filenames).result()
+        return meta, layout, unpack_records(packed)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+# run in the worker processes
+def write_packed_groups(filenames, packed, *args):
+    metas = write_group_files(filenames, unpack_records(packed), *args)
+    # the caller has the bloom filter already
+    for meta in metas:
+        meta.bloom_ftr = None
+    return metas
+
+
+def read_packed_groups(filenames):
+    meta, layout, workspace = read_group_files(filenames)
+    # only the key fences are wanted
+    if meta is not None:
+        meta.bloom_ftr = None
+    return meta, layout, pack_records(workspace)
@@ -0,0 +1,104 @@
+import threading
+import pytest
+from bloomfilter import BloomFilter
+from columngroup import ColumnGroup
+from compactor import CodecPool
+from lsmTree import LsmTree
+from membuf import MemBuf
+
+N = 800
+
+
+def test_worker_processes_write_and_read_the_files_the_caller_would(tmp_path, make_value):
+    workspace = {key: make_value(key, 0) for key in range(1, 300, 3)}
+    bloom_ftr = BloomFilter.build(list(workspace), 0.01)
+    layout = [[1], [2, 3, 4]]
+    local, pool = CodecPool(), CodecPool(2)
+    try:
+        for name, codecs in (('local', local), ('pool', pool)):
+            filenames = [str(tmp_path / ('%s.cg-%d' % (name, group))) for group in (1, 2)]
+            metas = codecs.write_groups(filenames, workspace, layout, bloom_ftr, ColumnGroup(4), 1, 298, 'zlib')
+            assert len(metas) == 2 and all(meta.bloom_ftr is bloom_ftr for meta in metas)
+            assert [meta.num_keys for meta in metas] == [len(workspace)] * 2
+
+            meta, read_layout, rows = codecs.read_groups(filenames)
+            assert (meta.key_min, meta.key_max) == (1, 298) and read_layout == layout
+            assert {key: val.cols for key, val in rows.items()} == {key: val.cols for key, val in workspace.items()}
+        assert [open(str(tmp_path / ('local.cg-%d' % group)), 'rb').read() for group in (1, 2)] == \
+            [open(str(tmp_path / ('pool.cg-%d' % group)), 'rb').read() for group in (1, 2)]
+    finally:
+        local.close()
+        pool.close()
+
+
+@pytest.mark.parametrize('options', [dict(compaction_workers=2),
+                                     dict(compaction_workers=2, compaction_pool='process')])
+def test_parallel_compactions_keep_every_key(tmp_path, options, load_model):
+    lsm = LsmTree(N, 3, 4, str(tmp_path), 0.01, buffer_bytes=8000, cols_per_group=2, **options)
+    # the last level files are written by worker processes with the 'process' pool only
+    assert (lsm.codec_pool.executor is not None) == (options.get('compaction_pool') == 'process')
+    model = load_model(lsm, dict(), N, 1500, deletes=0)
+    lsm.flush()
+    assert lsm.stats()['levels'][2]['keys'] > 0
+
+    def check(tree):
+        for key in range(0, N, 3):
+            val = tree.read(key, key, [2, 3])
+            assert (None if val is None else val.cols) == (model[key].project({2, 3}).cols if key in model else None)
+        assert [(key, val.cols) for key, val in tree.scan(0, N)] == [(key, model[key].cols) for key in sorted(model)]
+    check(lsm)
+    lsm.close()
+
+    lsm = LsmTree.open(str(tmp_path), buffer_bytes=8000, **options)
+    check(lsm)
+    lsm.close()
+
+    with pytest.raises(ValueError):
+        LsmTree(N, 3, 4, str(tmp_path / 'other'), 0.01, compaction_pool='fork')
+
+
+def test_writes_do_not_wait_for_the_flush_until_the_queue_is_full(tmp_path, monkeypatch, make_value):
+    release, flushing = threading.Event(), threading.Event()
+    compaction_m2f = MemBuf.compaction_m2f
+
+    def stalled(membuf, frozen):
+        flushing.set()
+        assert release.wait(30)
+        compaction_m2f(membuf, frozen)
+    monkeypatch.setattr(MemBuf, 'compaction_m2f', stalled)
+
+    lsm = LsmTree(N, 2, 4, str(tmp_path), 0.01, buffer_bytes=3000, max_immutables=2)
+    model = dict()
+
+    def write(key):
+        model[key] = make_value(key, 0)
+        lsm.write(key, model[key])
+
+    # a write that fills the buffer returns while its flush is stuck
+    key = 1
+    while not lsm.root.immutables:
+        write(key)
+        key += 1
+    assert flushing.wait(30)
+    per_buffer = key - 1
+    while len(lsm.root.immutables) < 2:
+        write(key)
+        key += 1
+
+    # the frozen buffers are read until they are retired
+    assert [lsm.read(k, k, 0).cols for k in model] == [val.cols for val in model.values()]
+    assert [k for k, _ in lsm.scan(0, N)] == sorted(model)
+
+    # with max_immutables buffers queued the write that fills the next one blocks, until a flush retires one
+    writer = threading.Thread(target=lambda: [write(k) for k in range(key, key + 2 * per_buffer)])
+    writer.start()
+    writer.join(1)
+    assert writer.is_alive() and len(lsm.root.immutables) == 2
+    release.set()
+    writer.join(30)
+    assert not writer.is_alive()
+
+    lsm.flush()
+    assert not lsm.root.immutables
+    assert [val.cols for val in lsm.multi_get(list(model))] == [val.cols for val in model.values()]
+    lsm.close()
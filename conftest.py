@@ -0,0 +1,65 @@
+import os
+import random
+import sys
+import pytest
+
+# the modules import each other by their plain names, also when pytest imports the tests as part of a package
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from value import Value
+
+
+def value_of(key, version):
+    """
+    The value the tests write: its version, the key (zero padded, so it sorts like the key), a column of a few values
+    and a column every third key does not have
+    """
+    cols = [(1, 'v%d' % version), (2, '%06d' % key), (3, 'c%d' % (key % 7))]
+    if key % 3:
+        cols.append((4, 'x' * (key % 5)))
+    return Value(cols, 4)
+
+
+def random_load(lsm, model, keys, writes, seed=1, deletes=0.1):
+    """
+    Writes and deletes random keys within [1, keys), doing the same to the model, a dict of the values the tree holds
+    :param writes: number of writes and deletes, the version of a value being its position among them
+    :param deletes: share of the deletes
+    """
+    rnd = random.Random(seed)
+    for version in range(writes):
+        key = rnd.randint(1, keys - 1)
+        if rnd.random() < deletes:
+            lsm.delete(key)
+            model.pop(key, None)
+        else:
+            model[key] = value_of(key, version)
+            lsm.write(key, model[key])
+    return model
+
+
+def check_against(lsm, model, keys, step=1):
+    """
+    Reads every step-th key up to keys + 1, multi_gets and scans every key up to keys, expecting what the model has
+    """
+    for key in range(0, keys + 2, step):
+        val = lsm.read(key, key, 0)
+        assert (None if val is None else val.cols) == (model[key].cols if key in model else None), key
+    assert [None if val is None else val.cols for val in lsm.multi_get(range(keys))] == \
+           [model[key].cols if key in model else None for key in range(keys)]
+    assert [(key, val.cols) for key, val in lsm.scan(0, keys)] == [(key, model[key].cols) for key in sorted(model)]
+
+
+@pytest.fixture
+def make_value():
+    return value_of
+
+
+@pytest.fixture
+def load_model():
+    return random_load
+
+
+@pytest.fixture
+def check_model():
+    return check_against
@@ -0,0 +1,41 @@
+import pytest
+from lsmTree import LsmTree
+
+N = 600
+
+
+@pytest.mark.parametrize('options', [dict(), dict(cols_per_group=2), dict(compaction='tiered', tier_runs=2)])
+def test_deletes_hide_every_older_version(tmp_path, options, load_model, check_model):
+    lsm = LsmTree(N, 3, 4, str(tmp_path), 0.01, buffer_bytes=8000, **options)
+    model = load_model(lsm, dict(), N, 1200, deletes=0.15)
+    assert lsm.delete_range(100, 160) == len([key for key in model if 100 <= key <= 160])
+    for key in range(100, 161):
+        model.pop(key, None)
+    # the tombstones still in the memory buffer
+    check_model(lsm, model, N)
+
+    # on disk, pushed down to the last level where the keys are dropped
+    lsm.flush()
+    check_model(lsm, model, N)
+    assert lsm.delete_range(100, 160) == 0
+    lsm.close()
+
+
+def test_a_range_read_sees_the_deletes_in_the_buffer(tmp_path, make_value):
+    lsm = LsmTree(N, 2, 4, str(tmp_path), 0.01, buffer_bytes=4000)
+    for key in range(1, 20):
+        lsm.write(key, make_value(key, 0))
+    lsm.flush()
+
+    # a read looks rkeyLow up, whatever rkeyHigh is, the newest version being the one in the buffer
+    lsm.delete(6)
+    lsm.write(7, make_value(7, 1))
+    assert lsm.read(6, 9, 0) is None
+    assert lsm.read(7, 9, 0).cols == make_value(7, 1).cols
+    assert lsm.read(8, 9, 0).cols == make_value(8, 0).cols
+
+    with lsm.snapshot() as snapshot:
+        lsm.write(6, make_value(6, 2))
+        assert lsm.read(6, 9, 0, snapshot) is None
+        assert lsm.read(6, 9, 0).cols == make_value(6, 2).cols
+    lsm.close()
@@ -1,7 +1,22 @@
+import functools
 import math
+import shutil
+import threading
+import time
+from compaction import make_policies
+from compactor import CodecPool
 from membuf import MemBuf
+from manifest import Manifest
+from metacache import MetaCache
 from node import Node
+from blockcodec import CODECS
+from partition import KeyRanges
 from pathlib import Path
+from stats import TreeStats
+from value import KEYS_ONLY, Value
+from wal import WriteAheadLog
+from workload import WorkloadMonitor
+from zonemap import compile_predicates, matches, predicate_columns
 
 '''
                                  ----- Design of the LSM Tree -----
@@ -34,12 +49,18 @@ from pathlib import Path
   5. The compaction from every level including the memory buffer to its children level is triggered when the node is
      full, while a receiving child node could in turn become full during the compaction and start a downward compaction 
      to the child node's children.
+  6. How a node takes the keys pushed into it is the compaction policy of its level: merged into its file (leveled, the
+     default) or written as a sorted run of their own, the runs being merged once there are tier_runs of them (tiered,
+     fewer rewrites for more files a read checks). See compaction.py.
 
 '''
 
 
 class LsmTree:
-    def __init__(self, items, levels, fan_out, file_root, fp_prob):
+    def __init__(self, items, levels, fan_out, file_root, fp_prob, max_immutables=2, cols_per_group=1,
+                 regroup_cost_factor=1.0, wal_sync='group', wal_group_records=128, wal_group_ms=0,
+                 block_cache_bytes=8 * 1024 * 1024, compression='none', compaction_workers=1,
+                 compaction_pool='thread', buffer_bytes=1024 * 1024, compaction='leveled', tier_runs=4):
         # number of levels is log[num_cols], starting at level 0 and thus +1
         self.levels = levels
 
@@ -52,32 +73,377 @@ class LsmTree:
         # fan out rate
         self.fan_out = fan_out
 
+        # number of columns per column group when the last level first stores a column
+        self.cols_per_group = cols_per_group
+
+        # block compression codec of every level, given once for all levels or as a list with one per level
+        self.compression = [compression] * levels if isinstance(compression, str) else list(compression)
+        if len(self.compression) != levels or any(codec not in CODECS for codec in self.compression):
+            raise ValueError('compression takes one of ' + str(CODECS) + ' or a list of them, one per level')
+
+        # compaction policy of every level, given once for all levels but the last (which is always leveled) or as a
+        # list with one per level, and the number of sorted runs a tiered node has before they are merged (see
+        # compaction.py)
+        self.policies = make_policies(compaction, levels, tier_runs)
+
+        # how many level 0 subtrees a flush compacts at a time, and whether the node files are encoded and decoded by
+        # the compacting threads ('thread') or in as many worker processes ('process'), see compactor.py
+        if compaction_pool not in ('thread', 'process'):
+            raise ValueError("compaction_pool takes 'thread' or 'process'")
+        self.compaction_workers = compaction_workers
+        self.codec_pool = CodecPool(compaction_workers if compaction_pool == 'process' else 0)
+
         # per node data capacity
         self.node_storage_capacity = math.ceil(items / pow(self.fan_out, self.levels))
 
+        # bytes of writes the memory buffer holds before it is flushed (see sortedbuf.py)
+        self.buffer_bytes = buffer_bytes
+
+        # counters of what every level does
+        self.stats_counters = TreeStats(levels)
+
+        # in-memory bloom filters and key fences of every node, and the decoded blocks of hot reads. Files snapshots
+        # still read are kept in snapshot-files, which no snapshot outlives the tree (so leftovers of a crash go)
+        shutil.rmtree(file_root + '/snapshot-files', ignore_errors=True)
+        self.meta_cache = MetaCache(block_cache_bytes, file_root + '/snapshot-files')
+
+        # which columns the reads of every last level node want, driving the column cracking
+        self.workload = WorkloadMonitor(regroup_cost_factor)
+
+        # the configuration recorded in the manifest, a tree can only be opened with the one it was made with
+        self.config = {'items': items, 'levels': levels, 'fan_out': fan_out, 'fp_prob': fp_prob,
+                       'cols_per_group': cols_per_group}
+
+        # write-ahead log of the writes still in memory
+        Path(file_root).mkdir(parents=True, exist_ok=True)
+        self.manifest = Manifest(file_root)
+        state = self.manifest.load() if self.manifest.exists() else None
+        if state is not None and state['config'] != self.config:
+            raise ValueError(file_root + ' holds a tree configured as ' + str(state['config']))
+        self.wal = WriteAheadLog(file_root, wal_sync, wal_group_records, wal_group_ms)
+
+        # the subtree compactions of a flush record their changes in the manifest too, one at a time
+        self.checkpoint_lock = threading.Lock()
+
         # root node
-        self.root = self.build_tree(items, file_root, fp_prob)
+        self.root = self.build_tree(items, file_root, fp_prob, max_immutables)
+        if state is not None:
+            self.restore(state['ranges'], state['nodes'])
+        self.meta_cache.on_layout_change = self.record_layout
+        self.meta_cache.on_stale_filter = self.rebuild_filter
+
+        # the edit log of the earlier run is folded into a new manifest
+        self.manifest.record(self.config, self.root.ranges.state())
+        self.stats_counters.count(None, manifest_bytes=self.manifest.rewrite())
+
+        self.recover()
+
+    @classmethod
+    def open(cls, file_root, **options):
+        """
+        Opens the tree stored at file_root with the configuration recorded in its manifest
+        :param options: the run time options of __init__ (max_immutables, regroup_cost_factor, wal_sync, ...)
+        """
+        config = Manifest(file_root).load()['config']
+        return cls(config['items'], config['levels'], config['fan_out'], file_root, config['fp_prob'],
+                   cols_per_group=config['cols_per_group'], **options)
+
+    def build_tree(self, items, file_root, fp_prob, max_immutables):
+        # level 0 nodes are only made when a flush first reaches them, see make_level_0_node
+        self.file_root = file_root
+        self.fp_prob = fp_prob
+        self.level_0_cap = math.ceil(items/self.fan_out)
+
+        ranges = KeyRanges.even(1, self.level_0_cap * self.fan_out, self.fan_out)
+        return MemBuf(self.buffer_bytes, self.level_0_cap, ranges, self.make_level_0_node, self.checkpoint,
+                      max_immutables, self.wal, self.stats_counters, self.meta_cache, self.compaction_workers)
+
+    def make_level_0_node(self, child, child_range_low_bound, child_range_high_bound):
+        filepath = self.file_root + '/lv-0.kr-' + str(child + 1) + '.cg-1'
+        return Node(child_range_low_bound, child_range_high_bound, self.levels,
+                    self.node_storage_capacity, 0, child + 1, 1, self.fan_out, filepath, self.fp_prob,
+                    self.meta_cache, self.cols_per_group, self.workload, self.stats_counters, self.compression,
+                    self.codec_pool, self.policies)
+
+    def restore(self, ranges, nodes):
+        """
+        Makes the nodes listed in the manifest, their files being read only when a read first needs them
+        :param ranges: the state of the level 0 boundary table
+        """
+        self.root.ranges = KeyRanges.from_state(ranges)
+        for entry in nodes:
+            # a crash can leave a node listed that a split had not yet put into its parent's boundary table, its keys
+            # are still in the node it was split from
+            node = self.root
+            for order in entry['orders']:
+                node = node.get_child(order - 1) if node.ranges.range_of(order - 1) is not None else None
+                if node is None:
+                    break
+            if node is None:
+                self.manifest.forget(entry['orders'])
+                continue
+
+            node.ranges = KeyRanges.from_state(entry['ranges'])
+            node.column_groups = entry['column_groups']
+            for cg in range(1, entry['files'] + 1):
+                self.meta_cache.expect(node.get_file_name(cg))
+            for run in entry['runs']:
+                self.meta_cache.expect(node.get_run_name(run))
+            if entry['runs']:
+                node.runs = entry['runs']
+                node.next_run = max(node.runs) + 1
+
+    def record_layout(self, nodes):
+        """
+        Appends the entries of the nodes a change installed or removed files of, split or merged, and of their parents,
+        to the manifest's edit log. Called on the thread that made the change, once it is made.
+        """
+        with self.checkpoint_lock:
+            # described after the change, between the changes of the other threads (which wait for the lock to record
+            # theirs), so the last record of a node is its newest entry
+            entries = dict()
+            ranges = None
+            for node in nodes:
+                for each in (node, None if node is self.root else node.parent):
+                    if each is self.root:
+                        ranges = self.root.ranges.state()
+                    elif each is not None:
+                        entry = self.describe_node(each)
+                        entries[entry['orders']] = entry
+            written = self.manifest.record(ranges=ranges, nodes=entries.values())
+            self.stats_counters.count(None, manifest_bytes=written)
 
-    def build_tree(self, items, file_root, fp_prob):
-        children = []
-        child_cap = math.ceil(items/self.fan_out)
-        child_range_low_bound = 1
-        child_range_high_bound = child_cap
+    def describe_node(self, node):
+        """
+        :return: the manifest entry of the node (see manifest.decode_node)
+        """
+        orders = []
+        each = node
+        while each is not self.root:
+            orders.append(each.key_range_order)
+            each = each.parent
 
-        for child in range(self.fan_out):
-            filepath = file_root + '/lv-0.kr-' + str(child + 1) + '.cg-1'
-            Path(filepath).mkdir(parents=True, exist_ok=True)
-            node = Node(child_range_low_bound, child_range_high_bound, self.levels,
-                        self.node_storage_capacity, 0, child + 1, 1, self.fan_out, filepath, fp_prob)
-            children.append(node)
-            child_range_low_bound = child_range_high_bound + 1
-            child_range_high_bound = child_range_low_bound + child_cap - 1
+        # the column group files of a last level node are numbered from 1 without gaps
+        files = 0
+        while self.meta_cache.known(node.get_file_name(files + 1)):
+            files += 1
 
-        return MemBuf(self.node_storage_capacity, math.ceil(items/self.fan_out), children)
+        return {'orders': tuple(reversed(orders)), 'files': files,
+                'column_groups': [list(group_cols) for group_cols in node.column_groups],
+                'ranges': node.ranges.state(),
+                'runs': [run for run in node.runs if self.meta_cache.known(node.get_run_name(run))]}
 
-    def read(self, rkeyLow, rkeyHigh, col_pos):
-        return self.root.read(rkeyLow, rkeyHigh, col_pos)
+    def checkpoint(self):
+        """
+        At the end of a flush: records the level 0 boundary table, and rewrites the manifest once its edit log has
+        grown past the entries it folds into
+        """
+        self.record_layout([self.root])
+        if self.manifest.grown():
+            self.stats_counters.count(None, manifest_bytes=self.manifest.rewrite())
+
+    def rebuild_filter(self, node, meta):
+        # on the compactor thread, the only one writing node files
+        self.root.compactor.submit_task(functools.partial(node.rebuild_filter, meta))
+
+    def recover(self):
+        # writes an earlier run logged but never flushed go back into the memory buffer
+        for pairs in self.wal.replay():
+            self.root.write_batch(pairs)
+        self.wal.forget_recovered()
+
+    def snapshot(self):
+        """
+        Takes a consistent view of the tree as of the last write, to pass to read, multi_get and scan. Writes,
+        flushes and compactions go on meanwhile without changing what it sees. Release it (or use it in a with
+        statement) once done, the files replaced since are kept until then.
+        :return: Snapshot instance (see snapshot.py)
+        """
+        return self.root.snapshot()
+
+    # reads the value of the key rkeyLow (scan iterates a key range), rkeyHigh is not used by the lookup
+    # col_pos: 0 for all columns, a column id or a list of column ids; only those columns are returned
+    # snapshot: read as of the snapshot instead of the latest writes
+    def read(self, rkeyLow, rkeyHigh, col_pos, snapshot=None):
+        start = time.perf_counter()
+        val = self.root.read(rkeyLow, rkeyHigh, col_pos, snapshot)
+        if val is not None and val.is_tombstone:
+            val = None
+        elif val is not None:
+            val = val.project(Value.wanted_cols(col_pos))
+        self.stats_counters.operation('read', start, counter='reads')
+        return val
+
+    def multi_get(self, keys, col_pos=0, snapshot=None):
+        """
+        Reads many keys at once, sharing the bloom filter checks and file reads of keys that land in the same node
+        :param snapshot: read as of the snapshot instead of the latest writes
+        :return: list of values (None where a key is not found) in the order of the keys
+        """
+        start = time.perf_counter()
+        cols = Value.wanted_cols(col_pos)
+        results = self.root.multi_get(keys, col_pos, snapshot)
+        values = [results[key].project(cols) if key in results and not results[key].is_tombstone else None
+                  for key in keys]
+        self.stats_counters.operation('multi_get', start, len(keys), 'multi_get_keys')
+        return values
+
+    def scan(self, low, high, col_pos=0, snapshot=None):
+        """
+        Iterates the key/value pairs with low <= key <= high in key order, newest version of every key,
+        merging the memory buffer and every level lazily
+        :param snapshot: iterate as of the snapshot instead of the latest writes
+        """
+        start = time.perf_counter()
+        cols = Value.wanted_cols(col_pos)
+        rows = 0
+        try:
+            for key, val in self.root.scan(low, high, col_pos, snapshot):
+                # the newest version of a deleted key is its tombstone
+                if val.is_tombstone:
+                    continue
+                rows += 1
+                yield key, val.project(cols)
+        finally:
+            self.stats_counters.operation('scan', start, rows)
+            self.stats_counters.count(None, scans=1)
+
+    def query(self, low, high, predicates, cols=0, snapshot=None):
+        """
+        Iterates the key/value pairs with low <= key <= high whose newest version satisfies every predicate, in key
+        order. Nodes and blocks whose zone maps rule the predicates out are not read (see zonemap.py).
+        :param predicates: list of (column id, operator, str) triples, operator being one of zonemap.OPS ('==', '!=',
+                           '<', '<=', '>', '>=' compare the str of the column, 'null' and 'not null' take no str)
+        :param cols: the columns returned, as col_pos of read
+        :param snapshot: query as of the snapshot instead of the latest writes
+        """
+        preds = compile_predicates(predicates)
+        return self.query_rows(low, high, preds, cols, snapshot)
+
+    def query_rows(self, low, high, preds, cols, snapshot):
+        start = time.perf_counter()
+        wanted = Value.wanted_cols(cols)
+        # the predicates are checked on the rows read, so their columns are read as well
+        read_cols = 0 if wanted is None else sorted(wanted | predicate_columns(preds))
+        rows = 0
+        try:
+            for key, val in self.root.scan(low, high, read_cols, snapshot, preds):
+                if val.is_tombstone or not matches(val, preds):
+                    continue
+                rows += 1
+                yield key, val.project(wanted)
+        finally:
+            self.stats_counters.operation('query', start, rows)
+            self.stats_counters.count(None, queries=1)
 
-    # ToDo: trigger bloom filter rebuild when FP rate creeps up
     def write(self, write_key, write_value):
+        start = time.perf_counter()
         self.root.write(write_key, write_value)
+        self.stats_counters.operation('write', start)
+
+    def write_batch(self, items):
+        """
+        :param items: iterable of (key, value) pairs, written in order
+        """
+        start = time.perf_counter()
+        items = list(items)
+        self.root.write_batch(items)
+        self.stats_counters.operation('write_batch', start, len(items))
+
+    def delete(self, key):
+        """
+        Writes a tombstone for the key, so reads no longer find it. The key's data is dropped once the tombstone
+        reaches the last level.
+        """
+        start = time.perf_counter()
+        self.root.write(key, Value.tombstone())
+        self.stats_counters.count(None, deletes=1)
+        self.stats_counters.operation('delete', start)
+
+    def delete_range(self, low, high):
+        """
+        Deletes every key with low <= key <= high: a tombstone for every such key the tree holds, written as one batch
+        :return: number of keys deleted
+        """
+        start = time.perf_counter()
+        keys = [key for key, val in self.root.scan(low, high, KEYS_ONLY) if not val.is_tombstone]
+        if keys:
+            self.root.write_batch([(key, Value.tombstone()) for key in keys])
+        self.stats_counters.operation('delete_range', start, len(keys), 'deletes')
+        return len(keys)
+
+    def flush(self):
+        """
+        Writes the memory buffer to disk and returns once it and every buffer frozen before it are flushed, with the
+        compactions they started. Raises the error of a background flush that failed.
+        """
+        self.root.flush()
+
+    def add_hook(self, hook):
+        """
+        :param hook: called as hook(event, info) after every operation, flush and compaction (see stats.py)
+        """
+        self.stats_counters.hooks.append(hook)
+
+    def stats(self):
+        """
+        :return: dict of the tree counters, the counters and derived rates of every level, and the block cache
+                 counters
+        """
+        tree, levels = self.stats_counters.snapshot()
+        reads = tree['reads'] + tree['multi_get_keys']
+        compaction_bytes = sum(counters['compaction_bytes_written'] for counters in levels)
+        # scans and queries open files too, but not per key read
+        tree['files_opened_per_read'] = sum(counters['lookup_files_opened'] for counters in levels) / reads \
+            if reads else 0
+        tree['block_bytes_read'] = sum(counters['block_bytes_read'] for counters in levels)
+        tree['write_amplification'] = (tree['wal_bytes'] + compaction_bytes + tree['manifest_bytes']) / \
+            tree['wal_bytes'] if tree['wal_bytes'] else 0
+
+        # how full the nodes holding a file are, from the metadata of their files
+        held = [[] for _ in levels]
+        for node in self.walk_nodes(self.root.children):
+            metas = [self.meta_cache.lookup_file(name) for name in [node.get_file_name()] + node.run_names()]
+            if any(meta is not None for meta in metas):
+                held[node.level].append(metas)
+        for level, counters in enumerate(levels):
+            level_nodes = held[level]
+            counters['level'] = level
+            counters['policy'] = self.policies[level].name
+            counters['nodes'] = len(level_nodes)
+            # a key in more than one sorted run of a node counts once per run
+            counters['keys'] = sum(meta.num_keys for metas in level_nodes for meta in metas if meta is not None)
+            counters['runs'] = sum(meta is not None for metas in level_nodes for meta in metas[1:])
+            counters['fill_ratio'] = counters['keys'] / (len(level_nodes) * self.node_storage_capacity) \
+                if level_nodes else 0
+
+            counters['files_opened_per_read'] = counters['lookup_files_opened'] / reads if reads else 0
+            # checks of keys not in the file: the ones the filter ruled out plus the false positives
+            negatives = counters['bloom_checks'] - counters['bloom_hits'] + counters['bloom_false_positives']
+            counters['bloom_fp_rate'] = counters['bloom_false_positives'] / negatives if negatives else 0
+
+        return {'tree': tree, 'levels': levels, 'block_cache': self.cache_stats()}
+
+    def walk_nodes(self, children):
+        # the children as they are now, compactions going on meanwhile
+        for node in list(children.values()):
+            yield node
+            yield from self.walk_nodes(node.children)
+
+    def cache_stats(self):
+        """
+        :return: dict of the block cache hit, miss and eviction counts and its bytes in use, None without a cache
+        """
+        if self.meta_cache.blocks is None:
+            return None
+        return self.meta_cache.blocks.counters()
+
+    def close(self):
+        """
+        Waits for the background flushes of full buffers and stops the compaction worker. Writes still in the memory
+        buffer stay in the write-ahead log and are replayed by the next tree opened on the same file root.
+        """
+        self.root.compactor.stop()
+        self.codec_pool.close()
+        self.wal.close()
+        self.manifest.close()
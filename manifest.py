@@ -0,0 +1,259 @@
+import os
+import struct
+import threading
+import zlib
+
+MANIFEST_NAME = 'MANIFEST'
+MAGIC = b'DSMF'
+VERSION = 6
+
+'''
+ $$$$ Manifest:
+  The file "MANIFEST" at the tree's file root describes the structure of the tree without any node file having to be
+  read: the tree configuration, the level 0 boundary table, and for every node that has a file, or children that do,
+  its key range path (the key range orders from level 0 down), last level column groups, the boundary table of its
+  children (see partition.py), how many column group files it has and the ids of its sorted runs (see compaction.py).
+  Opening a tree rebuilds the nodes from it, the metadata of a node file (key count, key fences, bloom filter, block
+  index) being read from the file's footer only when it is first needed.
+
+  It is an edit log: every change of the tree on disk that changes what it says of a node (see MetaCache.change)
+  appends a record with the node's new entry and one with its parent's (or the level 0 boundary table), and fsyncs
+  them before the change goes on, so a node holding data is never missing from it and a removed file is only deleted
+  once it is no longer listed. A record equal to the one the manifest holds is not appended, so rewriting a node file
+  in place costs nothing. Opening the tree, and the end of a flush once the log has grown past the entries it folds
+  into, rewrite the manifest from the folded entries (to a temporary file, then renamed over the old one).
+
+  Layout, packed with struct like the node files: a header (magic, format version) followed by records, each framed as
+  (crc32, length, type) so a record torn by a crash ends the log. A configuration record and a level 0 boundary table
+  record come first, a rewrite then has one node record per node, parents before their children. Later records replace
+  the record of the same kind (for node records: of the same key range path). A boundary table is its number of
+  children, its high key, most children and child width, then the low key and the id of every child.
+'''
+
+HEADER = struct.Struct('>4sH')
+# crc32 of the body, body length, record type
+FRAME = struct.Struct('>IIB')
+CONFIG_RECORD, RANGES_RECORD, NODE_RECORD = 1, 2, 3
+# items, levels, fan out, false positive probability, columns per group
+CONFIG = struct.Struct('>qHIdI')
+RANGES = struct.Struct('>IqIq')
+# depth of the key range path, then the key range orders
+PATH = struct.Struct('>H')
+# number of column groups, column group files and sorted runs
+NODE = struct.Struct('>HHH')
+GROUP = struct.Struct('>H')
+
+# records appended since the last rewrite, beyond the entries they fold into, before a flush rewrites the manifest
+LOG_SLACK = 64
+
+
+class Manifest(object):
+    def __init__(self, file_root):
+        self.filename = os.path.join(file_root, MANIFEST_NAME)
+        self.lock = threading.Lock()
+
+        # the folded entries: 'config', 'ranges' and every key range path -> the body of its newest record
+        self.records = dict()
+
+        # records appended since the last rewrite
+        self.appended = 0
+
+        # the manifest appended to, opened by the first rewrite
+        self.outfile = None
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def load(self):
+        """
+        Folds the records of the manifest, a torn record at the end being left out
+        :return: dict with the tree configuration under 'config', the level 0 boundary table under 'ranges' and the node
+                 entries under 'nodes', parents before their children
+        """
+        with open(self.filename, "rb") as infile:
+            data = infile.read()
+        if len(data) < HEADER.size or HEADER.unpack_from(data, 0) != (MAGIC, VERSION):
+            raise ValueError(self.filename + ' has an unknown manifest version')
+
+        pos = HEADER.size
+        while pos + FRAME.size <= len(data):
+            crc, length, kind = FRAME.unpack_from(data, pos)
+            body = data[(pos + FRAME.size):(pos + FRAME.size + length)]
+            if len(body) < length or zlib.crc32(body) != crc:
+                break
+            self.records[record_key(kind, body)] = body
+            pos += FRAME.size + length
+
+        return {'config': decode_config(self.records['config']),
+                'ranges': decode_ranges(self.records['ranges'], 0)[0],
+                'nodes': [decode_node(self.records[orders]) for orders in self.node_paths()]}
+
+    def node_paths(self):
+        return sorted(key for key in self.records if isinstance(key, tuple))
+
+    def record(self, config=None, ranges=None, nodes=()):
+        """
+        Appends the records that changed to the log, fsynced together. Before the first rewrite they are only folded.
+        :param config: the tree configuration
+        :param ranges: the state of the level 0 boundary table
+        :param nodes: node entries, dicts as decode_node returns
+        :return: number of bytes appended
+        """
+        bodies = []
+        if config is not None:
+            bodies.append((CONFIG_RECORD, encode_config(config)))
+        if ranges is not None:
+            bodies.append((RANGES_RECORD, encode_ranges(ranges)))
+        bodies.extend((NODE_RECORD, encode_node(entry)) for entry in nodes)
+
+        with self.lock:
+            out = bytearray()
+            for kind, body in bodies:
+                key = record_key(kind, body)
+                if self.records.get(key) == body:
+                    continue
+                self.records[key] = body
+                out += frame(kind, body)
+                self.appended += 1
+            if not out or self.outfile is None:
+                return 0
+            self.outfile.write(out)
+            self.outfile.flush()
+            os.fsync(self.outfile.fileno())
+            return len(out)
+
+    def forget(self, orders):
+        """
+        Drops the entry of a node from the folded entries, written out by the next rewrite
+        """
+        with self.lock:
+            self.records.pop(tuple(orders), None)
+
+    def grown(self):
+        """
+        :return: whether the log holds enough records replaced since to be worth a rewrite
+        """
+        return self.appended > len(self.records) + LOG_SLACK
+
+    def rewrite(self):
+        """
+        Writes the folded entries as a new manifest, leaving out the nodes that neither have a file nor nodes under them
+        that do
+        :return: number of bytes written
+        """
+        with self.lock:
+            paths = self.node_paths()
+            kept = set()
+            for orders in reversed(paths):
+                entry = decode_node(self.records[orders])
+                if entry['files'] or entry['runs'] or orders in kept:
+                    kept.update(orders[:depth] for depth in range(1, len(orders) + 1))
+
+            out = bytearray(HEADER.pack(MAGIC, VERSION))
+            out += frame(CONFIG_RECORD, self.records['config'])
+            out += frame(RANGES_RECORD, self.records['ranges'])
+            for orders in paths:
+                if orders in kept:
+                    out += frame(NODE_RECORD, self.records[orders])
+                else:
+                    del self.records[orders]
+
+            if self.outfile is not None:
+                self.outfile.close()
+            with open(self.filename + '.tmp', "wb") as outfile:
+                outfile.write(out)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(self.filename + '.tmp', self.filename)
+            self.outfile = open(self.filename, "ab")
+            self.appended = 0
+            return len(out)
+
+    def close(self):
+        with self.lock:
+            if self.outfile is not None:
+                self.outfile.close()
+                self.outfile = None
+
+
+def frame(kind, body):
+    return FRAME.pack(zlib.crc32(body), len(body), kind) + body
+
+
+def record_key(kind, body):
+    """
+    :return: the key of the folded entry the record replaces
+    """
+    if kind == CONFIG_RECORD:
+        return 'config'
+    if kind == RANGES_RECORD:
+        return 'ranges'
+    (depth,) = PATH.unpack_from(body, 0)
+    return struct.unpack_from('>%dI' % depth, body, PATH.size)
+
+
+def encode_config(config):
+    return CONFIG.pack(config['items'], config['levels'], config['fan_out'], config['fp_prob'],
+                       config['cols_per_group'])
+
+
+def decode_config(body):
+    items, levels, fan_out, fp_prob, cols_per_group = CONFIG.unpack_from(body, 0)
+    return {'items': items, 'levels': levels, 'fan_out': fan_out, 'fp_prob': fp_prob,
+            'cols_per_group': cols_per_group}
+
+
+def encode_ranges(state):
+    """
+    :param state: the state of a boundary table (see KeyRanges.state)
+    """
+    bounds, ids, high, max_slots, width = state
+    return RANGES.pack(len(bounds), high, max_slots, width) + struct.pack('>%dq' % len(bounds), *bounds) + \
+        struct.pack('>%dI' % len(ids), *ids)
+
+
+def decode_ranges(data, pos):
+    """
+    :return: the state of a boundary table, the position after it
+    """
+    count, high, max_slots, width = RANGES.unpack_from(data, pos)
+    pos += RANGES.size
+    bounds = list(struct.unpack_from('>%dq' % count, data, pos))
+    pos += 8 * count
+    ids = list(struct.unpack_from('>%dI' % count, data, pos))
+    pos += 4 * count
+    return (bounds, ids, high, max_slots, width), pos
+
+
+def encode_node(entry):
+    orders = entry['orders']
+    out = bytearray(PATH.pack(len(orders)) + struct.pack('>%dI' % len(orders), *orders))
+    out += NODE.pack(len(entry['column_groups']), entry['files'], len(entry['runs']))
+    out += encode_ranges(entry['ranges'])
+    for group_cols in entry['column_groups']:
+        out += GROUP.pack(len(group_cols)) + struct.pack('>%di' % len(group_cols), *group_cols)
+    out += struct.pack('>%dI' % len(entry['runs']), *entry['runs'])
+    return bytes(out)
+
+
+def decode_node(body):
+    """
+    :return: dict with the key range path under 'orders', the column groups, the boundary table of the children under
+             'ranges', the number of column group files under 'files' and the sorted run ids, newest first, under 'runs'
+    """
+    (depth,) = PATH.unpack_from(body, 0)
+    pos = PATH.size
+    orders = struct.unpack_from('>%dI' % depth, body, pos)
+    pos += 4 * depth
+    num_groups, files, num_runs = NODE.unpack_from(body, pos)
+    ranges, pos = decode_ranges(body, pos + NODE.size)
+
+    column_groups = []
+    for _ in range(num_groups):
+        (count,) = GROUP.unpack_from(body, pos)
+        pos += GROUP.size
+        column_groups.append(list(struct.unpack_from('>%di' % count, body, pos)))
+        pos += 4 * count
+    runs = list(struct.unpack_from('>%dI' % num_runs, body, pos))
+
+    return {'orders': orders, 'column_groups': column_groups, 'ranges': ranges, 'files': files, 'runs': runs}
@@ -1,51 +1,274 @@
-import math
+import bisect
+import functools
+import threading
+import time
+from compactor import Compactor
+from mergeiter import merge_newest
+from partition import Children, remove_retired, split_if_wanted, taken_ids
+from snapshot import Snapshot
+from sortedbuf import SortedBuffer
 
 
 # Memory buffer
-class MemBuf:
+class MemBuf(Children):
     # l: low key bound, h: high key bound, n: num of cols, v: total levels of lsm tree, f: fan-out rate
-    def __init__(self, capacity, level_0_cap, children):
-        self.buffer = dict()
-        self.capacity = capacity
+    def __init__(self, capacity_bytes, level_0_cap, ranges, make_child, checkpoint, max_immutables, wal, stats,
+                 meta_cache, compaction_workers=1):
+        # key -> [sequence number, value, the entry it replaced if a snapshot may read it] (see snapshot.py), in key
+        # order (see sortedbuf.py)
+        self.buffer = SortedBuffer()
+
+        # bytes of entries the buffer takes before it is frozen and flushed
+        self.capacity_bytes = capacity_bytes
+
+        # sequence number of the last write
+        self.seq = 0
+
+        # held by a write from logging it to putting it into the buffer, so sequence numbers follow the log
+        self.write_lock = threading.Lock()
+
+        # the tree-wide cache of node metadata, which also numbers the changes on disk and pins them for snapshots
+        self.meta_cache = meta_cache
+
+        # number of keys of a level 0 range added for keys beyond the key space so far
         self.child_key_cap = level_0_cap
-        self.children = children
 
-    def read(self, rkeyLow, rkeyHigh, col_pos):
-        if rkeyLow == rkeyHigh and rkeyLow in self.buffer:
-            return self.buffer[rkeyLow]
+        # boundary table of the level 0 key ranges (see partition.py)
+        self.ranges = ranges
+
+        # level 0 nodes made so far, by child order - 1. make_child(ch, low, high) makes one when a flush first
+        # reaches it
+        self.children = dict()
+        self.make_child = make_child
+
+        # level 0 nodes merged into a sibling, whose files the next flush removes
+        self.retired = []
+
+        # held while the boundary table is split or merged, the level 0 nodes of a flush being compacted in parallel
+        self.layout_lock = threading.Lock()
+
+        # records the level 0 boundary table in the manifest and folds its edit log once grown, called once a flush is
+        # on disk
+        self.checkpoint = checkpoint
+
+        # full buffers, newest first, that are still being flushed. They are never modified again and reads see them
+        self.immutables = []
+
+        # number of full buffers allowed to wait for the flush before writes block
+        self.max_immutables = max_immutables
+        self.flush_cond = threading.Condition()
+
+        # write-ahead log, so the buffered writes survive a crash
+        self.wal = wal
+
+        # the tree-wide counters (see stats.py)
+        self.stats = stats
+
+        # flushes frozen buffers in the background, compacting up to compaction_workers level 0 subtrees at a time
+        self.compactor = Compactor(self, compaction_workers)
+
+    def read(self, rkeyLow, rkeyHigh, col_pos, snapshot=None):
+        # the nodes look rkeyLow up, so the buffers do too whatever rkeyHigh is: a newer write (or delete) of the key
+        # there hides the one on disk
+        version = None if snapshot is None else snapshot.generation
+        if snapshot is not None:
+            val = snapshot.lookup(rkeyLow)
+            if val is not None:
+                return val
+        else:
+            if rkeyLow in self.buffer:
+                return self.buffer[rkeyLow][1]
+            for frozen in self.immutables:
+                if rkeyLow in frozen:
+                    return frozen[rkeyLow][1]
+
+        # the boundary table tells which child search should go to
+        table = self.ranges.table
+        child = self.find_child(self.child_index(rkeyLow, version), version)
+        obj = None if child is None else child.read(rkeyLow, rkeyLow, col_pos, version)
+        if obj is None and snapshot is None and self.ranges.table is not table:
+            # level 0 was split or merged meanwhile, the key may have moved to another node
+            return self.read(rkeyLow, rkeyHigh, col_pos)
+        return obj
 
-        # The following formula figures out which child search should go to
-        childLow = math.ceil(rkeyLow/self.child_key_cap) - 1
-        childHigh = math.ceil(rkeyHigh/self.child_key_cap) - 1
-        return self.children[childLow].read(rkeyLow, rkeyLow, col_pos)
+    def multi_get(self, read_keys, col_pos, snapshot=None):
+        """
+        :return: dict of the keys found and their values
+        """
+        version = None if snapshot is None else snapshot.generation
+        results = dict()
+        by_child = dict()
+        # a key asked for more than once is looked up once
+        for key in dict.fromkeys(read_keys):
+            if snapshot is not None:
+                val = snapshot.lookup(key)
+                if val is not None:
+                    results[key] = val
+                    continue
+            else:
+                for buf in [self.buffer] + self.immutables:
+                    if key in buf:
+                        results[key] = buf[key][1]
+                        break
+                if key in results:
+                    continue
+            by_child.setdefault(self.child_index(key, version), []).append(key)
+
+        # one bloom filter pass and one file decode per level 0 node
+        table = self.ranges.table
+        for ch in by_child:
+            # keys outside the key space of the tree, or of a level 0 node without data, are not found
+            child = self.find_child(ch, version)
+            if child is not None:
+                child.multi_get(by_child[ch], col_pos, results, version)
+
+        missing = [key for keys in by_child.values() for key in keys if key not in results]
+        if missing and snapshot is None and self.ranges.table is not table:
+            # level 0 was split or merged meanwhile, the keys may have moved to other nodes
+            results.update(self.multi_get(missing, col_pos))
+        return results
+
+    def snapshot(self):
+        """
+        :return: a Snapshot of the tree as of the last write, released by the caller
+        """
+        # no frozen buffer is retired meanwhile, so every flushed one is on disk as of the pinned generation. The
+        # generation is pinned before the sequence number is read, see put
+        with self.flush_cond:
+            generation = self.meta_cache.pin()
+            return Snapshot(self.seq, generation, self.buffer, self.immutables, self.meta_cache.release)
+
+    # preds: the predicates of a query, the level 0 nodes leave out the blocks their zone maps rule out (see Node.scan)
+    def scan(self, low, high, col_pos, snapshot=None, preds=None):
+        if snapshot is None:
+            sources = [((key, entry[1]) for key, entry in buf.range(low, high))
+                       for buf in [self.buffer] + self.immutables]
+        else:
+            sources = snapshot.scan_buffers(low, high)
+        sources.append(self.scan_children(low, high, col_pos, None if snapshot is None else snapshot.generation,
+                                          preds))
+        yield from merge_newest(sources)
 
     def write(self, wkey, wvalue):
-        self.buffer[wkey] = wvalue
+        with self.write_lock:
+            wal_bytes, ticket = self.wal.append([(wkey, wvalue)])
+            self.stats.count(None, writes=1, wal_bytes=wal_bytes)
+            self.put(wkey, wvalue)
+
+            if self.buffer.nbytes >= self.capacity_bytes:
+                self.freeze()
+        # outside of the write lock, so the writes logged meanwhile share the fsync
+        self.wal.commit(ticket)
+
+    def write_batch(self, items):
+        # the whole batch is one log append
+        items = list(items)
+        with self.write_lock:
+            wal_bytes, ticket = self.wal.append(items)
+            self.stats.count(None, writes=len(items), wal_bytes=wal_bytes)
+            for wkey, wvalue in items:
+                self.put(wkey, wvalue)
+
+            # the batch is logged in one segment, so it goes into one buffer as well
+            if self.buffer.nbytes >= self.capacity_bytes:
+                self.freeze()
+        self.wal.commit(ticket)
+
+    # puts a write into the buffer under the next sequence number
+    def put(self, wkey, wvalue):
+        seq = self.seq + 1
+        entry = [seq, wvalue, self.buffer.get(wkey)]
+        self.buffer.put(wkey, entry)
+        self.seq = seq
 
-        if len(self.buffer) >= self.capacity:
-            # make a copy of the memory buffer so it is freed for other writes
-            alternative_buffer = dict(self.buffer)
-            self.buffer.clear()
+        # a snapshot pins its generation before it reads the sequence number, so one taken after this check sees the
+        # write and never needs the entry it replaced
+        if not self.meta_cache.pinned:
+            self.buffer.drop_replaced(entry)
 
-            # TODO: issue compaction to a different thread so its done asynchronously
-            self.compaction_m2f(alternative_buffer)
-            alternative_buffer.clear()
+    def freeze(self):
+        """
+        Turns the buffer into an immutable one that the compactor flushes in the background, and starts a fresh buffer
+        for new writes. Blocks while max_immutables buffers are already waiting (backpressure).
+        """
+        with self.flush_cond:
+            while len(self.immutables) >= self.max_immutables:
+                self.compactor.check()
+                self.flush_cond.wait(1)
+
+            # publish the frozen buffer before swapping, so a read always finds a key in one of the two
+            frozen = self.buffer
+            self.immutables = [frozen] + self.immutables
+            self.buffer = SortedBuffer()
+
+            # the log segment holding the frozen buffer's writes is sealed with it
+            self.wal.rotate()
+
+        self.compactor.submit(frozen)
+
+    def flush(self):
+        """
+        Freezes the buffer if it holds any write and waits until every frozen buffer is flushed
+        """
+        with self.write_lock:
+            if len(self.buffer):
+                self.freeze()
+        self.compactor.wait()
+
+    def retire(self, frozen):
+        # the buffer is on disk now, so reads can stop looking at it and its log segment can go
+        with self.flush_cond:
+            self.immutables = [buf for buf in self.immutables if buf is not frozen]
+            self.flush_cond.notify_all()
+        self.wal.release_oldest()
 
     def compaction_m2f(self, compact_buffer):
-        # read in Level 0 nodes
-        for node in self.children:
-            node.read_whole_file()
+        start = time.perf_counter()
+        remove_retired(self)
+
+        # only the level 0 nodes the flushed keys land in are read and rewritten, keys beyond the key space so far
+        # getting a new level 0 range. The keys come in order, so every node gets one run of them, cut where its range
+        # ends
+        keys = compact_buffer.sorted_keys()
+        dirty = dict()
+        pos = 0
+        while pos < len(keys):
+            ch = self.child_index(keys[pos])
+            if ch is None:
+                with self.meta_cache.change() as stamp:
+                    ch = self.ranges.cover(keys[pos], self.child_key_cap, taken_ids(self), stamp)
+            end = bisect.bisect_right(keys, self.ranges.range_of(ch)[1], pos)
+            dirty[ch] = keys[pos:end]
+            pos = end
+
+        self.ranges.record({ch: len(dirty[ch]) for ch in dirty})
+        for child in dirty:
+            self.get_child(child)
+
+        # the subtrees under different level 0 nodes share no keys, so they are compacted in parallel
+        pending = set(dirty)
+        self.compactor.run_all([functools.partial(self.flush_child, child, dirty[child], compact_buffer, pending)
+                                for child in sorted(dirty)])
 
-        for key in compact_buffer:
-            child = math.ceil(key / self.child_key_cap) - 1
-            if key not in self.children[child].workspace:
-                self.children[child].bloom_ftr.add(str(key))
-            self.children[child].workspace[key] = compact_buffer[key]
+        # the manifest has to list the new level 0 ranges before the log of the flushed writes is dropped
+        self.checkpoint()
 
-            if len(self.children[child].workspace) >= self.children[child].storage_capacity:
-                self.children[child].compaction_f2f()
+        seconds = time.perf_counter() - start
+        self.stats.count(None, flushes=1, flush_seconds=seconds)
+        if self.stats.hooks:
+            self.stats.emit('flush', seconds=seconds, keys=len(compact_buffer))
 
-        # compaction is done so clear memory buffer and write out every child page
-        for node in self.children:
-            node.write_to_file()
+    # pushes the flushed keys of one level 0 node into it and down its subtree
+    # pending: the level 0 nodes of the flush not written yet, which a split cannot merge away
+    def flush_child(self, child, keys, compact_buffer, pending):
+        node = self.children[child]
+        # level 0's compaction policy decides how the node takes the keys (see compaction.py)
+        node.receive(self, ((key, compact_buffer[key][1]) for key in keys),
+                     functools.partial(self.split_node, node, pending))
+        with self.layout_lock:
+            pending.discard(child)
 
+    # a node hotter than the others is split instead of pushed down (see partition.py), one at a time
+    def split_node(self, node, pending):
+        with self.layout_lock:
+            return split_if_wanted(self, node, pending)
@@ -0,0 +1,21 @@
+import heapq
+
+
+def _tag(source, rank):
+    for key, value in source:
+        yield key, rank, value
+
+
+def merge_newest(sources):
+    """
+    K-way merges key-sorted (key, value) iterators lazily, keeping only the newest version of every key
+    :param sources: iterators sorted by key, newest source first
+    :return: generator of (key, value) in key order
+    """
+    tagged = [_tag(source, rank) for rank, source in enumerate(sources)]
+    last_key = None
+    for key, rank, value in heapq.merge(*tagged, key=lambda t: (t[0], t[1])):
+        if last_key is not None and key == last_key:
+            continue
+        last_key = key
+        yield key, value
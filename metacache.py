@@ -0,0 +1,269 @@
+import contextlib
+import itertools
+import os
+import threading
+from blockcache import BlockCache
+from nodefile import read_node_meta
+
+
+class MetaCache(object):
+    """
+    Per-tree cache of node metadata, keyed by the node file name. A node's bloom filter, key fences and
+    block index are loaded at most once and afterwards refreshed by Node.write_to_file, so negative lookups
+    never open the node file.
+
+    Compaction runs on a background thread, so a node file is only ever swapped (together with its cache entry)
+    under the cache lock, and readers open the file under the same lock to get the metadata matching it.
+
+    Only files this tree wrote or the manifest lists are known to exist, every other node file name is a miss without
+    asking the file system.
+
+    It also numbers the changes of the tree on disk and keeps the files replaced while snapshots are held (see
+    snapshot.py).
+    """
+    def __init__(self, block_cache_bytes, retain_dir):
+        self.entries = dict()
+        self.lock = threading.RLock()
+
+        # decoded data blocks of hot reads, None if there is no budget for them
+        self.blocks = BlockCache(block_cache_bytes) if block_cache_bytes else None
+
+        # generation of the last change (see change). A file gets the generation it was installed at, so cached blocks
+        # of a replaced file never match; files there when the tree was opened have generation 0
+        self.generation = 0
+
+        # (generation, oldest generation held) of the change being made, None outside of one
+        self.stamp = None
+
+        # generation -> number of snapshots held at it
+        self.pinned = dict()
+
+        # replaced or removed files snapshots may still read: file name -> list of (generation it was replaced at,
+        # its NodeMeta, the name it is kept under), oldest first
+        self.earlier = dict()
+
+        # where those files are kept
+        self.retain_dir = retain_dir
+        self.retained = itertools.count()
+
+        # files listed in the manifest and not loaded yet
+        self.listed = set()
+
+        # called with the nodes a change installed or removed files of, and with the nodes split or merged (see
+        # partition.py), so the manifest lists the new layout
+        self.on_layout_change = None
+
+        # nodes the change being made installed or removed files of; on_layout_change is called once it is made,
+        # outside of the lock, so readers do not wait for the manifest to be written
+        self.changed = []
+
+        # files removed by the change being made. They are deleted once a manifest not listing them is written, so a
+        # crash never leaves the manifest listing a file that is gone
+        self.removed = []
+
+        # called with a node and its NodeMeta when the node's bloom filter lets through more false positives than it
+        # was built for
+        self.on_stale_filter = None
+
+    def expect(self, filename):
+        """
+        Registers a node file listed in the manifest, its metadata is read on the first lookup
+        """
+        self.listed.add(filename)
+
+    def known(self, filename):
+        """
+        :return: whether there is a node file of the name, never reading it
+        """
+        return self.entries.get(filename) is not None or filename in self.listed
+
+    def lookup(self, node, column_group=1, version=None):
+        """
+        :param node: the node whose metadata is wanted
+        :param column_group: which column group file of a last level node
+        :param version: generation of a snapshot to see the file of, None for the current file
+        :return: NodeMeta instance, or None if the node has no file yet
+        """
+        return self.lookup_file(node.get_file_name(column_group), version)
+
+    def lookup_file(self, filename, version=None):
+        """
+        :return: NodeMeta of the node file (or sorted run, see compaction.py) of the given name, None if there is none
+        """
+        if version is not None:
+            with self.lock:
+                return self.at_version(filename, version)[0]
+
+        meta = self.entries.get(filename, False)
+        if meta is not False:
+            return meta
+
+        with self.lock:
+            if filename in self.entries:
+                return self.entries[filename]
+            meta = None
+            # a crash can leave a regrouped away column group file listed
+            if filename in self.listed and os.path.exists(filename):
+                meta = read_node_meta(filename)
+                meta.generation = 0
+            self.listed.discard(filename)
+            self.entries[filename] = meta
+            return meta
+
+    def at_version(self, filename, version):
+        """
+        :return: NodeMeta of the newest file of the name installed before the version and the name to open it under,
+                 (None, None) if there was none
+        """
+        meta = self.lookup_file(filename)
+        if meta is not None and meta.generation <= version:
+            return meta, filename
+        for until, old, kept_name in self.earlier.get(filename, ()):
+            if version < until:
+                return (old, kept_name) if old.generation <= version else (None, None)
+        return None, None
+
+    def open(self, node, column_group=1, version=None):
+        """
+        Opens the node file together with the metadata that describes it
+        :param version: generation of a snapshot to see the file of, None for the current file
+        :return: NodeMeta instance and the open file, or (None, None) if the node has no file yet
+        """
+        return self.open_file(node.get_file_name(column_group), version)
+
+    def open_file(self, filename, version=None):
+        """
+        Opens the node file (or sorted run) of the given name together with the metadata that describes it
+        :return: NodeMeta instance and the open file, or (None, None) if there is no such file
+        """
+        with self.lock:
+            if version is None:
+                meta = self.lookup_file(filename)
+            else:
+                meta, filename = self.at_version(filename, version)
+            if meta is None:
+                return None, None
+            return meta, open(filename, "rb")
+
+    @contextlib.contextmanager
+    def change(self):
+        """
+        Makes a change of the tree on disk, visible from a new generation on. Snapshots are not taken while it is made,
+        and the files installed and removed within it get its generation.
+        :return: (generation of the change, oldest generation a snapshot is held at or None)
+        """
+        with self.lock:
+            if self.stamp is not None:
+                # part of a change already being made
+                yield self.stamp
+                return
+            self.generation += 1
+            self.stamp = (self.generation, self.oldest())
+            try:
+                yield self.stamp
+            finally:
+                self.stamp = None
+                changed, self.changed = self.changed, []
+                removed, self.removed = self.removed, []
+        if changed and self.on_layout_change is not None:
+            self.on_layout_change(changed)
+        if removed:
+            self.delete(removed)
+
+    def delete(self, filenames):
+        """
+        Deletes removed node files (and the node directories they leave empty), unless installed again since
+        """
+        with self.lock:
+            for filename in filenames:
+                if self.entries.get(filename, False) is not None or not os.path.exists(filename):
+                    continue
+                os.remove(filename)
+                # a node directory goes with the last file of the node in it
+                if not os.listdir(os.path.dirname(filename)):
+                    os.rmdir(os.path.dirname(filename))
+
+    def pin(self):
+        """
+        :return: the generation of the last change, held (and the files it sees kept) until released
+        """
+        with self.lock:
+            self.pinned[self.generation] = self.pinned.get(self.generation, 0) + 1
+            return self.generation
+
+    def oldest(self):
+        """
+        :return: the oldest generation a snapshot is held at, None if none is held
+        """
+        with self.lock:
+            return min(self.pinned) if self.pinned else None
+
+    def release(self, generation):
+        with self.lock:
+            self.pinned[generation] -= 1
+            if not self.pinned[generation]:
+                del self.pinned[generation]
+
+            # drop the files no snapshot still held can see
+            oldest = self.oldest()
+            for filename in list(self.earlier):
+                kept = []
+                for until, old, kept_name in self.earlier[filename]:
+                    if oldest is not None and until > oldest:
+                        kept.append((until, old, kept_name))
+                    else:
+                        os.remove(kept_name)
+                if kept:
+                    self.earlier[filename] = kept
+                else:
+                    del self.earlier[filename]
+
+    def keep(self, filename, stamp):
+        """
+        Keeps the current file under another name if a snapshot may read it, before it is replaced or removed
+        """
+        generation, oldest = stamp
+        if oldest is None:
+            return
+        old = self.entries.get(filename)
+        if old is None and filename in self.listed and os.path.exists(filename):
+            # listed in the manifest and never read
+            old = read_node_meta(filename)
+            old.generation = 0
+        # a file installed after every snapshot held is seen by none of them
+        if old is None or old.generation > max(self.pinned):
+            return
+
+        os.makedirs(self.retain_dir, exist_ok=True)
+        kept_name = os.path.join(self.retain_dir, '%d.%d' % (generation, next(self.retained)))
+        os.link(filename, kept_name)
+        self.earlier.setdefault(filename, []).append((generation, old, kept_name))
+
+    def install(self, tmp_filename, filename, meta, node):
+        """
+        Atomically replaces a node file of the node with a newly written one and refreshes its metadata
+        """
+        with self.change() as stamp:
+            self.keep(filename, stamp)
+            os.replace(tmp_filename, filename)
+            meta.generation = stamp[0]
+            self.entries[filename] = meta
+            if self.blocks is not None:
+                self.blocks.invalidate(filename)
+            self.listed.discard(filename)
+            self.changed.append(node)
+
+    def remove(self, filename, node):
+        """
+        Takes a node file of the node that is no longer part of the tree out of it, the file is deleted after the change
+        (see change)
+        """
+        with self.change() as stamp:
+            if os.path.exists(filename):
+                self.keep(filename, stamp)
+                self.removed.append(filename)
+            self.entries[filename] = None
+            self.listed.discard(filename)
+            self.changed.append(node)
+            if self.blocks is not None:
+                self.blocks.invalidate(filename)
@@ -0,0 +1,39 @@
+import random
+import pytest
+from lsmTree import LsmTree
+from value import Value
+
+N = 600
+
+
+@pytest.mark.parametrize('options', [dict(), dict(cols_per_group=2)])
+def test_write_batch_and_multi_get_match_read(tmp_path, options, make_value):
+    lsm = LsmTree(N, 3, 4, str(tmp_path), 0.01, buffer_bytes=8000, **options)
+    model = dict()
+    rnd = random.Random(1)
+    for batch_no in range(40):
+        batch = []
+        for _ in range(rnd.randint(1, 60)):
+            key = rnd.randint(1, N - 1)
+            batch.append((key, make_value(key, batch_no)))
+        lsm.write_batch(batch)
+        # a key written twice in a batch keeps its last value
+        model.update(batch)
+    lsm.flush()
+
+    # more writes, some of them still in the memory buffer
+    for key in range(1, N, 29):
+        model[key] = make_value(key, -1)
+        lsm.write(key, model[key])
+
+    # duplicates, keys never written and keys beyond the key space, in no order
+    keys = rnd.sample(range(N + 20), 300) + [5, 5, N + 100]
+    for col_pos in (0, 3, [1, 4]):
+        cols = Value.wanted_cols(col_pos)
+        got = lsm.multi_get(keys, col_pos)
+        assert [None if val is None else val.cols for val in got] == \
+               [model[key].project(cols).cols if key in model else None for key in keys]
+        assert [None if val is None else val.cols for val in got] == \
+               [None if val is None else val.cols for val in (lsm.read(key, key, col_pos) for key in keys)]
+    assert lsm.multi_get([]) == []
+    lsm.close()
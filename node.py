@@ -1,9 +1,17 @@
+import contextlib
+import functools
 import math
 import os
+import time
 from pathlib import Path
-import pickle
 from bloomfilter import BloomFilter
 from columngroup import ColumnGroup
+from mergeiter import merge_newest
+from nodefile import (block_keys, block_range, intersect_ranges, iter_node_intervals, iter_node_range, mapped,
+                      read_node_file, read_node_value, read_node_values, read_zones, write_node_file)
+from partition import Children, KeyRanges, remove_retired, split_if_wanted
+from snapshot import keep_earlier, value_at
+from value import Value
 
 '''
  $$$$ File Naming Convention: 
@@ -30,24 +38,50 @@ from columngroup import ColumnGroup
         |       |__lv-1.kr-1.cg-2
         |       |__lv-1.kr-2.cg-1
         |----lv-0.kr-2.cg-1
-            
- $$$$ File content:
-  - bloom filter. Bloom filter will only be added when a key is written into a file, and will never be cleared even 
-    when the data get compacted into the nodes in the levels below. When a key is deleted, the bits indicating 
-    the existence of the key also won't be reset back to zero. Therefore, as more keys have been deleted, the bloom 
-    filter false positive rate will likely increase. When the FP rate is higher than certain rate, we will trigger 
-    a rebuild of bloom filter.
+
+ - A node of a tiered level (see compaction.py) also keeps its sorted runs next to its data.log, as run-<n>.log, n
+   counting up from 1 as the runs are written.
+
+ $$$$ File content (see nodefile.py for the byte layout):
+  - the actual data, sorted by key and cut into blocks (compressed with the codec of the level, if any), with a sparse
+    block index to find the one block holding a key
+  - bloom filter. The bloom filter covers the keys in the file only. It is built every time the file is written, sized
+    for the number of keys the file then holds, so keys compacted into the nodes below or dropped by deletes no longer
+    occupy bits in it. A key the filter rules out may still be in a child, so a read goes on to the child. A filter
+    whose estimated false positive rate comes out above fp_prob is built again with more bits, and so is one whose
+    false positive rate measured by reads goes clearly above it (see check_filter).
   - Children nodes column groups meta data. This records for every child key range (the concatenation of all children's
     distinct key ranges will make up the parent's key range) their column group information, ie, which columns a 
     particular child holds data for.
-  - the actual data
+  - the key count and key fences of the node
+
+ $$$$ Last level:
+  Nodes on the last level are column based. Every column group of the node is a file of its own in the directory
+  "lv-<i>.kr-<j>.cg-<k>", holding every key of the node with only the columns of group k. All group files carry the
+  same bloom filter and key fences, and the columns of every group are recorded in the parent's column group map. The
+  map is informational, a record of the layouts in the parent's file: reads go by the node's own column_groups, which
+  the manifest lists. A read for some columns only opens the files of the groups holding them. Their blocks are
+  stored column by column, dictionary and run-length encoded, so only the wanted columns are decoded. Which columns
+  share a group adapts to the reads the node sees (see workload.py).
+
+ $$$$ Deletes:
+  A delete writes a tombstone (see Value.tombstone) for the key. It moves down the tree like any other value, and a
+  read that meets it stops there and finds nothing. Once it reaches the last level there is nothing older left below
+  to hide, so the last level drops the tombstone together with the key.
                    
 '''
 
+# a filter's measured false positive rate is only trusted after this many reads of keys the file does not hold
+FILTER_SAMPLES = 1000
+
+# how many times a filter is built again when its estimated false positive rate comes out too high
+FILTER_RETRIES = 3
 
-class Node:
+
+class Node(Children):
     def __init__(self, key_low_bound, key_high_bound, total_levels, storage_capacity,
-                 level, key_range_order, column_group, fan_out, file_root, fp_prob):
+                 level, key_range_order, column_group, fan_out, file_root, fp_prob, meta_cache, cols_per_group,
+                 workload, stats, compression, codec_pool, policies):
         # root directory of where the file for this lsmtree node
         self.file_root = file_root
 
@@ -69,140 +103,655 @@ class Node:
         # the child order among children of its parent
         self.key_range_order = key_range_order
 
+        # the node (or the memory buffer, for level 0) whose boundary table routes keys to this one, see
+        # Children.add_child
+        self.parent = None
+
         # the position inside a column group this node is in
         self.column_group = column_group
 
         # number of children
         self.fan_out = fan_out
 
-        # list of children
-        if self.level < self.total_levels - 1:
-            self.children = self.make_node_children(fp_prob)
-        else:
-            self.children = []
+        # the tree-wide cache of node bloom filters and key fences
+        self.meta_cache = meta_cache
+
+        # the smallest and largest key ever written into this node
+        self.key_min = None
+        self.key_max = None
+
+        # last level only: the column ids of every column group, group k being column_groups[k-1]
+        self.column_groups = []
+
+        # last level only: the layouts replaced while snapshots are held (see snapshot.py)
+        self.earlier_groups = []
+
+        # last level only: number of columns put in a new column group when unseen columns arrive
+        self.cols_per_group = cols_per_group
+
+        # the tree-wide record of which columns are read together
+        self.workload = workload
+
+        # the tree-wide counters (see stats.py)
+        self.stats = stats
+
+        # the block compression codec of every level
+        self.compression = compression
+
+        # where compactions encode and decode the last level column group files (see compactor.py)
+        self.codec_pool = codec_pool
+
+        # the compaction policy of every level (see compaction.py)
+        self.policies = policies
+
+        # tiered levels: ids of the sorted runs written since the node file last took them in, newest first
+        self.runs = []
 
-        # the bloom filter for the keys stored in this node
-        self.bloom_ftr = BloomFilter((self.key_high_bound - self.key_low_bound + 1), fp_prob)
+        # the run lists replaced while snapshots are held (see snapshot.py)
+        self.earlier_runs = []
 
-        # children column group map
+        # id of the next sorted run written
+        self.next_run = 1
+
+        # children made so far, by child order - 1. A child (its directory and bloom filter included) is only made when
+        # a compaction first pushes data into it; its key range is the one the boundary table gives its order
+        self.children = dict()
+
+        # boundary table of the children key ranges (see partition.py)
+        self.ranges = KeyRanges.even(key_low_bound, key_high_bound, fan_out)
+
+        # children merged into a sibling, whose files the next compaction removes. They stay here while snapshots taken
+        # before the merge are held
+        self.retired = []
+
+        # generation the node was merged into its sibling at, None while it is not
+        self.retired_at = None
+
+        # false positive probability the bloom filter is sized for
+        self.fp_prob = fp_prob
+
+        # the bloom filter for the keys stored in this node, built when the node is written
+        self.bloom_ftr = None
+
+        # false positive probability the next bloom filter is built for, lowered when a filter falls short of fp_prob
+        self.bloom_fp_prob = fp_prob
+
+        # children column group map, written into the node file for reference only (reads use column_groups)
         self.children_cg_metadata = ColumnGroup(self.fan_out)
 
-        # the workspace in memory when data is read in from the file during compaction
+        # the workspace in memory when data is read in from the file during compaction. Its keys are always put in
+        # key order (see merged_with_files), so the dict iterates them sorted and a file is written without a sort
         self.workspace = dict()
 
-    def make_node_children(self, fp_prob):
-        child_key_cap = math.ceil((self.key_high_bound - self.key_low_bound + 1) / self.fan_out)
-        child_range_start = self.key_low_bound
-
-        col_position_in_group = 0
-        children = []
-        for ch in range(self.fan_out):
-            child_range_end = child_range_start + child_key_cap - 1
-            filepath = self.file_root + '/lv-' + str(self.level+1) + '.kr-' + str(ch+1) + '.cg-1'
-            Path(filepath).mkdir(parents=True, exist_ok=True)
-            chnode = Node(child_range_start, child_range_end, self.total_levels,
-                          self.storage_capacity, self.level+1, ch+1, 1, self.fan_out, filepath, fp_prob)
-            children.append(chnode)
-            child_range_start = child_range_end + 1
-
-        return children
-
-    # Read the value of a key
-    def read(self, rkeyLow, rkeyHigh, col_pos):
-        # What is the filename for myself
-        filename = self.get_file_name()
-        if not os.path.exists(filename):
+    def child_path(self, ch):
+        return self.file_root + '/lv-' + str(self.level+1) + '.kr-' + str(ch+1) + '.cg-1'
+
+    # makes a child for the key range [low, high] (see Children.add_child)
+    def make_child(self, ch, low, high):
+        return Node(low, high, self.total_levels, self.storage_capacity, self.level+1, ch+1, 1,
+                    self.fan_out, self.child_path(ch), self.fp_prob, self.meta_cache, self.cols_per_group,
+                    self.workload, self.stats, self.compression, self.codec_pool, self.policies)
+
+    # Read the value of a key, as of the generation of a snapshot if a version is given
+    def read(self, rkeyLow, rkeyHigh, col_pos, version=None):
+        # the bloom filters and key fences are kept in memory, so a miss costs no file I/O. The newest file's fences
+        # cover every key that ever went through this node
+        runs = self.runs
+        files = self.lookup_files(version)
+        if not files or not files[0][1].covers(rkeyLow):
             return None
+        meta = files[0][1]
 
-        # reconstruct the bloom filter from the file
-        bf, bf_length = BloomFilter.read_bloom_filter_from_file(filename)
+        if self.level >= self.total_levels - 1:
+            if not meta.bloom_ftr.check(rkeyLow):
+                self.stats.count(self.level, lookups=1, bloom_checks=1)
+                self.check_filter(meta, 1, 0)
+                return None
+            obj = self.read_columns(rkeyLow, Value.wanted_cols(col_pos), version)
+            self.stats.count(self.level, lookups=1, bloom_checks=1, bloom_hits=1,
+                             bloom_false_positives=int(obj is None))
+            if obj is None:
+                self.check_filter(meta, 1, 1)
+            return obj
+
+        # the sorted runs newest first, then the node file
+        for pos, (filename, meta) in enumerate(files):
+            # bloom filter shows the item is possibly in, so lets getting it
+            if meta.bloom_ftr.check(rkeyLow):
+                obj = self.read_data(filename, rkeyLow, version)
+                self.stats.count(self.level, lookups=int(pos == 0), bloom_checks=1, bloom_hits=1,
+                                 bloom_false_positives=int(obj is None))
+                # a tombstone is found too, and hides the older versions below
+                if obj is not None:
+                    return obj
+                self.check_filter(meta, 1, 1)
+            else:
+                self.stats.count(self.level, lookups=int(pos == 0), bloom_checks=1)
+                self.check_filter(meta, 1, 0)
+
+        if version is None and self.runs is not runs:
+            # the runs were merged meanwhile, the key may have moved to the node file
+            return self.read(rkeyLow, rkeyHigh, col_pos)
+
+        # not in these files (or the bloom filter was false positive), continue to search children
+        return self.read_child(rkeyLow, rkeyHigh, col_pos, version)
+
+    def read_child(self, rkeyLow, rkeyHigh, col_pos, version=None):
+        table = self.ranges.table
+        child = self.find_child(self.child_index(rkeyLow, version), version)
+        obj = None if child is None else child.read(rkeyLow, rkeyHigh, col_pos, version)
+        if obj is None and version is None and self.ranges.table is not table:
+            # the children were split or merged meanwhile, the key may have moved to another child
+            return self.read_child(rkeyLow, rkeyHigh, col_pos)
+        return obj
+
+    # Read many keys, sharing one bloom filter pass and one decode of every file of this node among them
+    def multi_get(self, read_keys, col_pos, results, version=None):
+        runs = self.runs
+        files = self.lookup_files(version)
+        if not files:
+            return
 
-        # bloom filter shows the item is possibly in, so lets getting it
-        if not bf.check(str(rkeyLow)):
-            return None
-        else:
-            obj = self.read_data(filename, bf_length, rkeyLow)
-            if obj is not None:
-                return obj
-            else:  # bloom filter was false positive, continue to search children
-                if self.level >= self.total_levels - 1:
-                    return None
-                else:
-                    child_key_cap = math.ceil((self.key_high_bound - self.key_low_bound + 1) / self.fan_out)
-                    child = math.ceil((rkeyLow - self.key_low_bound + 1) / child_key_cap) - 1
-                    if not self.children:
-                        return None
-                    else:
-                        return self.children[child].read(rkeyLow, rkeyHigh, col_pos)
-
-    # Read the bloom filter and the key/value pairs into memory for compaction
+        meta = files[0][1]
+        candidates = [key for key in read_keys if meta.covers(key)]
+
+        if self.level >= self.total_levels - 1:
+            in_file = [key for key, hit in zip(candidates, meta.bloom_ftr.check_many(candidates)) if hit]
+            num_found = 0
+            if in_file:
+                num_found = self.read_columns_many(in_file, Value.wanted_cols(col_pos), results, version)
+            self.stats.count(self.level, lookups=len(candidates), bloom_checks=len(candidates),
+                             bloom_hits=len(in_file), bloom_false_positives=len(in_file) - num_found)
+            self.check_filter(meta, len(candidates) - num_found, len(in_file) - num_found)
+            return
+
+        # the sorted runs newest first, then the node file, each taking the keys the newer ones did not have
+        remaining = candidates
+        for pos, (filename, meta) in enumerate(files):
+            if not remaining:
+                break
+            in_file = [key for key, hit in zip(remaining, meta.bloom_ftr.check_many(remaining)) if hit]
+            found = dict()
+            if in_file:
+                opened, infile = self.meta_cache.open_file(filename, version)
+                if infile is not None:
+                    with infile:
+                        found = read_node_values(infile, opened, in_file, self.meta_cache.blocks,
+                                                 counted=self.count_block_bytes)
+                results.update(found)
+            self.stats.count(self.level, lookups=len(remaining) if pos == 0 else 0, files_opened=int(bool(in_file)),
+                             lookup_files_opened=int(bool(in_file)), bloom_checks=len(remaining),
+                             bloom_hits=len(in_file), bloom_false_positives=len(in_file) - len(found))
+            self.check_filter(meta, len(remaining) - len(found), len(in_file) - len(found))
+            remaining = [key for key in remaining if key not in found]
+
+        if version is None and self.runs is not runs:
+            # the runs were merged meanwhile, the keys may have moved to the node file
+            self.multi_get(remaining, col_pos, results)
+            return
+
+        # the rest go down, grouped by the child that covers them
+        self.multi_get_children(remaining, col_pos, results, version)
+
+    def multi_get_children(self, read_keys, col_pos, results, version=None):
+        table = self.ranges.table
+        by_child = dict()
+        for key in read_keys:
+            by_child.setdefault(self.child_index(key, version), []).append(key)
+        for ch in by_child:
+            child = self.find_child(ch, version)
+            if child is not None:
+                child.multi_get(by_child[ch], col_pos, results, version)
+
+        missing = [key for key in read_keys if key not in results]
+        if missing and version is None and self.ranges.table is not table:
+            # the children were split or merged meanwhile, the keys may have moved to other children
+            self.multi_get_children(missing, col_pos, results)
+
+    # counts the stored bytes of a data block read from one of the node's files (see stats.py)
+    def count_block_bytes(self, nbytes):
+        self.stats.count(self.level, block_bytes_read=nbytes)
+
+    # counts reads of keys the file does not hold against its bloom filter, and asks for the filter to be rebuilt once
+    # clearly more of them got through than fp_prob allows
+    def check_filter(self, meta, negatives, false_positives):
+        meta.bloom_negatives += negatives
+        meta.bloom_false_positives += false_positives
+        if meta.bloom_negatives < FILTER_SAMPLES or meta.filter_rebuild_asked:
+            return
+
+        # three standard deviations over the expected count, so chance alone hardly ever asks for a rebuild
+        expected = meta.bloom_negatives * self.fp_prob
+        if meta.bloom_false_positives > expected + 3 * math.sqrt(expected) + 1:
+            meta.filter_rebuild_asked = True
+            if self.meta_cache.on_stale_filter is not None:
+                self.meta_cache.on_stale_filter(self, meta)
+
+    # rewrites the node file with a bloom filter built for a false positive probability as much lower as the measured
+    # rate of the current one was too high. Runs on the compactor thread, which does every other node file write
+    def rebuild_filter(self, meta):
+        if self.meta_cache.lookup(self) is not meta:
+            # the file was rewritten since, and the rate of its new filter is measured afresh
+            return
+
+        fp_rate = meta.bloom_false_positives / meta.bloom_negatives
+        # never more than about 10 bits per key over the filter sized for fp_prob
+        self.bloom_fp_prob = max(meta.bloom_ftr.fp_prob * self.fp_prob / fp_rate, self.fp_prob / 100)
+        self.read_whole_file()
+        self.write_to_file()
+        self.stats.count(self.level, bloom_rebuilds=1)
+
+    # gives the node a new key range when its parent splits or merges children. Only nodes without children get one, so
+    # the workspace holds every key of the node
+    def set_range(self, low, high):
+        self.key_low_bound = low
+        self.key_high_bound = high
+        self.ranges = KeyRanges.even(low, high, self.fan_out)
+        self.key_min = next(iter(self.workspace), None)
+        self.key_max = next(reversed(self.workspace), None)
+
+    # removes the files of a node that was merged into its sibling. A node kept for snapshots has none left afterwards
+    def remove_files(self):
+        groups = self.groups_for(None)
+        if not groups and not self.runs:
+            return
+        with self.meta_cache.change() as stamp:
+            for cg in groups:
+                self.meta_cache.remove(self.get_file_name(cg), self)
+            self.drop_runs(stamp)
+            self.earlier_groups = keep_earlier(self.earlier_groups, self.column_groups, stamp)
+            self.column_groups = []
+
+    # Lazily iterate the key/value pairs within [low, high] stored in this node and the nodes below it. Given the
+    # predicates of a query (see zonemap.py), the blocks whose zone maps rule them out are left out, the other pairs
+    # still have to be filtered by the caller
+    def scan(self, low, high, col_pos, version=None, preds=None):
+        # the key fences of the newest file cover every key that ever went through this node, so they prune the whole
+        # subtree
+        files = self.lookup_files(version)
+        meta = files[0][1] if files else None
+        if meta is None or meta.key_min is None or meta.key_max < low or meta.key_min > high:
+            return
+
+        cols = Value.wanted_cols(col_pos)
+        if self.level >= self.total_levels - 1:
+            yield from self.scan_columns(low, high, cols, version, preds)
+            return
+
+        # data in this node is newer than anything below it, and the sorted runs are newest first
+        opened = self.open_files(version)
+        self.stats.count(self.level, files_opened=len(opened))
+        if preds is None:
+            yield from merge_newest([iter_node_range(infile, meta, low, high, cols, self.count_block_bytes)
+                                     for meta, infile in opened] +
+                                    [self.scan_children(low, high, col_pos, version)])
+            return
+
+        with contextlib.ExitStack() as stack:
+            # a file only hides the older versions of the keys in its skipped blocks from the files after it
+            sources, newer = [], []
+            for meta, infile in opened:
+                mm = stack.enter_context(mapped(infile))
+                ranges, skipped = self.matching_ranges(meta, infile, low, high, preds)
+                sources.append(self.unshadowed(iter_node_intervals(mm, meta, ranges, counted=self.count_block_bytes),
+                                               list(newer)))
+                newer.append((mm, meta, skipped))
+            sources.append(self.unshadowed(self.scan_children(low, high, col_pos, version, preds), newer))
+            yield from merge_newest(sources)
+
+    # the key ranges of the blocks within [low, high] whose zone maps do not rule the predicates out, and the positions
+    # of the blocks they do
+    def matching_ranges(self, meta, infile, low, high, preds):
+        zones = read_zones(infile, meta)
+        first, last = max(meta.find_block(low), 0), meta.find_block(high)
+        matching = zones.matching_blocks(preds, first, last)
+        ranges = [block_range(meta, blk, low, high) for blk in matching]
+        skipped = set(range(first, last + 1)) - set(matching)
+        self.stats.count(self.level, query_blocks=max(last - first + 1, 0), query_blocks_skipped=len(skipped))
+        return [key_range for key_range in ranges if key_range is not None], skipped
+
+    # a key in a block left out by a query has a version there that fails the predicates, and hides the older ones
+    # the older files and the children have. The block is only read when an older key passes its bloom filter
+    # newer: (memory map, NodeMeta, positions of the skipped blocks) of every newer file
+    def unshadowed(self, pairs, newer):
+        skipped_keys = dict()
+        for key, val in pairs:
+            for pos, (mm, meta, skipped) in enumerate(newer):
+                blk = meta.find_block(key)
+                if blk in skipped and meta.bloom_ftr.check(key):
+                    if (pos, blk) not in skipped_keys:
+                        skipped_keys[(pos, blk)] = block_keys(mm, meta, blk, self.count_block_bytes)
+                    if key in skipped_keys[(pos, blk)]:
+                        break
+            else:
+                yield key, val
+
+    # last level: the column groups a read for the given columns (None for all) has to open
+    def groups_for(self, cols, version=None):
+        if cols is not None and not cols:
+            # only the keys are wanted, and every group file holds every key of the node
+            return [1]
+        # the layout first: a regrouping records the layout it replaces before swapping in the new one
+        current = self.column_groups
+        layout = value_at(self.earlier_groups, version, current)
+        if not layout:
+            # layout not known in memory (files written by an earlier tree), so every group file there is
+            groups = []
+            while self.has_group(len(groups) + 1, version):
+                groups.append(len(groups) + 1)
+            return groups
+        return [cg for cg, group_cols in enumerate(layout, start=1)
+                if cols is None or any(col in cols for col in group_cols)]
+
+    def has_group(self, column_group, version):
+        if version is None:
+            return os.path.exists(self.get_file_name(column_group))
+        return self.meta_cache.lookup(self, column_group, version) is not None
+
+    # last level: read one key, only opening the files of the column groups holding the wanted columns
+    def read_columns(self, read_key, cols, version=None):
+        self.workload.record(self.file_root, cols)
+
+        parts = []
+        for meta, infile in self.open_groups(cols, version):
+            with infile:
+                part = read_node_value(infile, meta, read_key, self.meta_cache.blocks, cols, self.count_block_bytes)
+            if part is None:
+                # every group file holds every key of the node
+                return None
+            parts.append(part)
+        return Value.stitch(parts)
+
+    # last level: read many keys, every wanted column group file being opened and searched once
+    # returns the number of keys found
+    def read_columns_many(self, read_keys, cols, results, version=None):
+        self.workload.record(self.file_root, cols, len(read_keys))
+
+        rows = dict()
+        for cg, (meta, infile) in enumerate(self.open_groups(cols, version)):
+            with infile:
+                found = read_node_values(infile, meta, read_keys, self.meta_cache.blocks, cols, self.count_block_bytes)
+            for key in read_keys:
+                # every group file holds every key of the node, so the first group decides what exists
+                if key in found and (cg == 0 or key in rows):
+                    rows.setdefault(key, []).append(found[key])
+        for key in rows:
+            results[key] = Value.stitch(rows[key])
+        return len(rows)
+
+    # last level: walk the wanted column group files in lockstep and stitch their rows together. Given the predicates
+    # of a query, only the key ranges no group file's zone maps rule out are walked
+    def scan_columns(self, low, high, cols, version=None, preds=None):
+        rows = 0
+        with contextlib.ExitStack() as stack:
+            groups = [(meta, infile, stack.enter_context(mapped(infile)))
+                      for meta, infile in self.open_groups(cols, version, lookup=False)]
+            ranges = [(low, high)]
+            if preds is not None:
+                for meta, infile, _ in groups:
+                    ranges = intersect_ranges(ranges, self.matching_ranges(meta, infile, low, high, preds)[0])
+
+            group_iters = [iter_node_intervals(mm, meta, ranges, cols, self.count_block_bytes)
+                           for meta, _, mm in groups]
+            try:
+                for parts in zip(*group_iters):
+                    rows += 1
+                    yield parts[0][0], Value.stitch([part for _, part in parts])
+            finally:
+                self.workload.record(self.file_root, cols, rows)
+
+    # last level: open the wanted group files all at once, so a regrouping in between cannot mix two layouts
+    # lookup: whether the files are opened for a point read (see stats.py)
+    def open_groups(self, cols, version=None, lookup=True):
+        with self.meta_cache.lock:
+            opened = [self.meta_cache.open(self, cg, version) for cg in self.groups_for(cols, version)]
+        opened = [(meta, infile) for meta, infile in opened if meta is not None]
+        self.stats.count(self.level, files_opened=len(opened), lookup_files_opened=len(opened) if lookup else 0)
+        return opened
+
+    # upper levels: (file name, NodeMeta) of the sorted runs newest first and then of the node file, the ones there are
+    def lookup_files(self, version=None):
+        names = self.run_names(version) + [self.get_file_name()]
+        found = [(name, self.meta_cache.lookup_file(name, version)) for name in names]
+        return [(name, meta) for name, meta in found if meta is not None]
+
+    # upper levels: open the sorted runs and the node file all at once, so a merge of the runs in between cannot leave
+    # keys out. The files are opened newest first
+    def open_files(self, version=None):
+        with self.meta_cache.lock:
+            names = self.run_names(version) + [self.get_file_name()]
+            opened = [self.meta_cache.open_file(name, version) for name in names]
+        return [(meta, infile) for meta, infile in opened if meta is not None]
+
+    # Read the key/value pairs of the node files into the workspace, for a rewrite of the whole node
     def read_whole_file(self):
+        self.workspace = dict(self.merged_with_files(()))
+
+    # the key/value pairs pushed into the node merged with the ones its files hold, in key order and only the newest
+    # version of every key. Every file is sorted already, so this is a k-way merge rather than a sort. The key fences
+    # are set to the files' ones
+    # pairs: iterable of (key, value) in key order, newer than the files
+    def merged_with_files(self, pairs):
+        if self.level >= self.total_levels - 1:
+            return merge_newest([pairs, self.read_column_groups().items()])
+
+        # the sorted runs are newer than the node file, and newest first
+        stored = []
         filename = self.get_file_name()
-        if os.path.exists(filename):
-            with open(filename, "rb") as infile:
-                alldata = infile.read()
-            length = int.from_bytes(alldata[:4], 'big')
-            self.bloom_ftr = pickle.loads(alldata[4:(4+length)])
-            cg_map_len = int.from_bytes(alldata[(4+length):(8+length)], 'big')
-            self.children_cg_metadata = pickle.loads(alldata[(8+length):(8+length+cg_map_len)])
-            self.workspace = pickle.loads(alldata[(8+length+cg_map_len):])
+        for name in self.run_names() + [filename]:
+            if name == filename and not os.path.exists(filename):
+                continue
+            meta, cg_metadata, file_pairs = read_node_file(name)
+            if name == filename:
+                self.children_cg_metadata = cg_metadata
+            if meta.key_min is not None:
+                self.key_min = meta.key_min if self.key_min is None else min(self.key_min, meta.key_min)
+                self.key_max = meta.key_max if self.key_max is None else max(self.key_max, meta.key_max)
+            stored.append(file_pairs.items())
+        return merge_newest([pairs] + stored)
+
+    # last level: read every column group file and stitch the rows back together
+    # returns dict of the key/value pairs in key order
+    def read_column_groups(self):
+        filenames = [self.get_file_name(cg) for cg in self.groups_for(None)]
+        meta, layout, rows = self.codec_pool.read_groups([filename for filename in filenames
+                                                          if os.path.exists(filename)])
+        if meta is not None:
+            self.key_min = meta.key_min
+            self.key_max = meta.key_max
+
+        # a lone group without columns only means the node held no column yet
+        if not self.column_groups and layout != [[]]:
+            self.column_groups = layout
+        return rows
+
+    # add a key/value pair into the workspace, keeping the key fences in step. Keys are put in key order, after every
+    # key the workspace holds. The last level has nothing below it for a tombstone to hide, so there a tombstone only
+    # removes its key
+    def put(self, key, value):
+        if value.is_tombstone and self.level >= self.total_levels - 1:
+            self.workspace.pop(key, None)
+        else:
+            self.workspace[key] = value
+
+        if self.key_min is None or key < self.key_min:
+            self.key_min = key
+        if self.key_max is None or key > self.key_max:
+            self.key_max = key
 
     # write the content of the node to a file
     def write_to_file(self):
-        bf_bytes = self.bloom_ftr.prepare_bloom_filter_to_write()
-        cg_bytes = self.children_cg_metadata.prepare_column_group_map_to_write()
-        obj_data_bytes = pickle.dumps(self.workspace)
+        self.bloom_ftr = self.build_filter(list(self.workspace))
 
-        data_to_write = bf_bytes + cg_bytes + obj_data_bytes
-
-        with open(self.get_file_name(), "wb") as outfile:
-            outfile.write(data_to_write)
-        outfile.close()
+        if self.level >= self.total_levels - 1:
+            self.write_column_groups()
+        else:
+            self.write_node(self.get_file_name(), self.workspace)
 
-        # TODO: check if clearing is not needed. If not then do not for performance reason
-        self.bloom_ftr.clear()
+        # the keys are on disk now, and the next compaction merges them in from the file again (see merged_with_files)
         self.workspace.clear()
 
+    # the filter is sized for the keys the file holds now. Keys crowding into some blocks can leave it above the false
+    # positive probability it was sized for, it is then built again with more bits
+    def build_filter(self, keys):
+        target = self.bloom_fp_prob
+        bloom = BloomFilter.build(keys, target)
+        for _ in range(FILTER_RETRIES):
+            estimate = bloom.estimated_fp_rate()
+            if estimate <= self.fp_prob:
+                break
+            target *= self.fp_prob / estimate
+            bloom = BloomFilter.build(keys, target)
+        return bloom
+
+    def write_node(self, filename, workspace):
+        Path(os.path.dirname(filename)).mkdir(parents=True, exist_ok=True)
+        meta = write_node_file(filename + '.tmp', workspace.items(), self.bloom_ftr, self.children_cg_metadata,
+                               self.key_min, self.key_max, self.compression[self.level])
+
+        # swap the file in and refresh the cached metadata, so reads never have to re-read the filter from the file.
+        # The file holds the keys of the sorted runs now, so they go with the same change
+        with self.meta_cache.change() as stamp:
+            self.meta_cache.install(filename + '.tmp', filename, meta, self)
+            self.drop_runs(stamp)
+        self.stats.count(self.level, compaction_bytes_written=meta.file_bytes)
+
+    # tiered levels: write the key/value pairs pushed into this node, in key order, as a new sorted run, reading
+    # nothing on disk
+    def write_run(self, pairs):
+        # the fences of a node opened from the manifest are in its newest file
+        if self.key_min is None:
+            found = self.lookup_files()
+            if found:
+                self.key_min, self.key_max = found[0][1].key_min, found[0][1].key_max
+
+        run = dict()
+        for key, value in pairs:
+            run[key] = value
+            if self.key_min is None or key < self.key_min:
+                self.key_min = key
+            if self.key_max is None or key > self.key_max:
+                self.key_max = key
+
+        # every run carries the fences of the whole node, so the newest one prunes the subtree like the node file does
+        filename = self.get_run_name(self.next_run)
+        Path(os.path.dirname(filename)).mkdir(parents=True, exist_ok=True)
+        meta = write_node_file(filename + '.tmp', run.items(), self.build_filter(list(run)),
+                               self.children_cg_metadata, self.key_min, self.key_max, self.compression[self.level])
+
+        # the run is listed before it is installed, so the manifest record of the change lists it
+        with self.meta_cache.change() as stamp:
+            self.earlier_runs = keep_earlier(self.earlier_runs, self.runs, stamp)
+            self.runs = [self.next_run] + self.runs
+            self.next_run += 1
+            self.meta_cache.install(filename + '.tmp', filename, meta, self)
+        self.stats.count(self.level, compaction_bytes_written=meta.file_bytes, runs_written=1)
+
+    # removes the sorted runs, within a change (see MetaCache.change) that put their keys elsewhere
+    def drop_runs(self, stamp):
+        if not self.runs:
+            return
+        for name in self.run_names():
+            self.meta_cache.remove(name, self)
+        self.earlier_runs = keep_earlier(self.earlier_runs, self.runs, stamp)
+        self.runs = []
+
+    # last level: split the rows by column group and write every group to its own file
+    def write_column_groups(self):
+        # columns not seen before get new groups of their own
+        known = set(col for group_cols in self.column_groups for col in group_cols)
+        new_cols = sorted(set(col for val in self.workspace.values() for col in val.ids) - known)
+        layout = self.column_groups + ColumnGroup.split_columns(new_cols, self.cols_per_group)
+
+        # the node is rewritten anyway, so this is when the columns can be regrouped for the observed reads
+        regrouped = self.workload.regroup(self.file_root, layout, self.column_bytes(), len(self.workspace))
+        if regrouped is not None:
+            layout = regrouped
+
+        # a node without any column yet still needs its first file for the keys, bloom filter and fences
+        groups = layout or [[]]
+        filenames = [self.get_file_name(cg) for cg in range(1, len(groups) + 1)]
+        for filename in filenames:
+            Path(os.path.dirname(filename)).mkdir(parents=True, exist_ok=True)
+        metas = self.codec_pool.write_groups([filename + '.tmp' for filename in filenames], self.workspace, groups,
+                                             self.bloom_ftr, self.children_cg_metadata, self.key_min, self.key_max,
+                                             self.compression[self.level])
+        written = list(zip(filenames, metas))
+
+        # swap all group files and the layout together, dropping the groups a regrouping left over
+        with self.meta_cache.change() as stamp:
+            for filename, meta in written:
+                self.meta_cache.install(filename + '.tmp', filename, meta, self)
+            for cg in range(len(written) + 1, len(self.column_groups) + 1):
+                self.meta_cache.remove(self.get_file_name(cg), self)
+            self.earlier_groups = keep_earlier(self.earlier_groups, self.column_groups, stamp)
+            self.column_groups = layout
+        self.stats.count(self.level, compaction_bytes_written=sum(meta.file_bytes for _, meta in written))
+
+    # last level: average bytes per row of every column in the workspace
+    def column_bytes(self):
+        col_bytes = dict()
+        for val in self.workspace.values():
+            for col, size in val.col_sizes():
+                col_bytes[col] = col_bytes.get(col, 0) + size
+        return {col: col_bytes[col] / len(self.workspace) for col in col_bytes}
+
     def compaction_f2f(self):
         if self.level >= self.total_levels - 1:
             return
 
-        for child in self.children:
-            child.read_whole_file()
+        start = time.perf_counter()
+        remove_retired(self)
 
-        child_key_cap = math.ceil((self.key_high_bound - self.key_low_bound + 1) / self.fan_out)
+        # only the children the keys land in are read and rewritten
+        dirty = dict()
         for key in self.workspace:
-            kiddo = math.ceil((key - self.key_low_bound + 1) / child_key_cap) - 1
-            if key not in self.children[kiddo].workspace:
-                self.children[kiddo].bloom_ftr.add(str(key))
-            self.children[kiddo].workspace[key] = self.workspace[key]
-
-            if len(self.children[kiddo].workspace) >= self.children[kiddo].storage_capacity:
-                self.children[kiddo].compaction_f2f()
+            dirty.setdefault(self.child_index(key), []).append(key)
+
+        self.ranges.record({ch: len(dirty[ch]) for ch in dirty})
+        pending = set(dirty)
+        for kiddo in sorted(dirty):
+            child = self.get_child(kiddo)
+            # the child's level decides how it takes the keys (see compaction.py)
+            piece = child.receive(self, ((key, self.workspace[key]) for key in dirty[kiddo]),
+                                  functools.partial(split_if_wanted, self, child, pending))
+            pending.discard(kiddo)
+            for node in [child] if piece is None else [child, piece]:
+                if node.column_groups:
+                    self.children_cg_metadata.set_child_groups(node.key_range_order, node.column_groups)
 
         # compact is done so clear myself
+        num_keys = len(self.workspace)
         self.workspace.clear()
-        for child in self.children:
-            child.write_to_file()
 
-    @classmethod
-    def read_data(cls, filename, start_length, read_key):
-        with open(filename, "rb") as infile:
-            indata = infile.read()
-
-        cgmap, cgmap_len = ColumnGroup.get_column_groups_from_file(indata, start_length)
-        obj_data = pickle.loads(indata[(start_length+4+cgmap_len):])
-
-        if obj_data and obj_data[read_key]:
-            return obj_data[read_key]
-        else:
+        seconds = time.perf_counter() - start
+        self.stats.count(self.level, compactions=1, compaction_seconds=seconds)
+        if self.stats.hooks:
+            self.stats.emit('compaction', level=self.level, seconds=seconds, keys=num_keys)
+
+    # takes the key/value pairs its parent pushes into it the way the compaction policy of its level does
+    # split: function splitting the node if it is to be split, see LeveledPolicy.receive
+    def receive(self, parent, pairs, split):
+        return self.policies[self.level].receive(parent, self, pairs, split)
+
+    def read_data(self, filename, read_key, version=None):
+        # open the file and its metadata together, compaction may have replaced both since the bloom filter check. A
+        # sorted run may have been merged into the node file meanwhile
+        meta, infile = self.meta_cache.open_file(filename, version)
+        if infile is None:
             return None
+        self.stats.count(self.level, files_opened=1, lookup_files_opened=1)
+        with infile:
+            return read_node_value(infile, meta, read_key, self.meta_cache.blocks, counted=self.count_block_bytes)
 
-    def get_file_name(self):
-        return self.file_root + '/data.log'
+    def get_file_name(self, column_group=1):
+        if column_group == self.column_group:
+            return self.file_root + '/data.log'
+        return self.file_root[:self.file_root.rindex('.cg-')] + '.cg-' + str(column_group) + '/data.log'
 
+    def get_run_name(self, run):
+        return self.file_root + '/run-' + str(run) + '.log'
 
-if __name__ == '__main__':
-    n = Node(1, 10, 100, 0, 1, 1, 8, '/Users/hollycasaletto', 0.05)
-    n.read('twitter', 100)
-    n.read('happy', 100)
\ No newline at end of file
+    # the file names of the sorted runs as of the version, newest first
+    def run_names(self, version=None):
+        return [self.get_run_name(run) for run in value_at(self.earlier_runs, version, self.runs)]
@@ -0,0 +1,604 @@
+import bisect
+import contextlib
+import mmap
+import os
+import struct
+from array import array
+from blockcache import block_bytes
+from blockcodec import ColumnBlock, encode_columns, pack_block, unpack_block
+from bloomfilter import BloomFilter
+from columngroup import ColumnGroup
+from value import Value
+from zonemap import ZoneMap, decode_zone_maps, encode_zone_maps
+
+'''
+ $$$$ Node file layout (data.log):
+
+    | header | data block 0 | data block 1 | ... | block index | bloom filter | column groups | zone maps | footer |
+
+  - header: magic, format version and the block size the file was cut with. A file of another version is not read.
+  - data blocks: the key/value pairs of the node sorted by key, cut into blocks of at most BLOCK_SIZE bytes before
+    compression (a single record larger than that gets a block of its own). Every block may be compressed and the
+    last level stores its blocks column by column (see blockcodec.py). Otherwise a block holds records: the key and
+    the value length packed as fixed-width integers followed by the encoded value (see Value.encode), so a block can
+    be scanned for a key without decoding any other value. The records after the first one of a block leave out their
+    column ids when they hold the same columns as the first one.
+  - block index: one fixed-width (first key, offset, length) entry per data block, binary-searched on lookup.
+  - bloom filter and children column groups meta data (see columngroup.py), each with its 4 bytes length prefix.
+  - zone maps: per column min, max and null count of every data block (see zonemap.py), read only by queries.
+  - footer: fixed-width, records where the block index, bloom filter, column groups and zone maps start, the number of
+    keys and the key fences of the node. A reader goes to the footer first.
+
+'''
+
+MAGIC = b'DSNF'
+VERSION = 6
+BLOCK_SIZE = 4096
+
+HEADER = struct.Struct('>4sHI')
+RECORD = struct.Struct('>qI')
+INDEX_ENTRY = struct.Struct('>qQI')
+FOOTER = struct.Struct('>QIQIQIQIQqq4s')
+
+
+class NodeMeta(object):
+    def __init__(self, bloom_ftr, first_keys, block_offsets, block_lengths, num_keys, key_min, key_max, location):
+        # the bloom filter of the keys in the node file
+        self.bloom_ftr = bloom_ftr
+
+        # the sparse block index: first key, file offset and length of every data block
+        self.first_keys = first_keys
+        self.block_offsets = block_offsets
+        self.block_lengths = block_lengths
+
+        # number of keys stored in the file
+        self.num_keys = num_keys
+
+        # the smallest and largest key ever written into the node (key fences)
+        self.key_min = key_min
+        self.key_max = key_max
+
+        # where the file keeps its metadata, as recorded in the footer: (block index offset, number of index entries,
+        # bloom filter offset, bloom filter length, column groups offset, column groups length, zone maps offset, zone
+        # maps length)
+        self.location = location
+
+        # size of the whole file
+        zone_offset, zone_len = location[6:]
+        self.file_bytes = zone_offset + zone_len + FOOTER.size
+
+        # the zone maps of the data blocks (see zonemap.FileZones), read on the first query
+        self.zones = None
+
+        # set by MetaCache, tells the block cache apart the files that ever had this name
+        self.generation = 0
+
+        # reads of keys the file does not hold that were checked against its bloom filter, and how many of them the
+        # filter let through (see Node.check_filter)
+        self.bloom_negatives = 0
+        self.bloom_false_positives = 0
+
+        # whether a rebuild of the bloom filter was asked for already
+        self.filter_rebuild_asked = False
+
+    def covers(self, key):
+        """
+        False means the key is definitely neither in this node nor in any node below it
+        """
+        return self.key_min is not None and self.key_min <= key <= self.key_max
+
+    def find_block(self, key):
+        """
+        Binary-searches the block index
+        :return: position of the only block that can hold the key, or -1
+        """
+        return bisect.bisect_right(self.first_keys, key) - 1
+
+
+def write_node_file(filename, pairs, bloom_ftr, cg_metadata, key_min, key_max, codec='none', columnar=False,
+                    covered=None):
+    """
+    Writes the node content in the block-indexed layout. Node files are replaced, never rewritten in place, so this
+    is called with a temporary name which MetaCache.install then moves over the live file.
+    :param pairs: iterable of the (key, value) pairs of the node in key order, cut into blocks as they come (a
+                  compaction merges sorted runs, so they are never sorted again here)
+    :param codec: compression of the data blocks, one of blockcodec.CODECS
+    :param columnar: store the data blocks column by column (see blockcodec.py)
+    :param covered: the columns the values were projected on (a last level column group), None if they hold all
+    :return: NodeMeta describing the file just written
+    """
+    out = bytearray(HEADER.pack(MAGIC, VERSION, BLOCK_SIZE))
+    first_keys, block_offsets, block_lengths, zones = [], [], [], []
+    num_keys = 0
+
+    cut = _cut_column_blocks if columnar else _cut_row_blocks
+    for block_first_key, raw, vals in cut(pairs):
+        stored = pack_block(raw, codec, columnar)
+        first_keys.append(block_first_key)
+        block_offsets.append(len(out))
+        block_lengths.append(len(stored))
+        zones.append(ZoneMap.build(vals))
+        num_keys += len(vals)
+        out += stored
+
+    index_offset = len(out)
+    for entry in zip(first_keys, block_offsets, block_lengths):
+        out += INDEX_ENTRY.pack(*entry)
+
+    bloom_offset = len(out)
+    bf_bytes = bloom_ftr.prepare_bloom_filter_to_write()
+    out += bf_bytes
+
+    cg_offset = len(out)
+    cg_bytes = cg_metadata.prepare_column_group_map_to_write()
+    out += cg_bytes
+
+    zone_offset = len(out)
+    zone_bytes = encode_zone_maps(zones, covered)
+    out += zone_bytes
+
+    # an empty key range is written as low > high
+    fence_low, fence_high = (0, -1) if key_min is None else (key_min, key_max)
+    location = (index_offset, len(first_keys), bloom_offset, len(bf_bytes), cg_offset, len(cg_bytes), zone_offset,
+                len(zone_bytes))
+    out += FOOTER.pack(*location, num_keys, fence_low, fence_high, MAGIC)
+
+    with open(filename, "wb") as outfile:
+        outfile.write(out)
+        # the write-ahead log of the flushed writes is deleted once the flush is done, so this has to be on disk
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+    return NodeMeta(bloom_ftr, first_keys, block_offsets, block_lengths, num_keys, key_min, key_max, location)
+
+
+def write_group_files(filenames, workspace, layout, bloom_ftr, cg_metadata, key_min, key_max, codec='none'):
+    """
+    Writes one columnar file per column group of a last level node, every one holding every key with only the
+    columns of its group (see write_node_file, the files get the temporary names)
+    :param filenames: file name of every group, in the order of layout
+    :param workspace: dict of the key/value pairs of the node, in key order
+    :param layout: list of the column ids of every group
+    :return: list of the NodeMeta of every file
+    """
+    metas = []
+    for filename, group_cols in zip(filenames, layout):
+        wanted = set(group_cols)
+        group_pairs = ((key, val.project(wanted)) for key, val in workspace.items())
+        metas.append(write_node_file(filename, group_pairs, bloom_ftr, cg_metadata, key_min, key_max, codec,
+                                     columnar=True, covered=wanted))
+    return metas
+
+
+def read_group_files(filenames):
+    """
+    Reads every column group file of a last level node and stitches the rows back together
+    :return: NodeMeta of the first file (None without files), list of the column ids of every group, dict of all
+             key/value pairs in key order
+    """
+    first = None
+    rows = dict()
+    layout = []
+    for filename in filenames:
+        meta, _, group_ws = read_node_file(filename)
+        if first is None:
+            first = meta
+
+        group_cols = set()
+        for key in group_ws:
+            rows.setdefault(key, []).append(group_ws[key])
+            group_cols.update(group_ws[key].ids)
+        layout.append(sorted(group_cols))
+    return first, layout, {key: Value.stitch(rows[key]) for key in rows}
+
+
+def pack_records(workspace):
+    """
+    :return: the workspace as a few flat arrays, how it crosses over to a worker process (pickling every Value on its
+             own costs more than encoding a file of them)
+    """
+    keys, num_cols, counts, ids, offsets = array('q'), array('I'), array('I'), array('i'), array('I')
+    data = []
+    for key, val in workspace.items():
+        keys.append(key)
+        num_cols.append(val.num_cols)
+        counts.append(len(val.ids))
+        ids.extend(val.ids)
+        offsets.extend(val.offsets)
+        data.append(val.data)
+    return keys, num_cols, counts, ids, offsets, b''.join(data)
+
+
+def unpack_records(packed):
+    keys, num_cols, counts, ids, offsets, data = packed
+    workspace = dict()
+    pos = data_pos = 0
+    for key, length, count in zip(keys, num_cols, counts):
+        data_len = offsets[pos + count - 1] if count else 0
+        workspace[key] = Value.from_parts(ids[pos:(pos + count)], offsets[pos:(pos + count)],
+                                          data[data_pos:(data_pos + data_len)], length)
+        pos += count
+        data_pos += data_len
+    return workspace
+
+
+def _read_tail(infile):
+    """
+    Checks the header, then reads the footer and everything it points at (block index, bloom filter, column groups)
+    :return: NodeMeta, column group bytes with their length prefix
+    """
+    header = infile.read(HEADER.size)
+    if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+        raise ValueError(infile.name + ' is not a node file')
+    version = HEADER.unpack(header)[1]
+    if version != VERSION:
+        # the layout of the blocks, the footer and the value encoding all change between versions
+        raise ValueError('%s is a version %d node file, version %d is read' % (infile.name, version, VERSION))
+
+    infile.seek(0, 2)
+    infile.seek(infile.tell() - FOOTER.size)
+    footer = FOOTER.unpack(infile.read(FOOTER.size))
+    location, (num_keys, fence_low, fence_high, magic) = footer[:8], footer[8:]
+    if magic != MAGIC:
+        raise ValueError(infile.name + ' is not a node file')
+
+    key_min, key_max = (None, None) if fence_low > fence_high else (fence_low, fence_high)
+    return _read_located(infile, location, num_keys, key_min, key_max)
+
+
+def _read_located(infile, location, num_keys, key_min, key_max):
+    """
+    Reads the block index, bloom filter and column groups at a known location, without going to the footer
+    :return: NodeMeta, column group bytes with their length prefix
+    """
+    index_offset, index_count, bloom_offset, bloom_len, cg_offset, cg_len = location[:6]
+    infile.seek(index_offset)
+    tail = infile.read(cg_offset + cg_len - index_offset)
+
+    first_keys, block_offsets, block_lengths = [], [], []
+    for first_key, offset, length in INDEX_ENTRY.iter_unpack(tail[:index_count * INDEX_ENTRY.size]):
+        first_keys.append(first_key)
+        block_offsets.append(offset)
+        block_lengths.append(length)
+
+    bloom_start = bloom_offset - index_offset
+    bloom_ftr = BloomFilter.from_bytes(tail[(bloom_start + 4):(bloom_start + bloom_len)])
+
+    cg_start = cg_offset - index_offset
+    cg_bytes = tail[cg_start:(cg_start + cg_len)]
+
+    meta = NodeMeta(bloom_ftr, first_keys, block_offsets, block_lengths, num_keys, key_min, key_max, location)
+    return meta, cg_bytes
+
+
+def read_node_meta(filename):
+    """
+    Reads only the metadata of a node file, none of its data blocks, found through the footer
+    """
+    with open(filename, "rb") as infile:
+        meta, _ = _read_tail(infile)
+    return meta
+
+
+def read_node_file(filename):
+    """
+    Reads the whole node file, used by compaction
+    :return: NodeMeta, children column groups meta data, dict of all key/value pairs in key order (the blocks are
+             read in file order)
+    """
+    with open(filename, "rb") as infile:
+        meta, cg_bytes = _read_tail(infile)
+        infile.seek(0)
+        alldata = infile.read(meta.block_offsets[-1] + meta.block_lengths[-1] if meta.first_keys else 0)
+
+    cg_metadata, _ = ColumnGroup.get_column_groups_from_file(cg_bytes, 0)
+
+    workspace = dict()
+    for blk in range(len(meta.first_keys)):
+        workspace.update(_block(alldata, meta, blk).items())
+
+    return meta, cg_metadata, workspace
+
+
+def _in_order(pairs):
+    last = None
+    for key, val in pairs:
+        if last is not None and key <= last:
+            raise ValueError('node file keys are not in order: %d after %d' % (key, last))
+        last = key
+        yield key, val
+
+
+def _cut_row_blocks(pairs):
+    """
+    Cuts the records, in key order, into blocks of at most BLOCK_SIZE bytes (before compression)
+    :return: list of (first key, encoded block, list of the values in the block)
+    """
+    blocks = []
+    block = bytearray()
+    block_first_key = None
+    schema = None
+    vals = []
+    for key, val in _in_order(pairs):
+        val_bytes = val.encode(schema)
+        if block and len(block) + RECORD.size + len(val_bytes) > BLOCK_SIZE:
+            blocks.append((block_first_key, bytes(block), vals))
+            block = bytearray()
+            vals = []
+        if not block:
+            # the first record of a block always carries its column ids
+            block_first_key = key
+            schema = val.ids
+            val_bytes = val.encode()
+        block += RECORD.pack(key, len(val_bytes))
+        block += val_bytes
+        vals.append(val)
+    if block:
+        blocks.append((block_first_key, bytes(block), vals))
+    return blocks
+
+
+def _cut_column_blocks(pairs):
+    """
+    Cuts the rows, in key order, into columnar blocks holding about BLOCK_SIZE bytes of values each
+    :return: list of (first key, encoded block, list of the values in the block)
+    """
+    blocks = []
+    rows = []
+    size = 0
+    for key, val in _in_order(pairs):
+        row_size = RECORD.size + len(val.data) + 4 * len(val.ids)
+        if rows and size + row_size > BLOCK_SIZE:
+            blocks.append((rows[0][0], encode_columns(rows), [val for _, val in rows]))
+            rows = []
+            size = 0
+        rows.append((key, val))
+        size += row_size
+    if rows:
+        blocks.append((rows[0][0], encode_columns(rows), [val for _, val in rows]))
+    return blocks
+
+
+def _block_records(buf, pos, end):
+    while pos < end:
+        key, val_len = RECORD.unpack_from(buf, pos)
+        pos += RECORD.size
+        yield key, buf[pos:(pos + val_len)]
+        pos += val_len
+
+
+class RowBlock(object):
+    """
+    A data block of records, the values being decoded only for the keys a read wants
+    """
+    def __init__(self, raw):
+        self.raw = raw
+
+        # the column ids of the first record, the ones the other records may leave out
+        self.schema = None
+
+    def decode(self, val_bytes, cols=None):
+        if cols is not None and not cols:
+            # only the keys are wanted
+            return Value.decode_empty(val_bytes)
+        if self.schema is None:
+            _, val_len = RECORD.unpack_from(self.raw, 0)
+            self.schema = Value.decode(self.raw[RECORD.size:(RECORD.size + val_len)]).ids
+        return Value.decode(val_bytes, self.schema)
+
+    def get(self, read_key, cols=None):
+        for key, val_bytes in _block_records(self.raw, 0, len(self.raw)):
+            if key == read_key:
+                return self.decode(val_bytes)
+            if key > read_key:
+                break
+        return None
+
+    def get_many(self, read_keys, cols=None):
+        """
+        :param read_keys: sorted keys
+        """
+        found = dict()
+        pos = 0
+        for key, val_bytes in _block_records(self.raw, 0, len(self.raw)):
+            while pos < len(read_keys) and read_keys[pos] < key:
+                pos += 1
+            if pos == len(read_keys):
+                break
+            if key == read_keys[pos]:
+                found[key] = self.decode(val_bytes)
+                pos += 1
+        return found
+
+    def keys(self):
+        return [key for key, _ in _block_records(self.raw, 0, len(self.raw))]
+
+    def items(self, low=None, high=None, cols=None):
+        for key, val_bytes in _block_records(self.raw, 0, len(self.raw)):
+            if high is not None and key > high:
+                return
+            if low is None or key >= low:
+                yield key, self.decode(val_bytes, cols)
+
+
+def _block(buf, meta, blk, counted=None):
+    """
+    :param buf: the node file content (or a memory map of it)
+    :param counted: function told the stored bytes of the block, None not to count them
+    :return: the decompressed data block, a RowBlock or a ColumnBlock
+    """
+    offset = meta.block_offsets[blk]
+    if counted is not None:
+        counted(meta.block_lengths[blk])
+    columnar, raw = unpack_block(buf[offset:(offset + meta.block_lengths[blk])])
+    return ColumnBlock(raw) if columnar else RowBlock(raw)
+
+
+class DecodedRows(object):
+    """
+    A row block decoded whole, the way the block cache keeps it: its values are decoded with all their columns anyway
+    """
+    def __init__(self, block):
+        self.values = dict(block.items())
+
+    @property
+    def nbytes(self):
+        return block_bytes(self.values)
+
+    def get(self, read_key, cols=None):
+        return self.values.get(read_key)
+
+    def get_many(self, read_keys, cols=None):
+        return {key: self.values[key] for key in read_keys if key in self.values}
+
+
+def _cached_block(infile, meta, blk, cache, counted=None):
+    """
+    :return: one data block, read once and then served from the block cache: a ColumnBlock, still decoding only the
+             columns a read wants, or the DecodedRows of a row block
+    """
+    cache_key = (infile.name, meta.generation, blk)
+    block = cache.get(cache_key)
+    if block is None:
+        infile.seek(meta.block_offsets[blk])
+        stored = infile.read(meta.block_lengths[blk])
+        if counted is not None:
+            counted(len(stored))
+        columnar, raw = unpack_block(stored)
+        block = ColumnBlock(raw) if columnar else DecodedRows(RowBlock(raw))
+        cache.put(cache_key, block, block.nbytes)
+    return block
+
+
+def read_node_value(infile, meta, read_key, cache=None, cols=None, counted=None):
+    """
+    Looks one key up: binary search of the block index, then a search of the one candidate block
+    :param infile: the node file opened together with meta (see MetaCache.open)
+    :param cache: BlockCache to take the block from, None to read it from the file
+    :param cols: the columns wanted, None for all. Columnar blocks only decode these, other values may hold more.
+    :param counted: function told the stored bytes of every block read from the file (see _block)
+    :return: the value, or None if the file does not hold the key
+    """
+    blk = meta.find_block(read_key)
+    if blk < 0:
+        return None
+    if cache is not None:
+        return _cached_block(infile, meta, blk, cache, counted).get(read_key, cols)
+
+    with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return _block(mm, meta, blk, counted).get(read_key, cols)
+
+
+def read_node_values(infile, meta, read_keys, cache=None, cols=None, counted=None):
+    """
+    Looks many keys up in one pass: every candidate block is decoded at most once
+    :param infile: the node file opened together with meta (see MetaCache.open)
+    :param cache: BlockCache to take the blocks from, None to read them from the file
+    :param cols: the columns wanted, None for all. Columnar blocks only decode these, other values may hold more.
+    :param counted: function told the stored bytes of every block read from the file (see _block)
+    :return: dict of the keys found and their values
+    """
+    by_block = dict()
+    for key in sorted(set(read_keys)):
+        blk = meta.find_block(key)
+        if blk >= 0:
+            by_block.setdefault(blk, []).append(key)
+
+    found = dict()
+    if cache is not None:
+        for blk in by_block:
+            found.update(_cached_block(infile, meta, blk, cache, counted).get_many(by_block[blk], cols))
+        return found
+
+    with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for blk in by_block:
+            found.update(_block(mm, meta, blk, counted).get_many(by_block[blk], cols))
+    return found
+
+
+def iter_node_range(infile, meta, low, high, cols=None, counted=None):
+    """
+    Lazily yields the key/value pairs of a node file within [low, high] in key order, decoding only the blocks
+    the range overlaps. The file is closed once the iteration ends.
+    :param infile: the node file opened together with meta (see MetaCache.open)
+    :param cols: the columns wanted, None for all. Columnar blocks only decode these, other values may hold more.
+    :param counted: function told the stored bytes of every block read (see _block)
+    """
+    with mapped(infile) as mm:
+        yield from iter_node_intervals(mm, meta, [(low, high)], cols, counted)
+
+
+@contextlib.contextmanager
+def mapped(infile):
+    """
+    Memory maps an open node file, closing both afterwards
+    """
+    with infile:
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def iter_node_intervals(buf, meta, intervals, cols=None, counted=None):
+    """
+    Lazily yields the key/value pairs of a node file with keys in any of the intervals in key order, decoding every
+    block they overlap once
+    :param buf: the node file content (or a memory map of it)
+    :param intervals: sorted, disjoint list of (low, high) key ranges
+    :param counted: function told the stored bytes of every block read (see _block)
+    """
+    block, block_pos = None, -1
+    for low, high in intervals:
+        blk = max(meta.find_block(low), 0)
+        while blk < len(meta.first_keys) and meta.first_keys[blk] <= high:
+            if blk != block_pos:
+                block, block_pos = _block(buf, meta, blk, counted), blk
+            yield from block.items(low, high, cols)
+            blk += 1
+
+
+def block_range(meta, blk, low, high):
+    """
+    :return: the part of [low, high] the data block can hold keys of, None if none
+    """
+    block_low = max(low, meta.first_keys[blk])
+    block_high = high if blk + 1 == len(meta.first_keys) else min(high, meta.first_keys[blk + 1] - 1)
+    return (block_low, block_high) if block_low <= block_high else None
+
+
+def intersect_ranges(ranges, others):
+    """
+    :param ranges: sorted, disjoint list of (low, high) key ranges, and so others
+    :return: sorted, disjoint list of the key ranges in both
+    """
+    both = []
+    pos = other_pos = 0
+    while pos < len(ranges) and other_pos < len(others):
+        low = max(ranges[pos][0], others[other_pos][0])
+        high = min(ranges[pos][1], others[other_pos][1])
+        if low <= high:
+            both.append((low, high))
+        # the range ending first overlaps nothing further
+        if ranges[pos][1] < others[other_pos][1]:
+            pos += 1
+        else:
+            other_pos += 1
+    return both
+
+
+def block_keys(buf, meta, blk, counted=None):
+    """
+    :return: set of the keys of a data block, none of its values being decoded
+    """
+    block = _block(buf, meta, blk, counted)
+    return set(block.keys() if isinstance(block, RowBlock) else block.keys)
+
+
+def read_zones(infile, meta):
+    """
+    :param infile: the node file opened together with meta (see MetaCache.open)
+    :return: the zone maps of the file (see zonemap.FileZones), read once and then kept with its metadata
+    """
+    if meta.zones is None:
+        zone_offset, zone_len = meta.location[6:]
+        meta.zones = decode_zone_maps(os.pread(infile.fileno(), zone_len, zone_offset))
+    return meta.zones
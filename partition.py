@@ -0,0 +1,415 @@
+import bisect
+import math
+from snapshot import keep_earlier, value_at
+
+'''
+ $$$$ Key range partitioning:
+  The memory buffer and every node route a key to a child through a boundary table (KeyRanges): the low key of every
+  child's range in ascending order and the id of the child owning it, searched with a binary search. The id is the
+  child's key range order minus one, so it names the child's directory and never changes. A node starts with its
+  range cut into fan_out equal pieces, ids 0 to fan_out - 1, like before there was a table.
+
+  The tables follow the keys actually written:
+   - Split: every compaction of a node counts the keys it pushes into each child, older compactions counting less and
+     less (RATE_DECAY). A child without children of its own that overflows while it gets more than SPLIT_SKEW times
+     the keys per key of range its parent gets on average is cut in two rather than pushed down into children of its
+     own, so a hot key range is spread over more, narrower children instead of cascading compactions down one path
+     while the siblings sit empty. The cut is the boundary between two of the child's own children ranges (the ones
+     it would push down into) nearest to its median key, so no range ever gets wider than the tree was laid out
+     with and a last level node never holds more keys than its range of the design. Keys all within one such range
+     leave nothing to cut, the child is then pushed down as before.
+   - Merge: a node has at most MAX_CHILDREN_FACTOR times its first number of children. When a split needs a slot and
+     there is none, two adjacent children without children of their own and no wider together than the node's first
+     children are merged, the pair that got the fewest keys lately, if together they hold at most a node's capacity.
+   - Growth: the memory buffer adds a level 0 range for keys beyond the ones it covers, so the key space grows past
+     the number of items the tree was made for without a rebuild.
+
+  A new piece is written before the table routes keys to it and a merged child's file is written before the table
+  stops routing keys to its sibling, whose files are only removed by the next compaction of the parent, so a read
+  always finds a file holding its key. The tables are recorded in the manifest.
+'''
+
+# how many times more keys per key of range than its parent on average an overflowing child has to get to be split
+SPLIT_SKEW = 2
+
+# weight of the keys a compaction pushed into the children at the next compaction of their parent
+RATE_DECAY = 0.5
+
+# how many times its first number of children a node can have
+MAX_CHILDREN_FACTOR = 2
+
+
+class KeyRanges(object):
+    """
+    Boundary table of the children of a node. The table and the rates are never changed in place, a split, merge or
+    growth swaps in new ones, so readers never need a lock.
+    """
+    def __init__(self, bounds, ids, high, max_slots, width):
+        # (low key of every child range in ascending order, id of every child in the same order, high key of the
+        # last range)
+        self.table = (list(bounds), list(ids), high)
+
+        # the tables replaced while snapshots are held (see snapshot.py)
+        self.earlier = []
+
+        # most children the node can have
+        self.max_slots = max_slots
+
+        # number of keys of a child range as the node was laid out, merges never make a wider one
+        self.width = width
+
+        # child id -> keys pushed into the child by the recent compactions (see record)
+        self.rates = dict()
+
+    @classmethod
+    def even(cls, low, high, parts):
+        """
+        The range [low, high] cut into parts equal pieces (fewer when it holds fewer keys), ids from 0
+        """
+        cap = max(1, math.ceil((high - low + 1) / parts))
+        bounds = list(range(low, high + 1, cap)) or [low]
+        return cls(bounds, range(len(bounds)), high, MAX_CHILDREN_FACTOR * parts, cap)
+
+    def state(self):
+        bounds, ids, high = self.table
+        return bounds, ids, high, self.max_slots, self.width
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(*state)
+
+    def at(self, version):
+        """
+        :param version: generation of a snapshot, None for the current table
+        """
+        # the table first: a change records the table it replaces before swapping in the new one
+        table = self.table
+        return value_at(self.earlier, version, table)
+
+    def swap(self, table, stamp):
+        """
+        :param stamp: the stamp of the change (see MetaCache.change)
+        """
+        self.earlier = keep_earlier(self.earlier, self.table, stamp)
+        self.table = table
+
+    def find(self, key, version=None):
+        """
+        :return: id of the child whose range holds the key, None if no range does
+        """
+        bounds, ids, high = self.at(version)
+        pos = bisect.bisect_right(bounds, key) - 1
+        if pos < 0 or key > high:
+            return None
+        return ids[pos]
+
+    def range_of(self, child_id, version=None):
+        """
+        :return: (low, high) of the child's range, None if the table has no such child
+        """
+        bounds, ids, high = self.at(version)
+        if child_id not in ids:
+            return None
+        pos = ids.index(child_id)
+        return bounds[pos], bounds[pos + 1] - 1 if pos + 1 < len(bounds) else high
+
+    def slots(self):
+        """
+        :return: list of (id, low, high) of every child, in key order
+        """
+        bounds, ids, high = self.table
+        highs = [bound - 1 for bound in bounds[1:]] + [high]
+        return list(zip(ids, bounds, highs))
+
+    def record(self, pushed):
+        """
+        :param pushed: child id -> number of keys a compaction pushes into the child
+        """
+        rates = {child_id: rate * RATE_DECAY for child_id, rate in self.rates.items()}
+        for child_id in pushed:
+            rates[child_id] = rates.get(child_id, 0) + pushed[child_id]
+        self.rates = rates
+
+    def next_id(self, taken):
+        """
+        :param taken: ids in use outside the table
+        """
+        return max(list(self.table[1]) + list(taken)) + 1
+
+    def split(self, child_id, pieces, stamp):
+        """
+        :param pieces: (low key, id) of the new children cutting the child's range, in key order
+        """
+        bounds, ids, high = self.table
+        pos = ids.index(child_id) + 1
+        self.swap((bounds[:pos] + [low for low, _ in pieces] + bounds[pos:],
+                   ids[:pos] + [piece_id for _, piece_id in pieces] + ids[pos:], high), stamp)
+
+        rates = dict(self.rates)
+        share = rates.pop(child_id, 0) / (len(pieces) + 1)
+        for piece_id in [child_id] + [piece_id for _, piece_id in pieces]:
+            rates[piece_id] = share
+        self.rates = rates
+
+    def merge(self, left_id, stamp):
+        """
+        The child takes over the range of the one after it
+        """
+        bounds, ids, high = self.table
+        pos = ids.index(left_id) + 1
+        self.swap((bounds[:pos] + bounds[(pos + 1):], ids[:pos] + ids[(pos + 1):], high), stamp)
+        rates = dict(self.rates)
+        rates[left_id] = rates.get(left_id, 0) + rates.pop(ids[pos], 0)
+        self.rates = rates
+
+    def cover(self, key, width, taken, stamp):
+        """
+        Adds ranges of width keys next to the table up to the one holding the key. A key further away than max_slots
+        such ranges gets one range of width keys, and the keys in between a single range of their own.
+        :param taken: ids in use outside the table
+        :return: id of the child whose range holds the key
+        """
+        bounds, ids, high = self.table
+        taken = set(taken)
+        if key > high:
+            cells = math.ceil((key - high) / width)
+            lows = [high + 1 + cell * width for cell in range(cells)]
+            if cells > self.max_slots:
+                lows = [high + 1, high + 1 + (cells - 1) * width]
+            new_ids = self.fresh_ids(len(lows), taken)
+            self.swap((bounds + lows, ids + new_ids, high + cells * width), stamp)
+            return new_ids[-1]
+
+        cells = math.ceil((bounds[0] - key) / width)
+        lows = [bounds[0] - (cells - cell) * width for cell in range(cells)]
+        if cells > self.max_slots:
+            lows = [lows[0], lows[0] + width]
+        new_ids = self.fresh_ids(len(lows), taken)
+        self.swap((lows + bounds, new_ids + ids, high), stamp)
+        return new_ids[0]
+
+    def fresh_ids(self, count, taken):
+        new_ids = []
+        for _ in range(count):
+            new_ids.append(self.next_id(taken))
+            taken.add(new_ids[-1])
+        return new_ids
+
+
+class Children(object):
+    """
+    Finding, making and walking the children a boundary table routes keys to, shared by the memory buffer (the level 0
+    nodes) and every node. The class using it keeps its children by id in children, the children merged away while
+    snapshots are held in retired, its table in ranges, and makes a child for a key range with make_child(ch, low,
+    high). Every child made knows its parent.
+    """
+    # the child at the given position, made on first use
+    def get_child(self, ch):
+        if ch not in self.children:
+            self.add_child(ch, *self.ranges.range_of(ch))
+        return self.children[ch]
+
+    # makes a child for the key range [low, high]
+    def add_child(self, ch, low, high):
+        self.children[ch] = self.make_child(ch, low, high)
+        self.children[ch].parent = self
+        return self.children[ch]
+
+    # the child at the given position, or None if no data ever reached it (nodes of an earlier tree on the same file
+    # root are made from its manifest when the tree is opened). A snapshot also finds the children merged away since
+    def find_child(self, ch, version=None):
+        child = self.children.get(ch)
+        if child is None and version is not None:
+            child = next((node for node in self.retired if node.key_range_order - 1 == ch), None)
+        return child
+
+    # which child covers the key, None if none does (for the memory buffer: a key beyond the key space so far)
+    def child_index(self, key, version=None):
+        return self.ranges.find(key, version)
+
+    # children key ranges never overlap, so walking the overlapping ones in order keeps the keys sorted. The boundary
+    # table is looked up again after every child and keys not above the last one yielded are skipped, so a split or
+    # merge while the scan runs neither loses keys nor repeats them
+    def scan_children(self, low, high, col_pos, version=None, preds=None):
+        bounds, _, _ = self.ranges.at(version)
+        key = max(low, bounds[0])
+        last = None
+        while key <= high:
+            ch = self.child_index(key, version)
+            if ch is None:
+                return
+            slot_high = self.ranges.range_of(ch, version)[1]
+            child = self.find_child(ch, version)
+            if child is not None:
+                for pair in child.scan(key, high, col_pos, version, preds):
+                    if last is None or pair[0] > last:
+                        last = pair[0]
+                        yield pair
+            now = self.ranges.range_of(ch, version)
+            key = min(slot_high, now[1] if now is not None else slot_high) + 1
+
+
+def taken_ids(parent):
+    """
+    :return: ids of the parent's children, the ones not in its table (yet, or any more) included
+    """
+    return set(parent.children) | set(node.key_range_order - 1 for node in parent.retired)
+
+
+def key_count(node):
+    """
+    :return: number of keys in the node's file and its sorted runs (see compaction.py), from their metadata
+    """
+    if node is None:
+        return 0
+    metas = [node.meta_cache.lookup_file(name) for name in [node.get_file_name()] + node.run_names()]
+    return sum(meta.num_keys for meta in metas if meta is not None)
+
+
+def wants_split(parent, child):
+    """
+    Whether the overflowing child is to be split rather than pushed down into children of its own
+    """
+    if child.children or len(child.workspace) < max(2, child.storage_capacity):
+        return False
+    bounds, ids, high = parent.ranges.table
+
+    child_id = child.key_range_order - 1
+    child_range = parent.ranges.range_of(child_id)
+    total = sum(parent.ranges.rates.values())
+    if child_range is None or child_range[0] == child_range[1] or not total:
+        return False
+
+    density = parent.ranges.rates.get(child_id, 0) / (child_range[1] - child_range[0] + 1)
+    if density <= SPLIT_SKEW * total / (high - bounds[0] + 1):
+        return False
+    return len(ids) < parent.ranges.max_slots or coldest_pair(parent, child.storage_capacity) is not None
+
+
+def split_if_wanted(parent, child, busy):
+    """
+    Splits the overflowing child if it is to be split (see wants_split and split_child)
+    :return: the new child, None if the child was not split
+    """
+    return split_child(parent, child, busy) if wants_split(parent, child) else None
+
+
+def split_point(child):
+    """
+    :return: the boundary between two of the child's own children ranges nearest to its median key, None if all its
+             keys are within one of them
+    """
+    # the workspace holds its keys in key order
+    keys = list(child.workspace)
+    cuts = [bound for bound in child.ranges.table[0][1:] if keys[0] < bound <= keys[-1]]
+    if not cuts:
+        return None
+    median = keys[len(keys) // 2]
+    return min(cuts, key=lambda bound: abs(bound - median))
+
+
+def split_child(parent, child, busy):
+    """
+    Cuts the child in two at its split point, writing the new child for the upper part. The child keeps the lower
+    part, to be written by the caller.
+    :param busy: ids of the children the running compaction still has to write, which cannot be merged
+    :return: the new child, None if the child was not split
+    """
+    child_id = child.key_range_order - 1
+    cut = split_point(child)
+    if cut is None:
+        return None
+    if len(parent.ranges.table[1]) >= parent.ranges.max_slots and \
+            not merge_coldest(parent, child.storage_capacity, busy | {child_id}):
+        return None
+
+    low, high = parent.ranges.range_of(child_id)
+    piece = parent.add_child(parent.ranges.next_id(taken_ids(parent)), cut, high)
+    piece.column_groups = [list(group_cols) for group_cols in child.column_groups]
+    for key in [key for key in child.workspace if key >= cut]:
+        piece.put(key, child.workspace.pop(key))
+    piece.write_to_file()
+
+    # the new child is on disk, so keys can be routed to it
+    with parent.meta_cache.change() as stamp:
+        parent.ranges.split(child_id, [(cut, piece.key_range_order - 1)], stamp)
+    child.set_range(low, cut - 1)
+    child.stats.count(child.level, splits=1)
+    layout_changed(child)
+    return piece
+
+
+def coldest_pair(parent, capacity, busy=frozenset()):
+    """
+    :return: ids of the two adjacent children without children of their own, no wider together than the node's first
+             children and holding at most capacity keys together, that got the fewest keys lately, None if there are
+             no such two
+    """
+    best = None
+    slots = parent.ranges.slots()
+    for (left_id, low, _), (right_id, _, high) in zip(slots, slots[1:]):
+        left, right = parent.find_child(left_id), parent.find_child(right_id)
+        if left_id in busy or right_id in busy or high - low + 1 > parent.ranges.width or \
+                any(node is not None and node.children for node in (left, right)):
+            continue
+        keys = key_count(left) + key_count(right)
+        rate = parent.ranges.rates.get(left_id, 0) + parent.ranges.rates.get(right_id, 0)
+        if keys <= capacity and (best is None or (rate, keys) < best[0]):
+            best = ((rate, keys), left_id, right_id)
+    return None if best is None else best[1:]
+
+
+def merge_coldest(parent, capacity, busy):
+    """
+    Merges the coldest pair of children (see coldest_pair), the left one taking over the right one's range and keys
+    :return: whether a pair was merged
+    """
+    pair = coldest_pair(parent, capacity, busy)
+    if pair is None:
+        return False
+    left_id, right_id = pair
+    right = parent.find_child(right_id)
+    if parent.find_child(left_id) is None and right is None:
+        # neither child holds any data, only the table changes
+        with parent.meta_cache.change() as stamp:
+            parent.ranges.merge(left_id, stamp)
+        layout_changed(parent)
+        return True
+
+    left = parent.get_child(left_id)
+    left.read_whole_file()
+    if right is not None:
+        right.read_whole_file()
+        for key in right.workspace:
+            left.put(key, right.workspace[key])
+        right.workspace = dict()
+    left.set_range(left.key_low_bound, parent.ranges.range_of(right_id)[1])
+    left.write_to_file()
+
+    # the left child's file holds every key of both now
+    with parent.meta_cache.change() as stamp:
+        parent.ranges.merge(left_id, stamp)
+        if right is not None:
+            # snapshots taken before still find it (see find_child)
+            right.retired_at = stamp[0]
+            parent.retired.append(right)
+            del parent.children[right_id]
+    left.stats.count(left.level, merges=1)
+    layout_changed(left)
+    return True
+
+
+def remove_retired(parent):
+    """
+    Removes the files of the children merged away by an earlier compaction of the parent, no read is routed to them
+    any more. The nodes stay retired while snapshots taken before they were merged away are held.
+    """
+    for node in parent.retired:
+        node.remove_files()
+    oldest = parent.meta_cache.oldest()
+    parent.retired = [node for node in parent.retired if oldest is not None and oldest < node.retired_at]
+
+
+def layout_changed(node):
+    if node.meta_cache.on_layout_change is not None:
+        node.meta_cache.on_layout_change([node])
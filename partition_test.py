@@ -0,0 +1,130 @@
+import os
+import random
+import bloomfilter
+from lsmTree import LsmTree
+from node import Node
+from partition import MAX_CHILDREN_FACTOR, RATE_DECAY, KeyRanges, merge_coldest
+
+
+def test_even_table_routes_every_key():
+    ranges = KeyRanges.even(1, 100, 4)
+    assert ranges.table == ([1, 26, 51, 76], [0, 1, 2, 3], 100)
+    assert (ranges.max_slots, ranges.width) == (MAX_CHILDREN_FACTOR * 4, 25)
+    assert [ranges.find(key) for key in (0, 1, 25, 26, 100, 101)] == [None, 0, 0, 1, 3, None]
+    assert ranges.range_of(2) == (51, 75) and ranges.range_of(3) == (76, 100) and ranges.range_of(9) is None
+    assert ranges.slots() == [(0, 1, 25), (1, 26, 50), (2, 51, 75), (3, 76, 100)]
+    assert KeyRanges.from_state(ranges.state()).table == ranges.table
+
+    # a range with fewer keys than parts
+    assert KeyRanges.even(5, 6, 4).table == ([5, 6], [0, 1], 6)
+
+
+def test_split_and_merge_keep_the_table_a_snapshot_sees():
+    ranges = KeyRanges.even(1, 100, 4)
+    ranges.record({1: 8, 2: 2})
+    ranges.record({1: 4})
+    assert ranges.rates == {1: 8 * RATE_DECAY + 4, 2: 2 * RATE_DECAY}
+
+    # split at generation 5, a snapshot being held at generation 3
+    ranges.split(1, [(40, ranges.next_id(set()))], (5, 3))
+    assert ranges.table == ([1, 26, 40, 51, 76], [0, 1, 4, 2, 3], 100)
+    assert ranges.range_of(1) == (26, 39) and ranges.range_of(4) == (40, 50)
+    assert ranges.rates[1] == ranges.rates[4] == (8 * RATE_DECAY + 4) / 2
+    assert ranges.find(45) == 4 and ranges.find(45, 3) == 1 and ranges.find(45, 5) == 4
+
+    # the pieces merged back, taking the rates of both; no snapshot held any more
+    ranges.merge(1, (6, None))
+    assert ranges.table == ([1, 26, 51, 76], [0, 1, 2, 3], 100)
+    assert ranges.rates[1] == 8 * RATE_DECAY + 4
+    assert ranges.earlier == [] and ranges.find(45, 3) == 1
+
+    # ids of children merged away but kept for snapshots are not handed out again
+    assert ranges.next_id({7}) == 8
+
+
+def test_cover_grows_the_key_space():
+    ranges = KeyRanges.even(1, 100, 4)
+    assert ranges.cover(130, 25, set(), (1, None)) == 5
+    assert ranges.table == ([1, 26, 51, 76, 101, 126], [0, 1, 2, 3, 4, 5], 150)
+    assert ranges.find(130) == 5
+
+    # below the lowest range, the id after the ones taken
+    assert ranges.cover(-10, 25, {6}, (2, None)) == 7
+    assert ranges.table[0][:2] == [-24, 1] and ranges.find(-10) == 7 and ranges.find(0) == 7
+
+    # a key far away gets a range of its own, the keys in between one more
+    far = 150 + 25 * (ranges.max_slots + 5)
+    new_id = ranges.cover(far, 25, set(), (3, None))
+    assert ranges.find(far) == new_id and ranges.find(151) == new_id - 1
+    assert ranges.range_of(new_id)[1] == ranges.table[2] and len(ranges.table[1]) == 9
+
+
+def test_hot_ranges_split_merge_and_the_key_space_grows(tmp_path, make_value):
+    lsm = LsmTree(1000, 2, 4, str(tmp_path), 0.01, buffer_bytes=3000)
+    model = dict()
+    rnd = random.Random(1)
+    # most writes land in the first level 0 range
+    for version in range(3000):
+        key = rnd.randint(1, 249) if rnd.random() < 0.9 else rnd.randint(250, 999)
+        model[key] = make_value(key, version)
+        lsm.write(key, model[key])
+    lsm.flush()
+    assert lsm.stats()['levels'][0]['splits'] > 0
+    assert len(lsm.root.ranges.table[1]) == lsm.root.ranges.max_slots
+
+    # the table is full; the coldest pair of children merges once it fits a node, a snapshot still reading both
+    with lsm.snapshot() as snapshot:
+        assert merge_coldest(lsm.root, 2 * lsm.root.children[0].storage_capacity, set())
+        assert len(lsm.root.ranges.table[1]) == lsm.root.ranges.max_slots - 1 and lsm.root.retired
+        assert lsm.stats()['levels'][0]['merges'] == 1
+        lsm.write(1, make_value(1, -2))
+        for key in range(1, 100):
+            val = lsm.read(key, key, 0, snapshot)
+            assert (None if val is None else val.cols) == (model[key].cols if key in model else None), key
+    model[1] = make_value(1, -2)
+
+    # keys beyond the key space the tree was made for, and below it
+    for key in list(range(1000, 1300, 7)) + [5000, -40]:
+        model[key] = make_value(key, -1)
+        lsm.write(key, model[key])
+    lsm.flush()
+    assert len(lsm.root.ranges.table[1]) > lsm.root.ranges.max_slots - 1
+    assert lsm.root.ranges.find(5000) is not None and lsm.root.ranges.find(-40) is not None
+
+    def check(tree):
+        for key in list(model)[::3] + [999, 1001, 4999, 5001]:
+            val = tree.read(key, key, 0)
+            assert (None if val is None else val.cols) == (model[key].cols if key in model else None), key
+        assert [(key, val.cols) for key, val in tree.scan(-100, 6000)] == \
+               [(key, model[key].cols) for key in sorted(model)]
+    check(lsm)
+    table = lsm.root.ranges.table
+    lsm.close()
+
+    # the tables are in the manifest
+    lsm = LsmTree.open(str(tmp_path), buffer_bytes=3000)
+    assert lsm.root.ranges.table == table
+    check(lsm)
+    lsm.close()
+
+
+def test_children_are_made_when_a_flush_first_reaches_them(tmp_path, monkeypatch, make_value):
+    built, made = [], []
+    build, init = bloomfilter.BloomFilter.build, Node.__init__
+    monkeypatch.setattr(bloomfilter.BloomFilter, 'build', lambda *args: built.append(args) or build(*args))
+    monkeypatch.setattr(Node, '__init__', lambda node, *args: made.append(args[4]) or init(node, *args))
+
+    # no node, directory or filter for any of the 10 + 100 + 1000 ranges of the tree
+    lsm = LsmTree(100000, 3, 10, str(tmp_path), 0.01, buffer_bytes=3000)
+    assert lsm.root.children == {} and not built and not made
+    assert not [name for name in os.listdir(str(tmp_path)) if name.startswith('lv-')]
+
+    lsm.write(55555, make_value(55555, 0))
+    lsm.write(55556, make_value(55556, 0))
+    lsm.flush()
+    ch = lsm.root.ranges.find(55555)
+    assert list(lsm.root.children) == [ch] and lsm.root.children[ch].children == {}
+    assert [name for name in os.listdir(str(tmp_path)) if name.startswith('lv-')] == ['lv-0.kr-%d.cg-1' % (ch + 1)]
+    # one level 0 node, written with one filter
+    assert made == [0] and len(built) == 1
+    lsm.close()
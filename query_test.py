@@ -0,0 +1,91 @@
+import operator
+import pytest
+from lsmTree import LsmTree
+from value import Value
+from zonemap import OPS, ZONE_BYTES, ZoneMap, compile_predicates, decode_zone_maps, encode_zone_maps, upper_bound
+
+N = 1000
+
+COMPARE = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt,
+           '>=': operator.ge}
+
+
+def brute_query(model, low, high, preds, col_pos):
+    found = []
+    for key in sorted(model):
+        if not low <= key <= high:
+            continue
+        val = model[key]
+        if all(val.get(pred[0]) is None if pred[1] == 'null' else
+               val.get(pred[0]) is not None if pred[1] == 'not null' else
+               val.get(pred[0]) is not None and COMPARE[pred[1]](val.get(pred[0]), pred[2]) for pred in preds):
+            found.append((key, val.project(Value.wanted_cols(col_pos)).cols))
+    return found
+
+
+CASES = [(1, N, [(3, '==', 'c3')], 0),
+         (200, 800, [(1, '>=', 'v5'), (3, '!=', 'c1')], [1, 3]),
+         (1, N, [(2, '<', '%06d' % 150)], [2]),
+         (1, N, [(2, '<=', '%06d' % 150), (2, '>', '%06d' % 90)], 1),
+         (1, N, [(4, 'null')], 0),
+         (1, N, [(4, 'not null'), (4, '>', 'xx')], [4]),
+         (1, N, [(4, '>=', 'xxx'), (3, '<', 'c4')], 0),
+         (1, N, [(1, '==', 'nothing')], 0),
+         (1, N, [], 3)]
+
+
+def test_zone_maps_rule_out_blocks():
+    zone = ZoneMap.build([Value([(1, 'b'), (2, 'm')], 2), Value([(1, 'd')], 2), Value([(1, 'c'), (2, 'm')], 2)])
+    assert zone.rows == 3 and zone.columns == {1: (b'b', b'd', 0), 2: (b'm', b'm', 1)}
+    may = {op: zone.may_match(compile_predicates([(1, op, 'a')])) for op in OPS if op not in ('null', 'not null')}
+    assert may == {'==': False, '!=': True, '<': False, '<=': False, '>': True, '>=': True}
+    assert not zone.may_match(compile_predicates([(2, '!=', 'm'), (1, '>', 'a')]))
+    assert zone.may_match(compile_predicates([(2, 'null')])) and not zone.may_match(compile_predicates([(1, 'null')]))
+    assert zone.may_match(compile_predicates([(3, 'null')]))
+    assert not zone.may_match(compile_predicates([(3, '==', 'x')]))
+    # a column the rows were projected away from rules nothing out
+    assert zone.may_match(compile_predicates([(1, '==', 'a')]), covered={2})
+
+    merged = ZoneMap.merge([zone, ZoneMap.build([Value([(1, 'a')], 2)])])
+    assert merged.rows == 4 and merged.columns == {1: (b'a', b'd', 0), 2: (b'm', b'm', 2)}
+
+    # a long max is cut and rounded up, still no smaller than the value
+    long = b'y' * (ZONE_BYTES + 5)
+    assert len(upper_bound(long)) == ZONE_BYTES and upper_bound(long) > long
+    decoded = decode_zone_maps(encode_zone_maps([zone, merged], {1, 2}))
+    assert decoded.covered == {1, 2} and [z.columns for z in decoded.blocks] == [zone.columns, merged.columns]
+
+    with pytest.raises(ValueError):
+        compile_predicates([(1, '~', 'a')])
+    with pytest.raises(ValueError):
+        compile_predicates([(1, '==', 5)])
+
+
+@pytest.mark.parametrize('options', [dict(), dict(cols_per_group=2), dict(compaction='tiered', tier_runs=2)])
+def test_queries_match_brute_force(tmp_path, options, load_model):
+    lsm = LsmTree(N, 3, 4, str(tmp_path), 0.01, buffer_bytes=8000, **options)
+    model = load_model(lsm, dict(), N, 1500)
+    lsm.flush()
+    for low, high, preds, col_pos in CASES:
+        assert [(key, val.cols) for key, val in lsm.query(low, high, preds, col_pos)] == \
+               brute_query(model, low, high, preds, col_pos), preds
+
+    # column 2 grows with the key, so blocks past its bound are ruled out by their zone maps
+    levels = lsm.stats()['levels']
+    assert sum(counters['query_blocks_skipped'] for counters in levels) > 0
+    assert lsm.stats()['tree']['queries'] == len(CASES)
+
+    # the newest writes, still in the memory buffer, are queried as well, a snapshot seeing the rows before them
+    with lsm.snapshot() as snapshot:
+        before = dict(model)
+        for key in range(1, N, 50):
+            model[key] = Value([(1, 'new'), (3, 'c3')], 4)
+            lsm.write(key, model[key])
+        lsm.delete(3)
+        model.pop(3, None)
+        for low, high, preds, col_pos in CASES[:3]:
+            assert [(key, val.cols) for key, val in lsm.query(low, high, preds, col_pos)] == \
+                   brute_query(model, low, high, preds, col_pos), preds
+            assert [(key, val.cols) for key, val in lsm.query(low, high, preds, col_pos, snapshot)] == \
+                   brute_query(before, low, high, preds, col_pos), preds
+    lsm.close()
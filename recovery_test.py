@@ -0,0 +1,119 @@
+import multiprocessing
+import os
+import pytest
+import manifest
+from lsmTree import LsmTree
+from value import Value
+
+N = 1500
+
+
+def batches(rounds):
+    """
+    The writes of the load: every round writes a share of the keys one by one and then deletes some in one batch
+    :return: list of lists of (key, Value) pairs
+    """
+    load = []
+    for round_no in range(rounds):
+        for key in range(1, N, round_no + 1):
+            load.append([(key, Value([(1, 'r%d' % round_no), (2, 'k%d' % key)], 2))])
+        load.append([(key, Value.tombstone()) for key in range(round_no * 50, N, 13)])
+    return load
+
+
+def expected(load):
+    model = dict()
+    for batch in load:
+        for key, val in batch:
+            model[key] = val
+    return {key: val for key, val in model.items() if not val.is_tombstone}
+
+
+def load_and_crash(file_root, load, cols_per_group, options):
+    # the process ends without the tree being closed, in the middle of its compactions
+    if os.path.exists(os.path.join(file_root, 'MANIFEST')):
+        lsm = LsmTree.open(file_root, **options)
+    else:
+        lsm = LsmTree(N, 3, 4, file_root, 0.01, cols_per_group=cols_per_group, **options)
+    for batch in load:
+        if len(batch) == 1:
+            lsm.write(*batch[0])
+        else:
+            lsm.write_batch(batch)
+    os._exit(0)
+
+
+def crash(file_root, load, cols_per_group, options):
+    process = multiprocessing.get_context('fork').Process(target=load_and_crash,
+                                                          args=(file_root, load, cols_per_group, options))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+
+def check(lsm, model):
+    for key in range(N + 1):
+        val = lsm.read(key, key, 0)
+        assert (None if val is None else val.cols) == (model[key].cols if key in model else None), key
+    assert [(key, val.cols) for key, val in lsm.scan(0, N)] == [(key, model[key].cols) for key in sorted(model)]
+
+
+@pytest.mark.parametrize('cols_per_group, options', [(1, dict(buffer_bytes=12000, wal_sync='none')),
+                                                     (1, dict(buffer_bytes=12000, compaction='tiered', tier_runs=2)),
+                                                     (2, dict(buffer_bytes=12000, compaction_workers=2)),
+                                                     (1, dict(buffer_bytes=1024 * 1024))])
+def test_reopen_after_crash(tmp_path, cols_per_group, options):
+    file_root = str(tmp_path)
+    load = batches(4)
+    first, second = len(load) // 2 + 7, len(load) - 100
+
+    crash(file_root, load[:first], cols_per_group, options)
+    lsm = LsmTree.open(file_root, **options)
+    check(lsm, expected(load[:first]))
+    lsm.close()
+
+    # a tree opened after a crash writes on, crashes again and is opened once more
+    crash(file_root, load[first:second], cols_per_group, options)
+    lsm = LsmTree.open(file_root, **options)
+    check(lsm, expected(load[:second]))
+    lsm.close()
+
+    lsm = LsmTree.open(file_root, **options)
+    check(lsm, expected(load[:second]))
+    lsm.close()
+
+
+def test_manifest_is_an_edit_log(tmp_path, monkeypatch):
+    rewrites = []
+    rewrite = manifest.Manifest.rewrite
+
+    def counting_rewrite(self):
+        rewrites.append(self.appended)
+        return rewrite(self)
+    monkeypatch.setattr(manifest.Manifest, 'rewrite', counting_rewrite)
+
+    file_root = str(tmp_path)
+    load = batches(2)
+    lsm = LsmTree(N, 3, 4, file_root, 0.01, buffer_bytes=12000)
+    for batch in load:
+        lsm.write_batch(batch)
+    lsm.flush()
+    # written when the tree was made, afterwards appended to and rewritten by a flush only once its log has grown
+    flushes = lsm.stats()['tree']['flushes']
+    assert flushes > 10 and len(rewrites) <= 1 + flushes // 4
+    assert lsm.manifest.appended > 0
+    lsm.close()
+
+    # a record torn by a crash ends the log, the records before it are still there
+    with open(os.path.join(file_root, 'MANIFEST'), 'ab') as outfile:
+        outfile.write(manifest.FRAME.pack(0, 100, manifest.NODE_RECORD) + b'torn')
+    lsm = LsmTree.open(file_root)
+    check(lsm, expected(load))
+    lsm.close()
+
+    # folded into a new manifest on open, which the next open folds into the same one
+    size = os.path.getsize(os.path.join(file_root, 'MANIFEST'))
+    lsm = LsmTree.open(file_root)
+    check(lsm, expected(load))
+    lsm.close()
+    assert os.path.getsize(os.path.join(file_root, 'MANIFEST')) == size
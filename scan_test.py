@@ -0,0 +1,35 @@
+import random
+from lsmTree import LsmTree
+from value import Value
+
+N = 600
+
+
+def check(lsm, model, seed):
+    rnd = random.Random(seed)
+    for _ in range(20):
+        low = rnd.randint(0, N)
+        high = low + rnd.randint(0, N // 3)
+        col_pos = rnd.choice([0, 1, [2, 4], 4])
+        got = [(key, val.cols) for key, val in lsm.scan(low, high, col_pos)]
+        assert got == [(key, model[key].project(Value.wanted_cols(col_pos)).cols)
+                       for key in sorted(model) if low <= key <= high]
+
+
+def test_scan_matches_brute_force(tmp_path, make_value, load_model):
+    lsm = LsmTree(N, 3, 4, str(tmp_path), 0.01, buffer_bytes=8000)
+    model = load_model(lsm, dict(), N, 2000, deletes=0)
+    lsm.flush()
+    check(lsm, model, 2)
+
+    # the newest writes still in the memory buffer hide the ones on disk
+    for key in range(1, N, 37):
+        model[key] = make_value(key, -1)
+        lsm.write(key, model[key])
+    check(lsm, model, 3)
+
+    # the scan is lazy: it stops where the caller does
+    scan = lsm.scan(0, N)
+    assert [next(scan)[0] for _ in range(3)] == sorted(model)[:3]
+    scan.close()
+    lsm.close()
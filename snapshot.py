@@ -0,0 +1,101 @@
+'''
+ $$$$ Snapshots:
+  Every write gets the next sequence number, and every change of the files or the layout of the tree on disk (a node
+  file installed or removed, a boundary table split, merged or grown, a last level node regrouped) gets the next
+  generation (see MetaCache.change). A snapshot is the sequence number of the last write and the generation of the last
+  change when it was taken, together with the memory buffers of that moment, and reads given it see exactly the tree
+  of that moment:
+   - memory buffers: the entry of a key is [sequence number, value, the entry it replaced]. While snapshots are held a
+     write keeps the entry it replaces, so a snapshot walks back to the newest entry not written after it. Buffers
+     frozen before the snapshot hold no later writes, and the snapshot keeps them after they are flushed.
+   - files: a file replaced or removed while snapshots are held is first hard linked under a new name, and kept until
+     the snapshots that can see it are released. A snapshot reads the newest file of a node installed before it.
+   - layout: boundary tables, column group layouts and nodes merged away keep the values they replace for the
+     snapshots (see keep_earlier and value_at).
+  Taking a snapshot only pins its generation, nothing is copied and neither writes nor compactions wait for it.
+'''
+
+
+class Snapshot(object):
+    """
+    A consistent view of the tree as of the last write before LsmTree.snapshot() returned it. Release it (or use it as
+    a context manager) once done, so the files and versions it keeps alive can go.
+    """
+    def __init__(self, seq, generation, buffer, immutables, on_release):
+        # sequence number of the last write the snapshot sees
+        self.seq = seq
+
+        # generation of the last change on disk the snapshot sees
+        self.generation = generation
+
+        # the memory buffer and frozen buffers, newest first, when the snapshot was taken
+        self.buffers = [buffer] + immutables
+
+        self.on_release = on_release
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.on_release(self.generation)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def entry_value(self, entry):
+        """
+        :param entry: the entry of a key in a memory buffer, None if it has none
+        :return: value of the newest version the snapshot sees, None if it sees none
+        """
+        while entry is not None and entry[0] > self.seq:
+            entry = entry[2]
+        return None if entry is None else entry[1]
+
+    def lookup(self, key):
+        """
+        :return: value of the key in the memory buffers, None if the snapshot sees none there
+        """
+        for buf in self.buffers:
+            val = self.entry_value(buf.get(key))
+            if val is not None:
+                return val
+        return None
+
+    def scan_buffers(self, low, high):
+        """
+        :return: one iterator per memory buffer, newest first, of the key/value pairs with low <= key <= high the
+                 snapshot sees there
+        """
+        sources = []
+        for buf in self.buffers:
+            pairs = [(key, self.entry_value(entry)) for key, entry in buf.range(low, high)]
+            sources.append(iter([pair for pair in pairs if pair[1] is not None]))
+        return sources
+
+
+def keep_earlier(earlier, value, stamp):
+    """
+    Records a value about to be replaced by a change
+    :param earlier: list of (generation the value was replaced at, value), oldest first
+    :param stamp: (generation of the change, oldest generation a snapshot is held at or None), see MetaCache.change
+    :return: the new list, without the values no snapshot can see any more
+    """
+    generation, oldest = stamp
+    if oldest is None:
+        return []
+    return [entry for entry in earlier if entry[0] > oldest] + [(generation, value)]
+
+
+def value_at(earlier, version, current):
+    """
+    :param version: generation of a snapshot, None for the current value
+    :return: the value as of the version
+    """
+    if version is not None:
+        for until, value in earlier:
+            if version < until:
+                return value
+    return current
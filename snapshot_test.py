@@ -0,0 +1,80 @@
+import random
+import threading
+import pytest
+from lsmTree import LsmTree
+from value import Value
+
+N = 400
+ROUNDS = 2
+
+
+def write_rounds(lsm, order):
+    # every round writes every key once more, in the same order, so a consistent view of the tree is a prefix of it
+    for round_no in range(1, ROUNDS + 1):
+        for key in order:
+            lsm.write(key, Value([(1, '%d' % round_no), (2, 'k%d' % key)], 2))
+
+
+def check_prefix(pairs, order):
+    """
+    :param pairs: list of (key, round) pairs of every key
+    """
+    rounds = dict(pairs)
+    assert sorted(rounds) == sorted(order)
+    seen = [rounds[key] for key in order]
+    newest = seen[0]
+    cut = next((pos for pos, round_no in enumerate(seen) if round_no != newest), len(seen))
+    assert all(round_no == newest for round_no in seen[:cut])
+    assert all(round_no == newest - 1 for round_no in seen[cut:])
+
+
+def reader(lsm, order, stop, checked, errors):
+    rnd = random.Random(1)
+    try:
+        while not stop.is_set():
+            with lsm.snapshot() as snapshot:
+                pairs = [(key, int(val.get(1))) for key, val in lsm.scan(0, N, 0, snapshot)]
+                check_prefix(pairs, order)
+
+                # the snapshot still reads the same after more writes and compactions
+                keys = rnd.sample(order, 100)
+                rounds = dict(pairs)
+                got = lsm.multi_get(keys, 1, snapshot)
+                assert [int(val.get(1)) for val in got] == [rounds[key] for key in keys]
+                for key in keys[:20]:
+                    assert int(lsm.read(key, key, 1, snapshot).get(1)) == rounds[key]
+                low = rnd.randint(0, N)
+                assert [(key, int(val.get(1))) for key, val in lsm.scan(low, low + 100, 1, snapshot)] == \
+                       [(key, round_no) for key, round_no in pairs if low <= key <= low + 100]
+            checked.append(snapshot)
+    except Exception as error:
+        errors.append(error)
+
+
+@pytest.mark.parametrize('options', [dict(), dict(compaction='tiered', tier_runs=2),
+                                     dict(cols_per_group=2, compaction_workers=2)])
+def test_snapshots_during_compaction(tmp_path, options):
+    lsm = LsmTree(N, 3, 4, str(tmp_path), 0.01, buffer_bytes=8000, **options)
+    order = list(range(1, N))
+    random.Random(1).shuffle(order)
+    for key in order:
+        lsm.write(key, Value([(1, '0'), (2, 'k%d' % key)], 2))
+    lsm.flush()
+
+    stop = threading.Event()
+    checked, errors = [], []
+    thread = threading.Thread(target=reader, args=(lsm, order, stop, checked, errors))
+    thread.start()
+    try:
+        write_rounds(lsm, order)
+        lsm.flush()
+    finally:
+        stop.set()
+        thread.join()
+    assert not errors, errors[0]
+    assert checked
+
+    # every file kept for the snapshots is gone once they are released
+    assert not lsm.meta_cache.earlier
+    check_prefix([(key, int(val.get(1))) for key, val in lsm.scan(0, N)], order)
+    lsm.close()
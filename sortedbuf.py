@@ -0,0 +1,114 @@
+import bisect
+import threading
+
+'''
+ $$$$ Sorted memory buffer:
+  The memory buffer keeps its keys in order as a sorted array plus a delta. A key written for the first time is
+  appended to the delta, and the delta is sorted and merged into the array once it outgrows a share of it, or when a
+  flush wants every key in order. A scan in between takes its slice of the array and sorts only the keys of the delta in
+  its range. Point reads and overwrites go through a dict and touch neither.
+
+  The array is never changed in place, a merge swaps in a new one, so a scan keeps working on the array it took while
+  writes go on.
+
+  The buffer also counts the bytes its entries take (see Value.nbytes), so the memory buffer is flushed by size rather
+  than by number of keys, and a buffer of wide rows stays within the same budget as one of narrow rows.
+'''
+
+# bytes of the dict slot, the entry list and the key of a key written, on top of its value
+ENTRY_OVERHEAD = 150
+
+# the delta is merged into the array once it holds more keys than this, and more than an eighth of the array
+MIN_MERGE = 256
+
+
+class SortedBuffer(object):
+    """
+    Ordered key -> entry map of the memory buffer, with the approximate bytes of its entries
+    """
+    def __init__(self):
+        # key -> [sequence number, value, the entry it replaced] (see snapshot.py)
+        self.entries = dict()
+
+        # keys in order, as of the last merge
+        self.keys = []
+
+        # keys written for the first time since, in the order they came
+        self.delta = []
+
+        # guards the delta, which the writer appends to while scans read it
+        self.lock = threading.Lock()
+
+        # bytes of all entries and of the values kept for snapshots
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, entry):
+        """
+        :param entry: [sequence number, value, the entry it replaces or None]
+        """
+        new = key not in self.entries
+        # the entry goes in first, so a scan finding the key in the delta finds its entry
+        self.entries[key] = entry
+        self.nbytes += entry[1].nbytes
+        if new:
+            with self.lock:
+                self.delta.append(key)
+            self.nbytes += ENTRY_OVERHEAD
+
+    def drop_replaced(self, entry):
+        """
+        Forgets the entry the given one replaced, no snapshot can read it
+        """
+        replaced = entry[2]
+        if replaced is not None:
+            entry[2] = None
+            # older entries it kept for snapshots are still counted, until the buffer is flushed
+            self.nbytes -= replaced[1].nbytes
+
+    def sorted_keys(self):
+        """
+        :return: list of every key in order
+        """
+        with self.lock:
+            if self.delta:
+                self.merge_delta()
+            return self.keys
+
+    def range(self, low, high):
+        """
+        :return: list of the (key, entry) pairs with low <= key <= high in key order
+        """
+        with self.lock:
+            if len(self.delta) > max(MIN_MERGE, len(self.keys) // 8):
+                self.merge_delta()
+            keys = self.keys
+            delta = list(self.delta)
+
+        run = keys[bisect.bisect_left(keys, low):bisect.bisect_right(keys, high)]
+        extra = [key for key in delta if low <= key <= high]
+        if extra:
+            # two sorted runs, merged in linear time
+            extra.sort()
+            run += extra
+            run.sort()
+        entries = self.entries
+        return [(key, entries[key]) for key in run]
+
+    def merge_delta(self):
+        self.delta.sort()
+        merged = self.keys + self.delta
+        merged.sort()
+        self.keys = merged
+        self.delta = []
@@ -0,0 +1,106 @@
+import random
+from lsmTree import LsmTree
+from sortedbuf import ENTRY_OVERHEAD, MIN_MERGE, SortedBuffer
+from value import Value
+
+NARROW = Value([(1, 'a')], 1)
+WIDE = Value([(col, 'w' * 300) for col in range(1, 11)], 10)
+
+
+def fill(buf, keys, val=NARROW):
+    for seq, key in enumerate(keys, start=1):
+        buf.put(key, [seq, val, buf.get(key)])
+
+
+def test_range_and_sorted_keys_merge_the_delta():
+    buf = SortedBuffer()
+    top = 2 * MIN_MERGE + 100
+    keys = list(range(0, top, 2))
+    random.Random(1).shuffle(keys)
+    fill(buf, keys[:100])
+
+    # a delta below MIN_MERGE is sorted per range, and kept
+    assert [key for key, _ in buf.range(10, 60)] == [key for key in sorted(keys[:100]) if 10 <= key <= 60]
+    assert buf.keys == [] and len(buf.delta) == 100
+
+    # above it, the range merges it into the array first
+    fill(buf, keys[100:])
+    assert [key for key, _ in buf.range(0, top)] == sorted(keys)
+    assert buf.keys == sorted(keys) and buf.delta == []
+    assert all(entry[1] is NARROW for _, entry in buf.range(0, 10))
+
+    # a small delta next to the array: merged into the ranges it falls in, the array left alone
+    array = buf.keys
+    fill(buf, [5, 7, top + 1])
+    assert [key for key, _ in buf.range(0, 8)] == [0, 2, 4, 5, 6, 7, 8]
+    assert buf.keys is array and len(buf.delta) == 3
+
+    # next to a large array the delta may grow past MIN_MERGE, up to len/8 of the array
+    big = SortedBuffer()
+    fill(big, range(0, 40 * MIN_MERGE, 2))
+    big.sorted_keys()
+    odd = list(range(1, 2 * (len(big) // 8 + 2), 2))
+    fill(big, odd[:MIN_MERGE + 10])
+    assert [key for key, _ in big.range(0, 20)] == list(range(21))
+    assert len(big.delta) == MIN_MERGE + 10
+    fill(big, odd[MIN_MERGE + 10:])
+    assert len(big.delta) > len(big.keys) // 8 > MIN_MERGE
+    assert [key for key, _ in big.range(0, 20)] == list(range(21))
+    assert big.delta == []
+
+    # sorted_keys merges whatever delta there is; a scan holding the old array keeps it as it was
+    old = buf.keys
+    assert buf.sorted_keys() == sorted(keys + [5, 7, top + 1])
+    assert buf.delta == [] and old == sorted(keys) and buf.keys is not old
+    assert SortedBuffer().sorted_keys() == [] and SortedBuffer().range(0, 10) == []
+
+
+def test_overwrites_and_replaced_entries():
+    buf = SortedBuffer()
+    fill(buf, [3, 1])
+    first = buf[3]
+    buf.put(3, [3, WIDE, first])
+    # the key is not put into the delta again, and its entry keeps the one it replaced for snapshots
+    assert len(buf) == 2 and 3 in buf and 4 not in buf and buf.delta == [3, 1]
+    assert buf[3][1] is WIDE and buf[3][2] is first and buf.get(4) is None
+    assert [(key, entry[1]) for key, entry in buf.range(0, 5)] == [(1, NARROW), (3, WIDE)]
+    assert buf.nbytes == 2 * ENTRY_OVERHEAD + 2 * NARROW.nbytes + WIDE.nbytes
+
+    # no snapshot can read the replaced entry any more: its bytes go
+    buf.drop_replaced(buf[3])
+    assert buf[3][2] is None and buf.nbytes == 2 * ENTRY_OVERHEAD + NARROW.nbytes + WIDE.nbytes
+    buf.drop_replaced(buf[3])
+    buf.drop_replaced(buf[1])
+    assert buf.nbytes == 2 * ENTRY_OVERHEAD + NARROW.nbytes + WIDE.nbytes
+
+
+def test_nbytes_follow_the_values():
+    assert WIDE.nbytes - NARROW.nbytes > 2900
+    narrow, wide = SortedBuffer(), SortedBuffer()
+    fill(narrow, range(50))
+    fill(wide, range(50), WIDE)
+    assert narrow.nbytes == 50 * (ENTRY_OVERHEAD + NARROW.nbytes)
+    assert wide.nbytes == 50 * (ENTRY_OVERHEAD + WIDE.nbytes)
+
+
+def test_the_buffer_freezes_on_bytes_not_entries(tmp_path):
+    capacity = 40000
+    lsm = LsmTree(2000, 2, 4, str(tmp_path), 0.01, buffer_bytes=capacity, max_immutables=8)
+    frozen = dict()
+    for val in (NARROW, WIDE):
+        key = 1 if val is NARROW else 1000
+        while val not in frozen:
+            buf = lsm.root.buffer
+            lsm.write(key, val)
+            key += 1
+            if lsm.root.buffer is not buf:
+                frozen[val] = buf
+        lsm.flush()
+
+    # each froze once its bytes, not its number of entries, reached the capacity
+    for val, buf in frozen.items():
+        per_entry = ENTRY_OVERHEAD + val.nbytes
+        assert buf.nbytes >= capacity > buf.nbytes - per_entry
+        assert len(buf) == -(-capacity // per_entry)
+    assert len(frozen[NARROW]) > 8 * len(frozen[WIDE])
+    lsm.close()
@@ -0,0 +1,79 @@
+import threading
+import time
+
+# counters kept for the tree as a whole
+TREE_COUNTERS = ('reads', 'multi_get_keys', 'scans', 'queries', 'writes', 'deletes', 'wal_bytes', 'manifest_bytes',
+                 'flushes', 'flush_seconds')
+
+# counters kept for every level
+LEVEL_COUNTERS = ('lookups', 'files_opened', 'lookup_files_opened', 'block_bytes_read', 'bloom_checks', 'bloom_hits',
+                  'bloom_false_positives', 'compactions', 'compaction_seconds', 'compaction_bytes_written',
+                  'bloom_rebuilds', 'splits', 'merges', 'query_blocks', 'query_blocks_skipped', 'runs_written',
+                  'run_merges')
+
+'''
+ $$$$ Statistics:
+  Nodes and the memory buffer add to the counters as they go, and LsmTree.stats() derives the rates from them. The
+  write amplification is every byte written to disk (write-ahead log, node files, manifest) per byte of the log.
+  Tree counters:
+   - wal_bytes: bytes of the writes appended to the write-ahead log
+   - manifest_bytes: bytes of the manifest's edit log records and rewrites (see manifest.py)
+  Level counters:
+   - lookups: keys looked up in a node of the level (within the node's key fences)
+   - files_opened: node files opened by reads, scans and queries, one per column group file on the last level
+   - lookup_files_opened: the ones of them opened by point reads (read and multi_get), per key read the
+     files_opened_per_read rate
+   - block_bytes_read: stored bytes of the data blocks reads, scans and queries read from the node files, through a
+     memory map or not (a block cache hit reads none)
+   - bloom_checks, bloom_hits: keys checked against a bloom filter of the level, and how many passed
+   - bloom_false_positives: keys that passed the bloom filter but were not in the file
+   - compactions, compaction_seconds: pushes of a node of the level down into its children, and their time
+   - compaction_bytes_written: bytes of the node files of the level written by compactions (flushes into level 0
+     included)
+   - bloom_rebuilds: node files of the level rewritten because their bloom filter let through too many false
+     positives
+   - splits, merges: nodes of the level split in pieces or merged into a sibling (see partition.py)
+   - query_blocks, query_blocks_skipped: data blocks of the level within the key range of a query, and how many of
+     them were not read because their zone maps ruled the query's predicates out (see zonemap.py)
+   - runs_written, run_merges: sorted runs written by the nodes of a tiered level, and merges of their runs into the
+     node file (see compaction.py)
+
+  Hooks are called as hook(event, info) after every operation ('read', 'multi_get', 'scan', 'query', 'write',
+  'write_batch', 'delete', 'delete_range') and every 'flush' and 'compaction', info being a dict that holds at least
+  the seconds it took.
+'''
+
+
+class TreeStats(object):
+    def __init__(self, levels):
+        self.tree = dict.fromkeys(TREE_COUNTERS, 0)
+        self.levels = [dict.fromkeys(LEVEL_COUNTERS, 0) for _ in range(levels)]
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def count(self, level, **counts):
+        """
+        :param level: level of the counters to add to, None for the tree counters
+        """
+        counters = self.tree if level is None else self.levels[level]
+        with self.lock:
+            for name in counts:
+                counters[name] += counts[name]
+
+    def emit(self, event, **info):
+        for hook in self.hooks:
+            hook(event, info)
+
+    def operation(self, event, start, keys=1, counter=None):
+        """
+        Ends a tree operation that began at time.perf_counter() start: adds keys to the counter, if any, and tells
+        the hooks about it
+        """
+        if counter is not None:
+            self.count(None, **{counter: keys})
+        if self.hooks:
+            self.emit(event, seconds=time.perf_counter() - start, keys=keys)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.tree), [dict(counters) for counters in self.levels]
@@ -0,0 +1,104 @@
+import os
+import pytest
+from lsmTree import LsmTree
+from stats import LEVEL_COUNTERS, TREE_COUNTERS, TreeStats
+
+N = 400
+
+
+def test_counters_add_up_per_level():
+    stats = TreeStats(2)
+    stats.count(None, reads=2, wal_bytes=10)
+    stats.count(1, lookups=3)
+    stats.count(1, lookups=1, files_opened=2)
+    tree, levels = stats.snapshot()
+    assert set(tree) == set(TREE_COUNTERS) and all(set(counters) == set(LEVEL_COUNTERS) for counters in levels)
+    assert (tree['reads'], tree['wal_bytes'], tree['writes']) == (2, 10, 0)
+    assert levels[0]['lookups'] == 0 and (levels[1]['lookups'], levels[1]['files_opened']) == (4, 2)
+
+    # a snapshot is a copy
+    tree['reads'] = 100
+    assert stats.snapshot()[0]['reads'] == 2
+
+
+def test_hooks_see_every_operation(tmp_path, make_value):
+    lsm = LsmTree(N, 2, 4, str(tmp_path), 0.01, buffer_bytes=3000)
+    events = []
+    lsm.add_hook(lambda event, info: events.append((event, info)))
+
+    for key in range(1, 100):
+        lsm.write(key, make_value(key, 0))
+    lsm.write_batch([(key, make_value(key, 1)) for key in range(100, 120)])
+    lsm.delete(5)
+    assert lsm.delete_range(10, 14) == 5
+    lsm.flush()
+    lsm.read(7, 7, 0)
+    lsm.multi_get([7, 8, 9])
+    assert len(list(lsm.scan(1, 50))) == 50 - 6
+    assert len(list(lsm.query(1, N, [(2, '==', '%06d' % 20)]))) == 1
+
+    seen = [event for event, _ in events]
+    for event in ('write', 'write_batch', 'delete', 'delete_range', 'flush', 'read', 'multi_get', 'scan', 'query'):
+        assert event in seen, event
+    assert seen.count('write') == 99
+    assert all(info['seconds'] >= 0 for _, info in events)
+    assert [info['keys'] for event, info in events if event in ('write_batch', 'multi_get', 'delete_range')] == \
+        [20, 5, 3]
+    assert [info['keys'] for event, info in events if event == 'scan'] == [50 - 6]
+    # the deletes are flushed as tombstones
+    assert sum(info['keys'] for event, info in events if event == 'flush') == 99 + 20 + 1 + 5
+    # the level 0 nodes filled up by the flushes were compacted into level 1
+    assert any(event == 'compaction' and info['level'] == 0 for event, info in events)
+    lsm.close()
+
+
+def test_stats_count_what_the_tree_did(tmp_path, make_value):
+    lsm = LsmTree(N, 2, 4, str(tmp_path), 0.01, buffer_bytes=3000)
+    for round_no in range(3):
+        for key in range(1, N):
+            lsm.write(key, make_value(key, round_no))
+    lsm.flush()
+    for key in range(1, N, 7):
+        assert lsm.read(key, key, 0).cols == make_value(key, 2).cols
+    assert lsm.read(N + 5, N + 5, 0) is None
+
+    stats = lsm.stats()
+    tree, levels = stats['tree'], stats['levels']
+    assert tree['writes'] == 3 * (N - 1) and tree['reads'] == len(range(1, N, 7)) + 1
+    assert tree['flushes'] > 0 and tree['wal_bytes'] > 0 and tree['manifest_bytes'] > 0
+
+    # every byte written: the log, the node files and the manifest
+    written = tree['wal_bytes'] + sum(counters['compaction_bytes_written'] for counters in levels) + \
+        tree['manifest_bytes']
+    assert tree['write_amplification'] == pytest.approx(written / tree['wal_bytes'])
+    assert tree['manifest_bytes'] >= os.path.getsize(os.path.join(str(tmp_path), 'MANIFEST'))
+
+    # every key is on one level at least, a key on level 0 and the last level counting twice
+    assert [counters['level'] for counters in levels] == [0, 1]
+    assert levels[0]['keys'] + levels[1]['keys'] >= N - 1 and 0 < levels[1]['keys'] <= N - 1
+    assert 0 < levels[1]['fill_ratio'] <= 1
+    assert all(counters['policy'] == 'leveled' and counters['runs'] == 0 for counters in levels)
+    assert 0 <= levels[1]['bloom_fp_rate'] <= 1
+    assert tree['files_opened_per_read'] == pytest.approx(
+        sum(counters['lookup_files_opened'] for counters in levels) / tree['reads'])
+    assert stats['block_cache']['misses'] > 0
+    assert tree['block_bytes_read'] == sum(counters['block_bytes_read'] for counters in levels) > 0
+
+    # scans and queries open files, but leave the rate of the point reads alone
+    for _ in range(5):
+        assert len(list(lsm.scan(1, N))) == N - 1
+        assert len(list(lsm.query(1, N, [(2, '!=', '%06d' % 1)]))) == N - 2
+    after = lsm.stats()
+    assert sum(counters['files_opened'] for counters in after['levels']) > \
+        sum(counters['files_opened'] for counters in levels)
+    assert after['tree']['files_opened_per_read'] == tree['files_opened_per_read']
+    assert [counters['files_opened_per_read'] for counters in after['levels']] == \
+        [counters['files_opened_per_read'] for counters in levels]
+
+    # scans read their blocks through memory maps, past the block cache, and every one counts them again
+    def scanned():
+        before = lsm.stats()['tree']['block_bytes_read']
+        assert len(list(lsm.scan(1, N))) == N - 1
+        return lsm.stats()['tree']['block_bytes_read'] - before
+    assert scanned() == scanned() > 0
+    lsm.close()
@@ -1,24 +1,120 @@
-import json
+import bisect
+import struct
+from array import array
+
+# encoded value: number of columns of the object, number of columns present (the top bit set when the column ids
+# are left out because they are the ones of the schema), then the column ids, the end offset of every column in the
+# data, and the data (the utf-8 bytes of all columns, one after the other)
+HEADER = struct.Struct('>IH')
+SCHEMA_FLAG = 0x8000
+
+# number of columns of a tombstone, the value a delete writes: it has no columns and hides every older version of its
+# key
+TOMBSTONE = 0xffffffff
+
+# column position of a read wanting none of the columns, only the keys (and which of them are deleted)
+KEYS_ONLY = -1
+
+# bytes of a Value object and its three members when empty, counted by nbytes
+VALUE_OVERHEAD = 200
 
 
 class Value:
     """ data stored. Is the Value in the (key, value) pair """
     '''
-    def __init__(self, a_str, b_str, c_str, d_str):
-        self.col1 = a_str
-        self.col2 = b_str
-        self.col3 = c_str
-        self.col4 = d_str
-        self.col5 = d_str + d_str
-        self.col6 = c_str + c_str
-        self.col7 = b_str + b_str
-        self.col8 = a_str + a_str
+    The columns are kept compact: an array of column ids in ascending order, an array with the end offset of every
+    column, and one bytes object holding the utf-8 bytes of all columns. A single column is decoded on its own (see
+    get), and projecting or stitching rows only slices bytes.
     '''
+    __slots__ = ('ids', 'offsets', 'data', 'num_cols')
 
     def __init__(self, cols, length):
-        self.cols = cols
+        """
+        :param cols: list of (column id, str) pairs
+        :param length: number of columns of the object
+        """
+        cols = sorted(cols)
+        self.ids = array('i', [col for col, _ in cols])
+        self.offsets = array('I')
+        data = bytearray()
+        for _, col_val in cols:
+            data += col_val.encode()
+            self.offsets.append(len(data))
+        self.data = bytes(data)
         self.num_cols = length
 
+    @classmethod
+    def from_parts(cls, ids, offsets, data, length):
+        val = cls.__new__(cls)
+        val.ids = ids
+        val.offsets = offsets
+        val.data = data
+        val.num_cols = length
+        return val
+
+    @classmethod
+    def from_raw(cls, pairs, num_cols=None):
+        """
+        :param pairs: list of (column id, utf-8 bytes) pairs in column id order
+        :param num_cols: num_cols of the row the columns come from, by default the number of pairs
+        """
+        ids = array('i')
+        offsets = array('I')
+        data = bytearray()
+        for col, col_bytes in pairs:
+            ids.append(col)
+            data += col_bytes
+            offsets.append(len(data))
+        return cls.from_parts(ids, offsets, bytes(data), len(ids) if num_cols is None else num_cols)
+
+    @classmethod
+    def tombstone(cls):
+        return cls.from_parts(array('i'), array('I'), b'', TOMBSTONE)
+
+    @property
+    def is_tombstone(self):
+        return self.num_cols == TOMBSTONE
+
+    @property
+    def cols(self):
+        """
+        list of (column id, str) pairs, decoding every column
+        """
+        return [(col, self.data[self.start(pos):end].decode()) for pos, (col, end) in
+                enumerate(zip(self.ids, self.offsets))]
+
+    def start(self, pos):
+        return self.offsets[pos - 1] if pos else 0
+
+    def get(self, col):
+        """
+        :return: the str of one column, decoding nothing else, or None if the value does not hold the column
+        """
+        col_bytes = self.get_bytes(col)
+        return None if col_bytes is None else col_bytes.decode()
+
+    def get_bytes(self, col):
+        """
+        :return: the utf-8 bytes of one column, or None if the value does not hold the column
+        """
+        pos = bisect.bisect_left(self.ids, col)
+        if pos == len(self.ids) or self.ids[pos] != col:
+            return None
+        return self.data[self.start(pos):self.offsets[pos]]
+
+    def col_sizes(self):
+        """
+        :return: list of (column id, bytes of the column) pairs
+        """
+        return [(col, end - self.start(pos)) for pos, (col, end) in enumerate(zip(self.ids, self.offsets))]
+
+    @property
+    def nbytes(self):
+        """
+        approximate memory size of the value
+        """
+        return VALUE_OVERHEAD + len(self.data) + len(self.ids) * (self.ids.itemsize + self.offsets.itemsize)
+
     @staticmethod
     def print_value(val):
         pstr = ''
@@ -32,3 +128,84 @@ class Value:
 
         return pstr
 
+    def project(self, cols):
+        """
+        :param cols: set of column ids to keep, None keeps every column
+        :return: Value holding only the wanted columns
+        """
+        if cols is None or self.is_tombstone:
+            return self
+        picked = [pos for pos, col in enumerate(self.ids) if col in cols]
+        return self.pick([(self, pos) for pos in picked], self.num_cols)
+
+    @staticmethod
+    def pick(columns, num_cols=None):
+        """
+        Builds a row from columns of other rows, without decoding them
+        :param columns: list of (Value, position of the column in it) pairs, in column id order
+        :param num_cols: num_cols of the row being built (see from_raw)
+        """
+        return Value.from_raw([(val.ids[pos], val.data[val.start(pos):val.offsets[pos]]) for val, pos in columns],
+                              num_cols)
+
+    @staticmethod
+    def stitch(parts):
+        """
+        Builds one row from the parts of it read out of several column groups
+        :param parts: list of Values, each carrying the num_cols of the whole row
+        """
+        columns = sorted(((col, val, pos) for val in parts for pos, col in enumerate(val.ids)),
+                         key=lambda column: column[0])
+        return Value.pick([(val, pos) for _, val, pos in columns], max((val.num_cols for val in parts), default=None))
+
+    def encode(self, schema=None):
+        """
+        :param schema: column ids the reader already knows (see decode), left out when they are the value's
+        :return: bytes
+        """
+        count = len(self.ids)
+        if schema is not None and schema == self.ids:
+            head = HEADER.pack(self.num_cols, count | SCHEMA_FLAG)
+        else:
+            head = HEADER.pack(self.num_cols, count) + struct.pack('>%di' % count, *self.ids)
+        return head + struct.pack('>%dI' % count, *self.offsets) + self.data
+
+    @staticmethod
+    def decode(buf, schema=None):
+        """
+        :param schema: the column ids to use if the encoded value left them out
+        """
+        num_cols, count = HEADER.unpack_from(buf, 0)
+        pos = HEADER.size
+        if count & SCHEMA_FLAG:
+            count &= ~SCHEMA_FLAG
+            ids = schema
+        else:
+            ids = array('i', struct.unpack_from('>%di' % count, buf, pos))
+            pos += 4 * count
+        offsets = array('I', struct.unpack_from('>%dI' % count, buf, pos))
+        pos += 4 * count
+        return Value.from_parts(ids, offsets, bytes(buf[pos:]), num_cols)
+
+    @staticmethod
+    def decode_empty(buf):
+        """
+        Decodes only the header of an encoded value
+        :return: Value holding none of the columns, with the num_cols of the encoded one (so a tombstone stays one)
+        """
+        num_cols, _ = HEADER.unpack_from(buf, 0)
+        return Value.from_parts(array('i'), array('I'), b'', num_cols)
+
+    @staticmethod
+    def wanted_cols(col_pos):
+        """
+        :param col_pos: 0 (or None) for every column, KEYS_ONLY for none, a column id, or a list of column ids
+        :return: set of column ids, None meaning every column
+        """
+        if col_pos == KEYS_ONLY:
+            return set()
+        if not col_pos:
+            return None
+        if isinstance(col_pos, int):
+            return {col_pos}
+        return set(col_pos)
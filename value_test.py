@@ -0,0 +1,72 @@
+from array import array
+from value import HEADER, KEYS_ONLY, SCHEMA_FLAG, TOMBSTONE, Value
+
+ROW = Value([(3, 'three'), (1, 'one'), (7, ''), (2, 'zwei ü')], 9)
+
+
+def test_columns_are_kept_in_id_order():
+    assert ROW.cols == [(1, 'one'), (2, 'zwei ü'), (3, 'three'), (7, '')]
+    assert (ROW.get(2), ROW.get(7), ROW.get(4)) == ('zwei ü', '', None)
+    assert ROW.get_bytes(2) == 'zwei ü'.encode()
+    assert ROW.col_sizes() == [(1, 3), (2, 7), (3, 5), (7, 0)]
+    assert not ROW.is_tombstone and ROW.num_cols == 9
+
+
+def test_encode_round_trip():
+    data = ROW.encode()
+    assert HEADER.unpack_from(data, 0) == (9, 4)
+    val = Value.decode(data)
+    assert val.cols == ROW.cols and val.num_cols == 9
+    assert list(val.ids) == [1, 2, 3, 7]
+
+    # a memoryview of a larger buffer decodes the same
+    assert Value.decode(memoryview(b'head' + data)[4:]).cols == ROW.cols
+
+
+def test_schema_flag_leaves_the_column_ids_out():
+    schema = array('i', [1, 2, 3, 7])
+    data = ROW.encode(schema)
+    assert HEADER.unpack_from(data, 0) == (9, 4 | SCHEMA_FLAG)
+    assert len(data) == len(ROW.encode()) - 4 * 4
+    assert Value.decode(data, schema).cols == ROW.cols
+
+    # the ids are written whenever they differ from the schema
+    other = array('i', [1, 2, 3])
+    assert HEADER.unpack_from(ROW.encode(other), 0) == (9, 4)
+    assert Value.decode(ROW.encode(other), other).cols == ROW.cols
+
+
+def test_tombstones_survive_encoding():
+    tomb = Value.tombstone()
+    assert tomb.is_tombstone and tomb.num_cols == TOMBSTONE and tomb.cols == []
+    assert Value.decode(tomb.encode()).is_tombstone
+    assert Value.decode_empty(tomb.encode()).is_tombstone
+    assert tomb.project({1}) is tomb
+
+    empty = Value.decode_empty(ROW.encode())
+    assert empty.cols == [] and empty.num_cols == 9 and not empty.is_tombstone
+
+
+def test_project_pick_and_stitch():
+    assert ROW.project(None) is ROW
+    part = ROW.project({3, 1, 5})
+    assert part.cols == [(1, 'one'), (3, 'three')] and part.num_cols == 9
+    assert ROW.project(set()).cols == []
+
+    rest = ROW.project({2, 7})
+    whole = Value.stitch([rest, part])
+    assert whole.cols == ROW.cols and whole.num_cols == 9
+    assert Value.pick([(ROW, 2), (part, 0)], 2).cols == [(3, 'three'), (1, 'one')]
+    assert Value.from_raw([(4, b'x')]).num_cols == 1
+
+
+def test_wanted_cols():
+    assert Value.wanted_cols(0) is None and Value.wanted_cols(None) is None
+    assert Value.wanted_cols(KEYS_ONLY) == set()
+    assert Value.wanted_cols(3) == {3}
+    assert Value.wanted_cols([1, 3, 3]) == {1, 3}
+
+
+def test_nbytes_grows_with_the_data():
+    small, large = Value([(1, 'a')], 1), Value([(1, 'a' * 1000)], 1)
+    assert large.nbytes - small.nbytes == 999
@@ -0,0 +1,189 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from value import Value
+
+'''
+ $$$$ Write-ahead log:
+  Every write is appended to the active log segment "wal-<n>.log" under the tree's file root before it goes into the
+  memory buffer. A record is framed as (crc32, value length, key) packed as fixed-width integers followed by the
+  encoded value (see Value.encode); the crc covers the key and the value bytes, so a torn record at the end of a
+  segment is detected and ends the replay of that segment.
+
+  When the memory buffer is frozen the active segment is sealed together with it and a new segment is started. Once
+  the compactor has flushed a frozen buffer into level 0, its segment is deleted, so the log never holds more than the
+  buffers that are not on disk yet. On start up the segments left by an earlier run are replayed into the buffer.
+
+  Sync policies:
+   - 'always': fsync after every write (or write_batch), before the next one is logged
+   - 'group':  group commit. A write returns once its records are on disk, and the writers waiting for that share
+               fsyncs: the first one to wait syncs the records of every write logged so far, outside of the log's
+               lock, while the writes logged meanwhile wait for the next fsync, made by the first of them. With
+               group_ms, the one syncing first waits up to group_ms milliseconds for group_records records to be
+               pending, more writes sharing an fsync at the cost of latency.
+   - 'none':   hand the records to the OS, never fsync
+'''
+
+RECORD = struct.Struct('>IIq')
+KEY = struct.Struct('>q')
+SYNC_POLICIES = ('always', 'group', 'none')
+
+
+class WriteAheadLog(object):
+    def __init__(self, file_root, sync_policy, group_records, group_ms):
+        if sync_policy not in SYNC_POLICIES:
+            raise ValueError('unknown WAL sync policy: ' + str(sync_policy))
+
+        self.file_root = file_root
+        self.sync_policy = sync_policy
+        self.group_records = group_records
+        self.group_ms = group_ms
+
+        # segments an earlier run left behind, replayed into the buffer and then removed
+        existing = sorted(int(name[4:-4]) for name in os.listdir(file_root)
+                          if name.startswith('wal-') and name.endswith('.log'))
+        self.recovered = existing
+
+        # segments sealed with a frozen buffer, oldest first, deleted once that buffer is flushed
+        self.sealed = []
+
+        self.lock = threading.Lock()
+        self.segment = (existing[-1] + 1) if existing else 1
+        self.outfile = open(self.segment_name(self.segment), "ab")
+
+        # number of records logged, and how many of the first of them are on disk. Writers waiting for their records
+        # wait on durable, which shares the lock
+        self.appended = 0
+        self.synced = 0
+        self.durable = threading.Condition(self.lock)
+
+        # whether a writer is syncing the log for the others, outside of the lock
+        self.syncing = False
+
+        self.closed = False
+
+    def segment_name(self, segment):
+        return os.path.join(self.file_root, 'wal-%06d.log' % segment)
+
+    def append(self, items):
+        """
+        Logs a list of (key, value) pairs, applying the sync policy once for all of them. Under 'group' the caller
+        passes the ticket to commit once it no longer holds up other writers.
+        :return: number of bytes logged, ticket of the records
+        """
+        out = bytearray()
+        for key, value in items:
+            val_bytes = value.encode()
+            crc = zlib.crc32(val_bytes, zlib.crc32(KEY.pack(key)))
+            out += RECORD.pack(crc, len(val_bytes), key)
+            out += val_bytes
+
+        with self.lock:
+            self.outfile.write(out)
+            self.outfile.flush()
+            self.appended += len(items)
+            if self.sync_policy == 'always':
+                self.sync_locked()
+            elif self.appended - self.synced >= self.group_records:
+                # a writer gathering a group waits for no more
+                self.durable.notify_all()
+            return len(out), self.appended
+
+    def commit(self, ticket):
+        """
+        Returns once the records of the ticket are on disk, as far as the sync policy makes them
+        """
+        if self.sync_policy != 'group':
+            return
+        with self.lock:
+            while self.synced < ticket:
+                if self.syncing:
+                    self.durable.wait()
+                    continue
+
+                # this writer syncs for every write logged so far
+                self.syncing = True
+                try:
+                    if self.group_ms:
+                        deadline = time.monotonic() + self.group_ms / 1000
+                        while self.appended - self.synced < self.group_records and time.monotonic() < deadline:
+                            self.durable.wait(deadline - time.monotonic())
+                    upto, outfile = self.appended, self.outfile
+                    self.lock.release()
+                    try:
+                        os.fsync(outfile.fileno())
+                    finally:
+                        self.lock.acquire()
+                    self.synced = max(self.synced, upto)
+                finally:
+                    self.syncing = False
+                    self.durable.notify_all()
+
+    def sync(self):
+        with self.lock:
+            self.sync_locked()
+
+    def sync_locked(self):
+        # the segment is not closed under a writer syncing it
+        while self.syncing:
+            self.durable.wait()
+        if self.appended > self.synced and self.sync_policy != 'none':
+            os.fsync(self.outfile.fileno())
+        self.synced = self.appended
+        self.durable.notify_all()
+
+    def rotate(self):
+        """
+        Seals the active segment (it belongs to the buffer being frozen) and starts a new one
+        """
+        with self.lock:
+            self.sync_locked()
+            self.outfile.close()
+            self.sealed.append(self.segment)
+            self.segment += 1
+            self.outfile = open(self.segment_name(self.segment), "ab")
+
+    def release_oldest(self):
+        """
+        The oldest frozen buffer is on disk now, so its segment is no longer needed
+        """
+        with self.lock:
+            segment = self.sealed.pop(0)
+        os.remove(self.segment_name(segment))
+
+    def replay(self):
+        """
+        Yields the (key, value) pairs of every segment an earlier run left behind as one list per segment, in the order
+        they were written
+        """
+        for segment in self.recovered:
+            with open(self.segment_name(segment), "rb") as infile:
+                data = infile.read()
+            pairs = []
+            pos = 0
+            while pos + RECORD.size <= len(data):
+                crc, val_len, key = RECORD.unpack_from(data, pos)
+                val_bytes = data[(pos + RECORD.size):(pos + RECORD.size + val_len)]
+                if len(val_bytes) < val_len or zlib.crc32(val_bytes, zlib.crc32(KEY.pack(key))) != crc:
+                    # torn write at the end of the segment
+                    break
+                pairs.append((key, Value.decode(val_bytes)))
+                pos += RECORD.size + val_len
+            yield pairs
+
+    def forget_recovered(self):
+        """
+        Removes the replayed segments, once their records are logged again in the current segments
+        """
+        self.sync()
+        for segment in self.recovered:
+            os.remove(self.segment_name(segment))
+        self.recovered = []
+
+    def close(self):
+        with self.lock:
+            self.sync_locked()
+            self.closed = True
+            self.outfile.close()
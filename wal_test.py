@@ -0,0 +1,121 @@
+import os
+import threading
+import pytest
+import wal
+from lsmTree import LsmTree
+from value import Value
+from wal import WriteAheadLog
+
+
+def make_value(key):
+    return Value([(1, 'v%d' % key), (2, 'k%d' % key)], 2)
+
+
+def test_replay_stops_at_a_torn_tail(tmp_path):
+    log = WriteAheadLog(str(tmp_path), 'always', 128, 0)
+    log.append([(key, make_value(key)) for key in range(10)])
+    log.rotate()
+    log.append([(key, make_value(key)) for key in range(10, 20)])
+    log.close()
+
+    # the last record of the second segment is cut short, as by a crash in the middle of the write
+    last = log.segment_name(2)
+    with open(last, 'r+b') as outfile:
+        outfile.truncate(os.path.getsize(last) - 3)
+
+    again = WriteAheadLog(str(tmp_path), 'always', 128, 0)
+    assert again.recovered == [1, 2]
+    replayed = list(again.replay())
+    assert [[key for key, _ in pairs] for pairs in replayed] == [list(range(10)), list(range(10, 19))]
+    assert all(val.cols == make_value(key).cols for pairs in replayed for key, val in pairs)
+    again.forget_recovered()
+    again.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['wal-000003.log']
+
+
+def test_replay_stops_at_a_corrupt_record(tmp_path):
+    log = WriteAheadLog(str(tmp_path), 'none', 128, 0)
+    nbytes, _ = log.append([(1, make_value(1))])
+    log.append([(2, make_value(2)), (3, make_value(3))])
+    log.close()
+
+    # a flipped byte in the second record's value fails its crc, ending the segment there
+    with open(log.segment_name(1), 'r+b') as outfile:
+        outfile.seek(nbytes + wal.RECORD.size + 2)
+        byte = outfile.read(1)
+        outfile.seek(-1, os.SEEK_CUR)
+        outfile.write(bytes([byte[0] ^ 0xff]))
+    assert [[key for key, _ in pairs] for pairs in WriteAheadLog(str(tmp_path), 'none', 128, 0).replay()] == [[1]]
+
+
+def test_tree_replays_a_torn_tail(tmp_path):
+    lsm = LsmTree(200, 2, 4, str(tmp_path), 0.01, wal_sync='always')
+    for key in range(1, 50):
+        lsm.write(key, make_value(key))
+    # never closed, the buffer only in the log; its last record torn
+    segment = lsm.wal.segment_name(lsm.wal.segment)
+    with open(segment, 'r+b') as outfile:
+        outfile.truncate(os.path.getsize(segment) - 1)
+
+    lsm = LsmTree.open(str(tmp_path))
+    assert [key for key, _ in lsm.scan(0, 200)] == list(range(1, 49))
+    assert lsm.read(49, 49, 0) is None
+    lsm.close()
+
+
+def test_group_commit_returns_once_the_write_is_synced(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+
+    def counting_fsync(fd):
+        synced.append(fd)
+        fsync(fd)
+    monkeypatch.setattr(wal.os, 'fsync', counting_fsync)
+
+    log = WriteAheadLog(str(tmp_path), 'group', 128, 0)
+    _, ticket = log.append([(1, make_value(1))])
+    assert log.synced < ticket
+    log.commit(ticket)
+    assert log.synced >= ticket and len(synced) == 1
+
+    # nothing left to sync for an earlier ticket
+    log.commit(ticket)
+    assert len(synced) == 1
+    log.close()
+
+
+def test_group_commit_shares_fsyncs_between_writers(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+
+    def counting_fsync(fd):
+        synced.append(fd)
+        fsync(fd)
+    monkeypatch.setattr(wal.os, 'fsync', counting_fsync)
+
+    log = WriteAheadLog(str(tmp_path), 'group', 128, 0)
+    logged = threading.Barrier(8)
+    tickets = []
+
+    def writer(key):
+        _, ticket = log.append([(key, make_value(key))])
+        tickets.append(ticket)
+        # every writer logs its record before any of them commits
+        logged.wait()
+        log.commit(ticket)
+        assert log.synced >= ticket
+
+    threads = [threading.Thread(target=writer, args=(key,)) for key in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(tickets) == list(range(1, 9))
+    # the writer syncing first syncs the records of all of them
+    assert len(synced) == 1
+    log.close()
+
+
+def test_unknown_sync_policy(tmp_path):
+    with pytest.raises(ValueError):
+        WriteAheadLog(str(tmp_path), 'sometimes', 128, 0)
@@ -0,0 +1,81 @@
+import threading
+
+# bytes charged for every column group file a read touches (a file open plus a block read)
+GROUP_OPEN_COST = 4096
+
+'''
+ $$$$ Column cracking:
+  Reads that reach the last level are recorded per node (key range) as the set of columns they wanted. When the node
+  is rewritten by a compaction, its columns are regrouped so that columns always read together share one group file:
+  every column is labelled with the set of recorded read patterns that want it, and columns with the same label form
+  one group (columns no read wanted form a cold group of their own). The new grouping is only used when the bytes it
+  would have saved on the recorded reads are more than rewrite_factor times the bytes of the node.
+
+'''
+
+
+class WorkloadMonitor(object):
+    def __init__(self, rewrite_factor):
+        # node file root -> {frozenset of column ids, None for whole rows -> [number of reads, number of rows]}
+        self.coaccess = dict()
+
+        # how many times the node size the recorded reads have to save before the node gets regrouped
+        self.rewrite_factor = rewrite_factor
+
+        self.lock = threading.Lock()
+
+    def record(self, node_id, cols, rows=1):
+        pattern = None if cols is None else frozenset(cols)
+        with self.lock:
+            counts = self.coaccess.setdefault(node_id, dict()).setdefault(pattern, [0, 0])
+            counts[0] += 1
+            counts[1] += rows
+
+    def regroup(self, node_id, layout, col_bytes, num_rows):
+        """
+        :param layout: the current column groups of the node
+        :param col_bytes: average bytes per row of every column of the node
+        :param num_rows: number of rows the node holds
+        :return: the new column groups if regrouping pays off, otherwise None
+        """
+        with self.lock:
+            patterns = dict(self.coaccess.get(node_id, {}))
+        if not patterns or not col_bytes:
+            return None
+
+        proposed = self.propose(patterns, sorted(col_bytes))
+        if sorted(proposed) == sorted(sorted(group_cols) for group_cols in layout):
+            return None
+
+        savings = self.cost(layout, patterns, col_bytes) - self.cost(proposed, patterns, col_bytes)
+        rewrite = self.rewrite_factor * num_rows * sum(col_bytes.values())
+        if savings <= rewrite:
+            return None
+
+        # a new layout starts a new observation window
+        with self.lock:
+            self.coaccess.pop(node_id, None)
+        return proposed
+
+    @staticmethod
+    def propose(patterns, all_cols):
+        """
+        Groups the columns read by exactly the same read patterns together
+        """
+        labels = dict()
+        for col in all_cols:
+            label = frozenset(pattern for pattern in patterns if pattern is None or col in pattern)
+            labels.setdefault(label, []).append(col)
+        return sorted(labels.values())
+
+    @staticmethod
+    def cost(layout, patterns, col_bytes):
+        """
+        Expected bytes the recorded reads cost with the given column groups
+        """
+        total = 0
+        for pattern, (reads, rows) in patterns.items():
+            for group_cols in layout:
+                if pattern is None or any(col in pattern for col in group_cols):
+                    total += reads * GROUP_OPEN_COST + rows * sum(col_bytes.get(col, 0) for col in group_cols)
+        return total
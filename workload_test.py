@@ -0,0 +1,61 @@
+from lsmTree import LsmTree
+from value import Value
+from workload import GROUP_OPEN_COST, WorkloadMonitor
+
+COL_BYTES = {1: 10, 2: 10, 3: 10, 4: 10}
+
+
+def test_propose_groups_columns_read_together():
+    patterns = {frozenset({1, 2}): [5, 5], frozenset({2, 3}): [1, 1]}
+    assert WorkloadMonitor.propose(patterns, [1, 2, 3, 4]) == [[1], [2], [3], [4]]
+
+    patterns = {frozenset({1, 2}): [5, 5], frozenset({3}): [1, 1]}
+    assert WorkloadMonitor.propose(patterns, [1, 2, 3, 4]) == [[1, 2], [3], [4]]
+
+    # a whole row read wants every column
+    patterns = {None: [1, 1], frozenset({1, 2}): [5, 5]}
+    assert WorkloadMonitor.propose(patterns, [1, 2, 3, 4]) == [[1, 2], [3, 4]]
+
+
+def test_cost_counts_the_groups_a_read_opens():
+    patterns = {frozenset({1, 2}): [100, 300]}
+    assert WorkloadMonitor.cost([[1], [2], [3], [4]], patterns, COL_BYTES) == 2 * (100 * GROUP_OPEN_COST + 300 * 10)
+    assert WorkloadMonitor.cost([[1, 2], [3, 4]], patterns, COL_BYTES) == 100 * GROUP_OPEN_COST + 300 * 20
+    assert WorkloadMonitor.cost([[1, 2, 3, 4]], {None: [1, 1]}, COL_BYTES) == GROUP_OPEN_COST + 40
+
+
+def test_regroup_only_when_the_savings_pay_for_the_rewrite():
+    layout = [[1], [2], [3], [4]]
+    # 100 reads of 100 rows in all save a file open each
+    savings = 100 * GROUP_OPEN_COST
+
+    monitor = WorkloadMonitor(1.0)
+    monitor.record('node', {1, 2}, 100)
+    for _ in range(99):
+        monitor.record('node', {1, 2}, 0)
+    assert monitor.regroup('node', layout, COL_BYTES, savings // 40 + 1) is None
+    assert monitor.regroup('node', layout, COL_BYTES, savings // 40 - 1) == [[1, 2], [3, 4]]
+
+    # a new layout starts a new observation window
+    assert monitor.regroup('node', layout, COL_BYTES, 1) is None
+
+    # nor is a node regrouped into the layout it has
+    monitor.record('node', {1, 2})
+    assert monitor.regroup('node', [[1, 2], [3, 4]], COL_BYTES, 1) is None
+
+
+def test_reads_regroup_last_level_nodes(tmp_path):
+    lsm = LsmTree(400, 2, 4, str(tmp_path), 0.01, buffer_bytes=4000, regroup_cost_factor=0.01)
+    for round_no in range(2):
+        for key in range(1, 400):
+            lsm.write(key, Value([(col, '%d-%d' % (round_no, col)) for col in range(1, 5)], 4))
+        lsm.flush()
+        for key in range(1, 400):
+            assert lsm.read(key, key, [1, 2]).cols == [(1, '%d-1' % round_no), (2, '%d-2' % round_no)]
+
+    # the nodes rewritten since the reads have the columns read together in one group
+    layouts = [node.column_groups for level_0 in lsm.root.children.values() for node in level_0.children.values()]
+    assert [[1, 2], [3, 4]] in layouts
+    assert all(layout in ([[1], [2], [3], [4]], [[1, 2], [3, 4]]) for layout in layouts)
+    assert all(val.cols == [(col, '1-%d' % col) for col in range(1, 5)] for _, val in lsm.scan(0, 400))
+    lsm.close()
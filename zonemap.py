@@ -0,0 +1,259 @@
+import struct
+
+'''
+ $$$$ Zone maps:
+  Every node file records, for every data block, the smallest and largest value and the number of rows without it of
+  every column (the zone map of the block), after its column groups. Columns compare as the str they hold; min and max
+  are kept as utf-8 bytes, which order the same way, and cut to ZONE_BYTES (a cut max is rounded up, so it still is
+  no smaller than every value). A row without the column is a null for it, a tombstone is null in every column.
+
+  A query (see LsmTree.query) asks for the rows of a key range whose columns satisfy predicates (column, operator,
+  value). A block whose zone map shows that none of its rows can satisfy them all is not read, and neither is a whole
+  file whose blocks all are ruled out. The zone maps of a file are read on the first query that reaches it, and
+  cached with its metadata.
+
+  The files of a last level column group only hold the columns of their group, and only rule out blocks on those: a
+  predicate on a column held by another group is left to that group's file.
+'''
+
+# predicate operators: comparisons with the str of the column, and whether the row has no value for the column
+OPS = ('==', '!=', '<', '<=', '>', '>=', 'null', 'not null')
+
+# bytes of a column's min and max kept in a zone map
+ZONE_BYTES = 32
+
+# zone maps section: number of columns the file holds (NOT_LISTED for every column), their ids, number of blocks
+COVERED = struct.Struct('>iI')
+NOT_LISTED = -1
+
+# zone map of a block: number of rows, number of columns with a value in any row; then per column: column id, number
+# of rows without a value, length of min, length of max, followed by min and max
+ZONE = struct.Struct('>IH')
+ZONE_COLUMN = struct.Struct('>iIHH')
+
+
+class ZoneMap(object):
+    """
+    Per column min, max and null count of some rows
+    """
+    def __init__(self, rows, columns):
+        # number of rows
+        self.rows = rows
+
+        # column id -> (min bytes, max bytes, number of rows without the column), only for the columns some row holds
+        self.columns = columns
+
+    @classmethod
+    def build(cls, vals):
+        """
+        :param vals: list of Value
+        """
+        found = dict()
+        for val in vals:
+            data = val.data
+            start = 0
+            for col, end in zip(val.ids, val.offsets):
+                col_bytes = data[start:end]
+                start = end
+                stats = found.get(col)
+                if stats is None:
+                    found[col] = [col_bytes, col_bytes, 1]
+                    continue
+                if col_bytes < stats[0]:
+                    stats[0] = col_bytes
+                elif col_bytes > stats[1]:
+                    stats[1] = col_bytes
+                stats[2] += 1
+        return cls(len(vals), {col: (lower_bound(stats[0]), upper_bound(stats[1]), len(vals) - stats[2])
+                               for col, stats in found.items()})
+
+    @classmethod
+    def merge(cls, zones):
+        """
+        :return: the zone map of all rows of the zone maps
+        """
+        rows = sum(zone.rows for zone in zones)
+        merged = dict()
+        for zone in zones:
+            for col, (low, high, _) in zone.columns.items():
+                if col in merged:
+                    low, high = min(low, merged[col][0]), max(high, merged[col][1])
+                merged[col] = (low, high, 0)
+        for col in merged:
+            # a block without the column has all of its rows null for it
+            nulls = sum(zone.columns[col][2] if col in zone.columns else zone.rows for zone in zones)
+            merged[col] = merged[col][:2] + (nulls,)
+        return cls(rows, merged)
+
+    def may_match(self, predicates, covered=None):
+        """
+        :param predicates: list of (column id, operator, utf-8 bytes or None), see compile_predicates
+        :param covered: set of the columns the rows were projected on, None if they hold all of theirs
+        :return: False if no row can satisfy all predicates
+        """
+        for col, op, value in predicates:
+            if covered is not None and col not in covered:
+                continue
+            if not self.column_may_match(col, op, value):
+                return False
+        return True
+
+    def column_may_match(self, col, op, value):
+        if col not in self.columns:
+            # every row is null
+            return op == 'null' and self.rows > 0
+        low, high, nulls = self.columns[col]
+        if op == 'null':
+            return nulls > 0
+        if op == 'not null':
+            return True
+        if op == '==':
+            return low <= value <= high
+        if op == '!=':
+            return not (low == high == value)
+        if op == '<':
+            return low < value
+        if op == '<=':
+            return low <= value
+        if op == '>':
+            return high > value
+        return high >= value
+
+
+def lower_bound(col_bytes):
+    return col_bytes[:ZONE_BYTES]
+
+
+def upper_bound(col_bytes):
+    """
+    :return: the bytes cut to ZONE_BYTES and rounded up, so no smaller than any bytes sharing the cut prefix
+    """
+    if len(col_bytes) <= ZONE_BYTES:
+        return col_bytes
+    prefix = col_bytes[:ZONE_BYTES].rstrip(b'\xff')
+    if not prefix:
+        return col_bytes
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+def compile_predicates(predicates):
+    """
+    :param predicates: list of (column id, operator, str) triples, operator being one of OPS (the str is left out or
+                       None for 'null' and 'not null')
+    :return: list of (column id, operator, utf-8 bytes or None)
+    """
+    compiled = []
+    for predicate in predicates:
+        col, op = predicate[0], predicate[1]
+        if op not in OPS:
+            raise ValueError('predicate operator takes one of ' + str(OPS))
+        value = predicate[2] if len(predicate) > 2 else None
+        if op not in ('null', 'not null'):
+            if not isinstance(value, str):
+                raise ValueError('predicate ' + str(predicate) + ' compares with a str')
+            value = value.encode()
+        compiled.append((col, op, value))
+    return compiled
+
+
+def matches(val, predicates):
+    """
+    :param predicates: compiled predicates (see compile_predicates)
+    :return: whether the Value satisfies all of them
+    """
+    for col, op, value in predicates:
+        col_bytes = val.get_bytes(col)
+        if op == 'null':
+            ok = col_bytes is None
+        elif op == 'not null':
+            ok = col_bytes is not None
+        elif col_bytes is None:
+            ok = False
+        elif op == '==':
+            ok = col_bytes == value
+        elif op == '!=':
+            ok = col_bytes != value
+        elif op == '<':
+            ok = col_bytes < value
+        elif op == '<=':
+            ok = col_bytes <= value
+        elif op == '>':
+            ok = col_bytes > value
+        else:
+            ok = col_bytes >= value
+        if not ok:
+            return False
+    return True
+
+
+def predicate_columns(predicates):
+    return set(col for col, _, _ in predicates)
+
+
+def encode_zone_maps(zones, covered=None):
+    """
+    :param zones: ZoneMap of every data block
+    :param covered: the columns the file holds, None for all
+    """
+    cols = [] if covered is None else sorted(covered)
+    out = bytearray(COVERED.pack(NOT_LISTED if covered is None else len(cols), len(zones)))
+    out += struct.pack('>%di' % len(cols), *cols)
+    for zone in zones:
+        out += ZONE.pack(zone.rows, len(zone.columns))
+        for col in sorted(zone.columns):
+            low, high, nulls = zone.columns[col]
+            out += ZONE_COLUMN.pack(col, nulls, len(low), len(high))
+            out += low
+            out += high
+    return bytes(out)
+
+
+def decode_zone_maps(data):
+    """
+    :return: FileZones
+    """
+    num_covered, num_zones = COVERED.unpack_from(data, 0)
+    pos = COVERED.size
+    covered = None
+    if num_covered != NOT_LISTED:
+        covered = set(struct.unpack_from('>%di' % num_covered, data, pos))
+        pos += 4 * num_covered
+
+    zones = []
+    for _ in range(num_zones):
+        rows, num_cols = ZONE.unpack_from(data, pos)
+        pos += ZONE.size
+        columns = dict()
+        for _ in range(num_cols):
+            col, nulls, low_len, high_len = ZONE_COLUMN.unpack_from(data, pos)
+            pos += ZONE_COLUMN.size
+            low = data[pos:(pos + low_len)]
+            pos += low_len
+            high = data[pos:(pos + high_len)]
+            pos += high_len
+            columns[col] = (low, high, nulls)
+        zones.append(ZoneMap(rows, columns))
+    return FileZones(zones, covered)
+
+
+class FileZones(object):
+    """
+    The zone maps of a node file
+    """
+    def __init__(self, blocks, covered):
+        # zone map of every data block
+        self.blocks = blocks
+
+        # the columns the file holds, None for all
+        self.covered = covered
+
+        # zone map of the whole file
+        self.whole = ZoneMap.merge(blocks)
+
+    def matching_blocks(self, predicates, first, last):
+        """
+        :return: the positions of the blocks from first to last (inclusive) whose rows may satisfy the predicates
+        """
+        if not self.whole.may_match(predicates, self.covered):
+            return []
+        return [blk for blk in range(first, last + 1) if self.blocks[blk].may_match(predicates, self.covered)]